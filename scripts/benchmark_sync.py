@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import shutil
+import socket
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import requests
+import mysql.connector
+from mysql.connector import Error
+
+from db import db_cursor
+from enqueue import enqueue_images
+from registry_client import RegistryClient
+from docker_client import DockerClient, DockerError
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 基准测试使用的容器，名称固定，重复运行前会先删除
+CONTAINER_PREFIX = 'mydocker-bench'
+REGISTRY_IMAGE = 'registry:2'
+MYSQL_IMAGE = 'mysql:8.0'
+MYSQL_PASSWORD = 'bench'
+MYSQL_DB = 'mydocker_bench'
+
+# 合成镜像所在的命名空间
+NAMESPACE = 'bench'
+
+# 等待容器就绪的最长时间（秒）
+READY_TIMEOUT = 180
+
+# 测试场景: cold 目标仓库为空且没有本地缓存; warm 目标仓库为空，但上一次运行的blob缓存或本地镜像保留;
+# present 目标仓库中已有全部层，只清空推送记录，预检不会跳过
+SCENARIOS = ('cold', 'warm', 'present')
+
+MANIFEST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+CONFIG_MEDIA_TYPE = 'application/vnd.docker.container.image.v1+json'
+LAYER_MEDIA_TYPE = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+
+MB = 1024 * 1024
+
+def log(message):
+    print(message, flush=True)
+
+def docker_cli(*args, check=True):
+    """执行docker命令，返回标准输出"""
+    result = subprocess.run(['docker'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"docker {' '.join(args)} 失败: {result.stderr.strip()}")
+    return result.stdout.strip()
+
+def container_name(role):
+    return f"{CONTAINER_PREFIX}-{role}"
+
+def wait_until(check, description, timeout=READY_TIMEOUT):
+    """每秒调用一次check，返回True时结束，超时报错"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except (requests.RequestException, Error, OSError):
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"等待{description}超时")
+
+def start_registry(role, port):
+    """启动一个空的registry:2容器，已存在时删除后重新创建（数据不保留）"""
+    name = container_name(role)
+    docker_cli('rm', '-f', '-v', name, check=False)
+    docker_cli('run', '-d', '--name', name, '-p', f"{port}:5000", REGISTRY_IMAGE)
+    wait_until(lambda: requests.get(f"http://localhost:{port}/v2/", timeout=5).status_code == 200,
+               f"仓库 localhost:{port} 启动")
+
+def start_mysql(port):
+    """启动MySQL容器并设置同步脚本使用的环境变量"""
+    name = container_name('mysql')
+    docker_cli('rm', '-f', '-v', name, check=False)
+    docker_cli('run', '-d', '--name', name, '-p', f"{port}:3306", '-e', f"MYSQL_ROOT_PASSWORD={MYSQL_PASSWORD}",
+               '-e', f"MYSQL_DATABASE={MYSQL_DB}", MYSQL_IMAGE)
+    os.environ.update({'MYSQL_HOST': '127.0.0.1', 'MYSQL_PORT': str(port), 'MYSQL_USER': 'root',
+                       'MYSQL_PASSWORD': MYSQL_PASSWORD, 'MYSQL_DB': MYSQL_DB})
+
+    def ready():
+        connection = mysql.connector.connect(host='127.0.0.1', port=port, user='root', password=MYSQL_PASSWORD,
+                                             database=MYSQL_DB)
+        connection.close()
+        return True
+    wait_until(ready, 'MySQL启动')
+
+def stop_containers():
+    for role in ('source', 'target', 'mysql'):
+        docker_cli('rm', '-f', '-v', container_name(role), check=False)
+
+def make_layer(seed, size):
+    """生成内容固定的gzip层，返回(压缩后的数据, 解压后的摘要)"""
+    data = random.Random(seed).randbytes(size)
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode='w', format=tarfile.USTAR_FORMAT) as tar:
+        info = tarfile.TarInfo(f"bench/{hashlib.sha256(seed.encode()).hexdigest()[:16]}.bin")
+        info.size = size
+        info.mtime = 0
+        tar.addfile(info, io.BytesIO(data))
+    raw = raw.getvalue()
+    # 随机数据无法压缩，使用最快的压缩级别；mtime固定使摘要可以重现
+    return gzip.compress(raw, compresslevel=1, mtime=0), 'sha256:' + hashlib.sha256(raw).hexdigest()
+
+def blob_digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+def push_blob(client, repository, data):
+    digest = blob_digest(data)
+    if not client.blob_exists(repository, digest):
+        client.upload_blob(repository, digest, data)
+    return {'mediaType': LAYER_MEDIA_TYPE, 'size': len(data), 'digest': digest}
+
+def generate_images(registry_url, args):
+    """在源仓库中生成合成镜像：每个镜像有shared_layers个共同的基础层和layers个自己的层
+
+    层内容由种子决定，相同参数每次生成的镜像摘要都相同。返回镜像引用列表和数据集描述
+    """
+    client = RegistryClient(registry_url)
+    base_layers = [make_layer(f"{args.seed}-base-{index}", int(args.base_layer_mb * MB))
+                   for index in range(args.shared_layers)]
+    images = []
+    total_bytes = 0
+    for index in range(args.images):
+        repository = f"{NAMESPACE}/app{index}"
+        layers = base_layers + [make_layer(f"{args.seed}-{index}-{layer}", int(args.layer_size_mb * MB))
+                                for layer in range(args.layers)]
+        descriptors = [push_blob(client, repository, data) for data, _ in layers]
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'created': '1970-01-01T00:00:00Z',
+            'config': {},
+            'rootfs': {'type': 'layers', 'diff_ids': [diff_id for _, diff_id in layers]},
+        }, sort_keys=True).encode()
+        config_descriptor = dict(push_blob(client, repository, config), mediaType=CONFIG_MEDIA_TYPE)
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_MEDIA_TYPE,
+            'config': config_descriptor,
+            'layers': descriptors,
+        }).encode()
+        client.put_manifest(repository, 'v1', manifest, MANIFEST_MEDIA_TYPE)
+        total_bytes += sum(descriptor['size'] for descriptor in descriptors)
+        images.append(f"{registry_url}/{repository}:v1")
+        log(f"已生成镜像 {images[-1]}（{len(descriptors)} 层）")
+    base_bytes = sum(len(data) for data, _ in base_layers)
+    return images, {
+        'images': args.images,
+        'shared_layers': args.shared_layers,
+        'base_layer_mb': args.base_layer_mb,
+        'layers': args.layers,
+        'layer_size_mb': args.layer_size_mb,
+        'seed': args.seed,
+        'total_bytes': total_bytes,
+        # 共同的基础层只需要传输一次
+        'unique_bytes': total_bytes - (args.images - 1) * base_bytes if args.images else 0,
+    }
+
+def remove_local_images(images, target_registry_url):
+    """删除本地的源镜像和目标镜像引用并清理悬空层，docker模式下模拟没有本地缓存"""
+    docker = DockerClient()
+    for image in images:
+        _, _, name = image.partition('/')
+        for reference in (image, f"{target_registry_url}/{name}"):
+            try:
+                docker.remove_image(reference)
+            except DockerError as e:
+                log(f"删除本地镜像 {reference} 失败: {e}")
+    docker.prune_images()
+
+def reset_queue(images, source_registry_url):
+    """清空合成镜像的推送记录并重新加入队列"""
+    with db_cursor(commit=True) as cursor:
+        cursor.execute("DELETE FROM images_for_push WHERE source_registry_url = %s", (source_registry_url,))
+        cursor.execute("DELETE FROM pushed_images WHERE source_registry_url = %s", (source_registry_url,))
+    if not enqueue_images(images):
+        raise RuntimeError('写入同步队列失败')
+
+def count_pushed(source_registry_url):
+    with db_cursor() as cursor:
+        cursor.execute("""
+        SELECT SUM(push_status = 1), COUNT(*) FROM images_for_push WHERE source_registry_url = %s
+        """, (source_registry_url,))
+        pushed, total = cursor.fetchone()
+        return int(pushed or 0), int(total or 0)
+
+def run_sync(mode, workers, args, cache_dir, name):
+    """运行一次sync_images.py，返回(耗时, 指标汇总)"""
+    metrics_path = os.path.join(args.work_dir, f"{name}.json")
+    command = [sys.executable, os.path.join(SCRIPTS_DIR, 'sync_images.py'), '--target', 'private',
+               '--mode', mode, '--workers', str(workers), '--schedule', 'fifo', '--retry-window', '0',
+               '--metrics-json', metrics_path]
+    if mode == 'registry':
+        command += ['--blob-cache', cache_dir]
+    env = dict(os.environ, MY_REGISTRY=f"localhost:{args.target_port}", MY_REGISTRY_USER='', MY_REGISTRY_PASSWORD='')
+    started = time.time()
+    with open(os.path.join(args.work_dir, f"{name}.log"), 'w') as output:
+        returncode = subprocess.call(command, env=env, stdout=output, stderr=subprocess.STDOUT)
+    elapsed = time.time() - started
+    if returncode != 0:
+        raise RuntimeError(f"sync_images.py 退出码 {returncode}，日志: {output.name}")
+    try:
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        metrics = {}
+    return elapsed, metrics
+
+def prepare_scenario(scenario, mode, images, args, cache_dir):
+    """按场景准备目标仓库、本地缓存和队列"""
+    if scenario in ('cold', 'warm'):
+        start_registry('target', args.target_port)
+    if scenario == 'cold':
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        if mode == 'docker':
+            remove_local_images(images, f"localhost:{args.target_port}")
+    reset_queue(images, f"localhost:{args.source_port}")
+
+def summarize(mode, workers, scenario, runs, dataset, pushed):
+    """汇总同一组合多次运行的结果，以中位数为准"""
+    seconds = [elapsed for elapsed, _ in runs]
+    median = statistics.median(seconds)
+    # 取耗时最接近中位数的一次运行的各阶段统计
+    _, metrics = min(runs, key=lambda run: abs(run[0] - median))
+    return {
+        'mode': mode,
+        'workers': workers,
+        'scenario': scenario,
+        'runs': [round(elapsed, 3) for elapsed in seconds],
+        'median_seconds': round(median, 3),
+        'min_seconds': round(min(seconds), 3),
+        'max_seconds': round(max(seconds), 3),
+        'mb_per_second': round(dataset['unique_bytes'] / MB / median, 2) if median else 0.0,
+        'images_per_minute': round(dataset['images'] * 60 / median, 2) if median else 0.0,
+        'pushed': pushed,
+        'phases': metrics.get('phases', []),
+    }
+
+def result_key(result):
+    return result['mode'], result['workers'], result['scenario']
+
+def compare_with_baseline(results, baseline_path):
+    """与之前的结果文件对比中位耗时，在结果中写入变化百分比"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {result_key(result): result for result in baseline.get('results', [])}
+    log(f"========== 与 {baseline_path}（{baseline.get('commit') or '未知提交'}）对比 ==========")
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old or not old['median_seconds']:
+            continue
+        change = (result['median_seconds'] - old['median_seconds']) * 100 / old['median_seconds']
+        result['baseline_median_seconds'] = old['median_seconds']
+        result['change_percent'] = round(change, 1)
+        log(f"{result['mode']:<9} workers={result['workers']:<3} {result['scenario']:<8} "
+            f"{old['median_seconds']:>8.2f}s -> {result['median_seconds']:>8.2f}s ({change:+.1f}%)")
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='同步性能基准测试：在本地仓库和MySQL上生成合成镜像，测量不同并发数和模式下的同步耗时')
+    parser.add_argument('--modes', type=parse_list, default=['registry', 'docker'],
+                        help='测试的同步方式，逗号分隔（默认 registry,docker）')
+    parser.add_argument('--workers', type=lambda value: parse_list(value, int), default=[1, 4],
+                        help='测试的并发数，逗号分隔（默认 1,4）')
+    parser.add_argument('--scenarios', type=parse_list, default=list(SCENARIOS),
+                        help=f"测试场景，逗号分隔（默认 {','.join(SCENARIOS)}）")
+    parser.add_argument('--repeat', type=int, default=3, help='每个组合运行的次数，结果取中位数（默认%(default)s）')
+    parser.add_argument('--images', type=int, default=8, help='合成镜像数量（默认%(default)s）')
+    parser.add_argument('--layers', type=int, default=3, help='每个镜像自己的层数（默认%(default)s）')
+    parser.add_argument('--layer-size-mb', type=float, default=16, help='每个镜像自己的层的大小（默认%(default)sMB）')
+    parser.add_argument('--shared-layers', type=int, default=2, help='所有镜像共同的基础层数（默认%(default)s）')
+    parser.add_argument('--base-layer-mb', type=float, default=32, help='基础层的大小（默认%(default)sMB）')
+    parser.add_argument('--seed', default='1', help='生成层内容的随机种子，相同种子生成的镜像完全相同')
+    parser.add_argument('--source-port', type=int, default=5101, help='源仓库端口（默认%(default)s）')
+    parser.add_argument('--target-port', type=int, default=5102, help='目标仓库端口（默认%(default)s）')
+    parser.add_argument('--mysql-port', type=int, default=3307, help='MySQL容器端口（默认%(default)s）')
+    parser.add_argument('--external-mysql', action='store_true',
+                        help='不启动MySQL容器，使用MYSQL_*环境变量指定的数据库（只会删除合成镜像的记录）')
+    parser.add_argument('--work-dir', help='保存每次运行的日志、指标和blob缓存的目录（默认临时目录）')
+    parser.add_argument('--output', default='benchmark-results.json', help='结果文件（默认%(default)s）')
+    parser.add_argument('--baseline', help='之前的结果文件，输出中位耗时的变化')
+    parser.add_argument('--keep-containers', action='store_true', help='结束后保留容器')
+    args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}（可选: {', '.join(SCENARIOS)}）")
+    unknown = [mode for mode in args.modes if mode not in ('docker', 'registry')]
+    if unknown:
+        parser.error(f"未知的同步方式: {', '.join(unknown)}")
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix='mydocker-bench-')
+    os.makedirs(args.work_dir, exist_ok=True)
+    # 场景按 cold、warm、present 的顺序运行
+    scenarios = [scenario for scenario in SCENARIOS if scenario in args.scenarios]
+    source_registry_url = f"localhost:{args.source_port}"
+
+    results = []
+    try:
+        start_registry('source', args.source_port)
+        start_registry('target', args.target_port)
+        if not args.external_mysql:
+            start_mysql(args.mysql_port)
+        from init_db import init_database
+        init_database()
+        images, dataset = generate_images(source_registry_url, args)
+        log(f"合成镜像 {len(images)} 个，共 {dataset['total_bytes'] / MB:.1f}MB，去重后 {dataset['unique_bytes'] / MB:.1f}MB，"
+            f"工作目录: {args.work_dir}")
+
+        for mode in args.modes:
+            for workers in args.workers:
+                cache_dir = os.path.join(args.work_dir, f"blob-cache-{mode}-{workers}")
+                primed = False
+                for scenario in scenarios:
+                    if scenario != 'cold' and not primed:
+                        # warm、present需要之前至少同步过一次
+                        prepare_scenario('cold', mode, images, args, cache_dir)
+                        run_sync(mode, workers, args, cache_dir, f"{mode}-w{workers}-prime")
+                    runs = []
+                    for attempt in range(args.repeat):
+                        prepare_scenario(scenario, mode, images, args, cache_dir)
+                        elapsed, metrics = run_sync(mode, workers, args, cache_dir,
+                                                    f"{mode}-w{workers}-{scenario}-{attempt + 1}")
+                        runs.append((elapsed, metrics))
+                        log(f"{mode} workers={workers} {scenario} 第 {attempt + 1} 次: {elapsed:.2f}秒")
+                    primed = True
+                    pushed, total = count_pushed(source_registry_url)
+                    if pushed != total:
+                        log(f"警告: {mode} workers={workers} {scenario} 只同步了 {pushed}/{total} 个镜像")
+                    results.append(summarize(mode, workers, scenario, runs, dataset, pushed))
+    finally:
+        if not args.keep_containers:
+            stop_containers()
+
+    log("========== 基准测试结果（中位数） ==========")
+    for result in results:
+        log(f"{result['mode']:<9} workers={result['workers']:<3} {result['scenario']:<8} "
+            f"{result['median_seconds']:>8.2f}s  {result['mb_per_second']:>8.2f}MB/s  "
+            f"{result['images_per_minute']:>7.2f} 镜像/分钟")
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'python': sys.version.split()[0],
+        'dataset': dataset,
+        'config': {'modes': args.modes, 'workers': args.workers, 'scenarios': scenarios, 'repeat': args.repeat},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    log(f"结果已写入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import threading
+
+from registry_client import STREAM_CHUNK_SIZE
+
+# 缓存目录默认大小上限（GB）
+DEFAULT_CACHE_SIZE_GB = 20
+
+# 超过该秒数没有写入的临时文件视为中断的运行留下的，其他共用缓存目录的进程正在写入的文件不会被删除
+STALE_INGEST_SECONDS = 3600
+
+_cache = None
+
+class CachedBlob:
+    """缓存中的blob文件，提供与BlobStream相同的len()/read()/迭代接口，用于上传"""
+
+    def __init__(self, path, size):
+        self._file = open(path, 'rb')
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = STREAM_CHUNK_SIZE
+        return self._file.read(size)
+
+    def close(self):
+        self._file.close()
+
+class CacheWriter:
+    """边下载边写入缓存的临时文件，下载完成且摘要校验通过后由BlobCache.commit放入缓存"""
+
+    def __init__(self, path, digest, size):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.failed = False
+        self._file = open(path, 'wb')
+
+    def write(self, chunk):
+        # 写缓存失败（如磁盘已满）不影响复制本身
+        if self.failed:
+            return
+        try:
+            self._file.write(chunk)
+        except OSError:
+            self.failed = True
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class BlobCache:
+    """内容寻址的本地blob缓存
+
+    目录采用OCI镜像布局（oci-layout、index.json、blobs/sha256/<摘要>），可以在多次运行之间保留；
+    总大小超过上限时按最近使用时间淘汰
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._blobs_dir = os.path.join(root, 'blobs', 'sha256')
+        self._ingest_dir = os.path.join(root, 'ingest')
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._ingest_dir, exist_ok=True)
+        # 上次运行中断时留下的临时文件
+        stale = time.time() - STALE_INGEST_SECONDS
+        for entry in os.scandir(self._ingest_dir):
+            try:
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        self._write_layout()
+        # 摘要 -> (字节数, 最近使用时间)
+        self._entries = {}
+        for entry in os.scandir(self._blobs_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                self._entries['sha256:' + entry.name] = (stat.st_size, stat.st_mtime)
+        self.total_bytes = sum(size for size, _ in self._entries.values())
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def _write_layout(self):
+        layout = os.path.join(self.root, 'oci-layout')
+        if not os.path.exists(layout):
+            with open(layout, 'w') as f:
+                json.dump({'imageLayoutVersion': '1.0.0'}, f)
+        index = os.path.join(self.root, 'index.json')
+        if not os.path.exists(index):
+            with open(index, 'w') as f:
+                json.dump({'schemaVersion': 2, 'manifests': []}, f)
+
+    def path(self, digest):
+        return os.path.join(self._blobs_dir, digest.split(':', 1)[1])
+
+    def open(self, digest, size):
+        """读取缓存的blob，未命中时返回None"""
+        path = self.path(digest)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] != size:
+                self.misses += 1
+                return None
+            try:
+                blob = CachedBlob(path, size)
+                # 以修改时间记录最近使用时间，下次运行时据此恢复淘汰顺序
+                os.utime(path)
+            except OSError:
+                self._entries.pop(digest, None)
+                self.misses += 1
+                return None
+            self._entries[digest] = (size, os.path.getmtime(path))
+            self.hits += 1
+            self.bytes_saved += size
+            return blob
+
+    def writer(self, digest, size):
+        """开始写入一个blob，过大（超过缓存上限）时返回None"""
+        if size > self.max_bytes:
+            return None
+        return CacheWriter(os.path.join(self._ingest_dir, uuid.uuid4().hex), digest, size)
+
+    def commit(self, writer):
+        """把已校验的临时文件放入缓存，并按需淘汰旧的blob"""
+        if writer.failed:
+            writer.discard()
+            return
+        writer.close()
+        path = self.path(writer.digest)
+        try:
+            os.replace(writer.path, path)
+        except OSError:
+            # 长时间没有写入的临时文件可能已被其他进程当作残留文件删除
+            return
+        with self._lock:
+            previous = self._entries.get(writer.digest)
+            if previous:
+                self.total_bytes -= previous[0]
+            self._entries[writer.digest] = (writer.size, os.path.getmtime(path))
+            self.total_bytes += writer.size
+            self._evict()
+
+    def _evict(self):
+        """删除最久未使用的blob，直到总大小不超过上限"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        for digest, (size, _) in sorted(self._entries.items(), key=lambda item: item[1][1]):
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass
+            del self._entries[digest]
+            self.total_bytes -= size
+            if self.total_bytes <= self.max_bytes:
+                return
+
+def configure_blob_cache(root, max_gb=DEFAULT_CACHE_SIZE_GB):
+    """启用blob缓存"""
+    global _cache
+    _cache = BlobCache(root, int(max_gb * 1024 * 1024 * 1024))
+    return _cache
+
+def get_blob_cache():
+    """返回已启用的blob缓存，未启用时返回None"""
+    return _cache
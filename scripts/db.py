@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from mysql.connector import Error, pooling
+
+# 连接池大小（mysql-connector 最多支持32个连接）
+DEFAULT_POOL_SIZE = 5
+MAX_POOL_SIZE = 32
+
+# 连接池耗尽时等待空闲连接的最长时间（秒）
+POOL_WAIT_TIMEOUT = 60
+
+# 批量写入：积累的语句数量达到该值或距上次提交超过该秒数时，在一个事务中提交
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_BATCH_INTERVAL = 10
+
+# 批量事务失败（如死锁）时整体重试的次数，之后逐条写入
+BATCH_RETRIES = 2
+# 单条语句在多次提交中都写入失败时放弃，避免错误语句永远留在队列中
+STATEMENT_MAX_FAILURES = 3
+
+_pool = None
+_pool_size = int(os.environ.get('MYSQL_POOL_SIZE', DEFAULT_POOL_SIZE))
+_pool_lock = threading.Lock()
+
+class DBTimings:
+    """线程安全的数据库耗时统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.seconds = {}
+
+    def add(self, key, seconds, count=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + count
+            self.seconds[key] = self.seconds.get(key, 0.0) + seconds
+
+    def get(self, key):
+        with self._lock:
+            return self.counts.get(key, 0), self.seconds.get(key, 0.0)
+
+DB_TIMINGS = DBTimings()
+
+def configure_pool(pool_size):
+    """设置连接池大小，需要在第一次获取连接之前调用"""
+    global _pool_size
+    with _pool_lock:
+        if _pool is None:
+            _pool_size = max(1, min(pool_size, MAX_POOL_SIZE))
+
+def get_pool():
+    """获取（或创建）进程内共享的连接池"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            started = time.time()
+            _pool = pooling.MySQLConnectionPool(
+                pool_name='mydocker',
+                pool_size=_pool_size,
+                pool_reset_session=True,
+                host=os.environ.get('MYSQL_HOST'),
+                port=os.environ.get('MYSQL_PORT'),
+                user=os.environ.get('MYSQL_USER'),
+                password=os.environ.get('MYSQL_PASSWORD'),
+                database=os.environ.get('MYSQL_DB')
+            )
+            # 创建连接池时会一次性建立全部连接
+            DB_TIMINGS.add('connect', time.time() - started, _pool_size)
+        return _pool
+
+def get_db_connection():
+    """从连接池获取数据库连接，close()时归还连接池"""
+    started = time.time()
+    try:
+        pool = get_pool()
+        while True:
+            try:
+                connection = pool.get_connection()
+                break
+            except pooling.PoolError:
+                # 所有连接都在使用中，等待其他线程归还
+                if time.time() - started > POOL_WAIT_TIMEOUT:
+                    raise
+                time.sleep(0.05)
+        DB_TIMINGS.add('checkout', time.time() - started)
+        return connection
+    except Error as e:
+        # 连接池也在工作线程和服务中使用，交给调用方处理，不能直接退出进程
+        print(f"数据库连接错误: {e}")
+        raise
+
+class TimedCursor:
+    """记录每次查询耗时的游标包装"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, operation, params=None):
+        started = time.time()
+        try:
+            return self._cursor.execute(operation, params)
+        finally:
+            DB_TIMINGS.add('query', time.time() - started)
+
+    def executemany(self, operation, seq_params):
+        started = time.time()
+        try:
+            return self._cursor.executemany(operation, seq_params)
+        finally:
+            DB_TIMINGS.add('query', time.time() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+@contextmanager
+def db_cursor(dictionary=False, commit=False):
+    """获取连接池中的连接和游标；commit为True时正常结束后提交，出错时回滚；结束后总是归还连接"""
+    connection = get_db_connection()
+    cursor = connection.cursor(dictionary=dictionary)
+    try:
+        yield TimedCursor(cursor)
+        if commit:
+            started = time.time()
+            connection.commit()
+            DB_TIMINGS.add('commit', time.time() - started)
+    except Exception:
+        if commit and connection.is_connected():
+            connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+class BatchWriter:
+    """批量写入器：积累写语句，在一个事务中批量提交，减少与远程数据库的往返"""
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_BATCH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.time()
+
+    def add(self, operation, params):
+        """加入一条写语句，达到批量大小或时间间隔时提交"""
+        with self._lock:
+            self._pending.append((operation, params, 0))
+            if len(self._pending) < self.batch_size and time.time() - self._last_flush < self.interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """在一个事务中提交所有积累的写语句；失败时重试，再逐条写入，未写入的语句放回队列"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.time()
+            if not pending:
+                return
+            started = time.time()
+            error = None
+            for attempt in range(BATCH_RETRIES):
+                try:
+                    self._write(pending)
+                    DB_TIMINGS.add('batch', time.time() - started)
+                    DB_TIMINGS.add('batch_statements', 0, len(pending))
+                    return
+                except Error as e:
+                    error = e
+                    if attempt + 1 < BATCH_RETRIES:
+                        time.sleep(attempt + 1)
+            print(f"批量写入数据库错误: {error}，逐条写入 {len(pending)} 条语句")
+            failed = []
+            for operation, params, failures in pending:
+                try:
+                    self._write([(operation, params, failures)])
+                except Error as e:
+                    print(f"写入数据库错误: {e}（{operation.split()[0]} 语句）")
+                    if failures + 1 < STATEMENT_MAX_FAILURES:
+                        failed.append((operation, params, failures + 1))
+                    else:
+                        print(f"语句连续 {STATEMENT_MAX_FAILURES} 次写入失败，已放弃: {operation.strip()} {params}")
+            DB_TIMINGS.add('batch', time.time() - started)
+            DB_TIMINGS.add('batch_statements', 0, len(pending) - len(failed))
+            if failed:
+                # 放回队列，下次提交时再写入，避免丢失状态更新
+                print(f"{len(failed)} 条语句写入失败，下次提交时重试")
+                self._pending = failed + self._pending
+
+    @staticmethod
+    def _write(statements):
+        with db_cursor(commit=True) as cursor:
+            for operation, params, _ in statements:
+                cursor.execute(operation, params)
+
+# 同步状态写入共用的批量写入器
+STATUS_WRITER = BatchWriter()
+
+def print_db_timings():
+    """输出本次运行的数据库连接和查询耗时"""
+    connect_count, connect_seconds = DB_TIMINGS.get('connect')
+    checkout_count, checkout_seconds = DB_TIMINGS.get('checkout')
+    query_count, query_seconds = DB_TIMINGS.get('query')
+    batch_count, batch_seconds = DB_TIMINGS.get('batch')
+    batch_statements, _ = DB_TIMINGS.get('batch_statements')
+    print("========== 数据库统计 ==========")
+    print(f"建立连接: {connect_count} 个，耗时 {connect_seconds:.2f}秒；从连接池获取连接: {checkout_count} 次，"
+          f"耗时 {checkout_seconds:.2f}秒")
+    if query_count:
+        print(f"查询: {query_count} 次，总耗时 {query_seconds:.2f}秒，平均 {query_seconds * 1000 / query_count:.1f}毫秒")
+    if batch_count:
+        print(f"批量写入: {batch_count} 个事务共 {batch_statements} 条语句，耗时 {batch_seconds:.2f}秒")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+GB = 1024 * 1024 * 1024
+
+# 清单中只有各层压缩后的大小，解压到本地后按该倍数估算
+UNCOMPRESSED_RATIO = 2.5
+
+# 空间不足时等待其他镜像同步完成的最长时间（秒）
+RESERVE_WAIT_TIMEOUT = 1800
+
+class DiskBudget:
+    """预测性磁盘预算
+
+    拉取前按预计大小预留空间，并始终保留headroom的余量。空间不足时按最近最少使用的顺序
+    删除本次运行中已推送的本地镜像；仍不足时等待其他正在同步的镜像完成后再拉取
+    """
+
+    def __init__(self, docker, path='/', headroom_gb=5):
+        self.docker = docker
+        self.path = path
+        self.headroom = int(headroom_gb * GB)
+        self._cond = threading.Condition()
+        # 已预留但尚未拉取完成的镜像: key -> 预计字节数
+        self._reserved = {}
+        # 已拉取、正在推送的镜像，不能删除
+        self._active = set()
+        # 已推送、可以删除的本地镜像: key -> (镜像引用列表, 字节数)，按最近使用排序
+        self._pushed = OrderedDict()
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+    def free_bytes(self):
+        return shutil.disk_usage(self.path).free
+
+    def _available(self):
+        """扣除已预留空间和余量后可用的字节数"""
+        return self.free_bytes() - sum(self._reserved.values()) - self.headroom
+
+    def reserve(self, key, size, log=print):
+        """为即将拉取的镜像预留size字节，返回预留后剩余的磁盘空间（字节）
+
+        空间不足时先删除已推送的镜像，然后清理悬空镜像，最后等待其他镜像完成；
+        没有其他镜像在同步时仍然返回，由拉取本身决定成败（预计大小可能偏大）
+        """
+        deadline = time.time() + RESERVE_WAIT_TIMEOUT
+        pruned = False
+        waiting = False
+        with self._cond:
+            while True:
+                available = self._available()
+                if available >= size:
+                    break
+                if self._evict_one(log):
+                    continue
+                if not pruned:
+                    pruned = True
+                    self._prune(log)
+                    continue
+                others = set(self._reserved) | self._active
+                others.discard(key)
+                if not others or time.time() > deadline:
+                    log(f"警告: 磁盘空间可能不足（预计需要 {size / GB:.2f}GB，"
+                        f"可用 {(available + self.headroom) / GB:.2f}GB），仍然尝试拉取")
+                    break
+                if not waiting:
+                    waiting = True
+                    log(f"磁盘空间不足（预计需要 {size / GB:.2f}GB），等待其他镜像同步完成后再拉取")
+                self._cond.wait(60)
+            self._reserved[key] = size
+            return self.free_bytes() - sum(self._reserved.values())
+
+    def commit(self, key):
+        """镜像拉取完成，实际占用已反映在磁盘可用空间中，取消预留；推送完成前不会被删除"""
+        with self._cond:
+            self._reserved.pop(key, None)
+            self._active.add(key)
+            self._cond.notify_all()
+
+    def track(self, key, refs, size):
+        """镜像推送结束，记为最近使用的可删除镜像"""
+        with self._cond:
+            self._active.discard(key)
+            self._pushed[key] = (list(refs), size)
+            self._pushed.move_to_end(key)
+            self._cond.notify_all()
+
+    def release(self, key):
+        """镜像没有留在本地（如拉取失败），取消预留"""
+        with self._cond:
+            self._reserved.pop(key, None)
+            self._active.discard(key)
+            self._cond.notify_all()
+
+    def _evict_one(self, log):
+        """删除最久未使用的已推送镜像，没有可删除的镜像时返回False"""
+        if not self._pushed:
+            return False
+        _, (refs, size) = self._pushed.popitem(last=False)
+        log(f"删除最久未使用的已推送镜像: {' '.join(refs)}（约 {size / GB:.2f}GB）")
+        for ref in refs:
+            try:
+                self.docker.remove_image(ref)
+            except Exception as e:
+                log(f"删除镜像 {ref} 失败: {e}")
+        self.evicted += 1
+        self.evicted_bytes += size
+        return True
+
+    def _prune(self, log):
+        """清理悬空镜像"""
+        log("清理悬空的Docker镜像...")
+        try:
+            self.docker.prune_images()
+        except Exception as e:
+            log(f"清理Docker镜像错误: {e}")
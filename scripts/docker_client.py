@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import base64
+import socket
+import threading
+import http.client
+from urllib.parse import urlencode, quote
+
+DEFAULT_DOCKER_SOCKET = '/var/run/docker.sock'
+
+# 与docker CLI一致，镜像名中的/和:直接放在URL路径中
+IMAGE_PATH_SAFE = '/:@'
+
+# 这些状态表示某一层已经处理完成，其余状态（Waiting、Downloading等）只用于统计进度
+LAYER_DONE_STATUSES = ('Pull complete', 'Already exists', 'Pushed', 'Layer already exists', 'Mounted from')
+# 其中实际传输了数据的状态
+TRANSFER_DONE_STATUSES = ('Pull complete', 'Pushed')
+
+class DockerError(Exception):
+    """Docker守护进程返回错误"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+def docker_socket_path():
+    """从DOCKER_HOST读取unix socket路径，未设置时使用默认路径"""
+    host = os.environ.get('DOCKER_HOST', '')
+    if host.startswith('unix://'):
+        return host[len('unix://'):]
+    return DEFAULT_DOCKER_SOCKET
+
+def split_image_reference(image):
+    """把镜像引用拆分为(名称, 标签或摘要)，如 localhost:5000/ns/app:1.0 -> (localhost:5000/ns/app, 1.0)"""
+    if '@' in image:
+        name, digest = image.split('@', 1)
+        return name, digest
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        return image, 'latest'
+    return name, tag
+
+def registry_auth_header(username, password, server):
+    """生成X-Registry-Auth头，凭据通过请求头传递，不会出现在命令行中"""
+    auth = {'username': username or '', 'password': password or '', 'serveraddress': server}
+    return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """通过unix socket连接的HTTP连接"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class LayerProgress:
+    """处理拉取/推送的JSON事件：记录各层进度，层完成时输出一行日志"""
+
+    def __init__(self, log=print):
+        self.log = log
+        self.layers = {}
+        self.aux = {}
+
+    def __call__(self, event):
+        if 'aux' in event:
+            # 推送结束时返回 {Tag, Digest, Size}
+            self.aux.update(event['aux'])
+            return
+        layer = event.get('id')
+        status = event.get('status', '')
+        if not layer:
+            if status.startswith(('Digest:', 'Status:')):
+                self.log(status)
+            return
+        detail = event.get('progressDetail') or {}
+        if detail.get('total'):
+            self.layers[layer] = (status, detail.get('current', 0), detail['total'])
+            return
+        if status.startswith(LAYER_DONE_STATUSES):
+            _, _, total = self.layers.get(layer, (None, 0, 0))
+            self.layers[layer] = (status, total, total)
+            size = f"（{total / (1024 * 1024):.2f}MB）" if total else ''
+            self.log(f"  {layer}: {status}{size}")
+
+    def summary(self):
+        """返回 {状态: 层数}"""
+        counts = {}
+        for status, _, _ in self.layers.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def transferred(self):
+        """实际下载或上传的字节数（已存在、已挂载的层不计入）"""
+        return sum(total for status, _, total in self.layers.values()
+                   if status.startswith(TRANSFER_DONE_STATUSES))
+
+class DockerClient:
+    """Docker Engine API 客户端，每个线程复用一个到 docker.sock 的keep-alive连接"""
+
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or docker_socket_path()
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = UnixHTTPConnection(self.socket_path)
+        return connection
+
+    def _request(self, method, path, params=None, headers=None):
+        if params:
+            path += '?' + urlencode({k: v for k, v in params.items() if v is not None})
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, headers=headers or {})
+                return connection.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                # 守护进程可能已关闭空闲连接，重新连接后再试一次
+                connection.close()
+                if attempt:
+                    raise DockerError(f"连接Docker守护进程失败: {e}")
+
+    @staticmethod
+    def _error_message(body, status):
+        try:
+            message = json.loads(body).get('message')
+        except ValueError:
+            message = None
+        return message or body.decode('utf-8', 'replace').strip() or f"HTTP {status}"
+
+    def _call(self, method, path, params=None, expected=(200,), headers=None):
+        response = self._request(method, path, params, headers)
+        body = response.read()
+        if response.status not in expected:
+            raise DockerError(self._error_message(body, response.status), response.status)
+        return json.loads(body) if body else None
+
+    def _stream(self, method, path, params=None, headers=None, on_event=None):
+        """发送请求并逐行处理返回的JSON事件，遇到错误事件时抛出DockerError"""
+        response = self._request(method, path, params, headers)
+        if response.status != 200:
+            raise DockerError(self._error_message(response.read(), response.status), response.status)
+        error = None
+        completed = False
+        try:
+            for line in response:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError as e:
+                    raise DockerError(f"无法解析Docker守护进程返回的事件: {e}")
+                if 'error' in event:
+                    # 继续读完响应，连接才能被复用
+                    error = error or event['error']
+                elif on_event:
+                    on_event(event)
+            completed = True
+        except (OSError, http.client.HTTPException) as e:
+            # 守护进程在传输过程中断开连接（包括IncompleteRead）
+            raise DockerError(f"读取Docker守护进程响应失败: {e}")
+        finally:
+            if not completed:
+                # 响应没有读完，连接不能再复用
+                self._connection().close()
+        if error:
+            raise DockerError(error)
+
+    def pull_image(self, image, platform=None, auth=None, on_event=None):
+        """拉取镜像"""
+        name, tag = split_image_reference(image)
+        headers = {'X-Registry-Auth': auth} if auth else None
+        self._stream('POST', '/images/create', {'fromImage': name, 'tag': tag, 'platform': platform},
+                     headers, on_event)
+
+    def tag_image(self, image, target):
+        """为镜像添加新的引用"""
+        repo, tag = split_image_reference(target)
+        self._call('POST', f"/images/{quote(image, safe=IMAGE_PATH_SAFE)}/tag", {'repo': repo, 'tag': tag},
+                   expected=(201,))
+
+    def push_image(self, image, auth, on_event=None):
+        """推送镜像"""
+        name, tag = split_image_reference(image)
+        self._stream('POST', f"/images/{quote(name, safe=IMAGE_PATH_SAFE)}/push", {'tag': tag},
+                     {'X-Registry-Auth': auth}, on_event)
+
+    def inspect_image(self, image):
+        """一次请求返回镜像的大小、RepoDigests等信息"""
+        return self._call('GET', f"/images/{quote(image, safe=IMAGE_PATH_SAFE)}/json")
+
+    def remove_image(self, image):
+        """删除镜像引用，镜像不存在时忽略"""
+        self._call('DELETE', f"/images/{quote(image, safe=IMAGE_PATH_SAFE)}", expected=(200, 404))
+
+    def prune_images(self):
+        """清理悬空镜像，返回释放的字节数"""
+        result = self._call('POST', '/images/prune', {'filters': json.dumps({'dangling': ['true']})})
+        return (result or {}).get('SpaceReclaimed', 0)
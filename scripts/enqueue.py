@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+
+from mysql.connector import Error
+
+from db import db_cursor
+
+# 每条多行INSERT最多写入的镜像数，避免语句超过max_allowed_packet
+ENQUEUE_CHUNK_SIZE = 1000
+
+def parse_image_info(image):
+    """解析镜像信息，返回(registry_url, namespace, name:tag)"""
+    # 默认registry为docker.io
+    registry_url = "docker.io"
+    
+    # 检查是否包含自定义registry
+    if '/' in image:
+        parts = image.split('/')
+        # 如果第一部分包含点或冒号，则认为是自定义registry
+        if '.' in parts[0] or ':' in parts[0]:
+            registry_url = parts[0]
+            image = '/'.join(parts[1:])
+    
+    # 解析namespace和name:tag
+    if '/' in image:
+        namespace, name_tag = image.split('/', 1)
+    else:
+        # 对于没有命名空间的镜像，如果是docker.io，则默认命名空间为library
+        namespace = "library" if registry_url == "docker.io" else ""
+        name_tag = image
+    
+    return registry_url, namespace, name_tag
+
+def get_known_digests(registry_url, namespace, repository):
+    """返回队列中某个镜像仓库已有的标签 {name:tag: 已知的源清单摘要}
+
+    摘要优先取入队时记录的值，没有时取同步时记录在pushed_images中的值，都没有时为None
+    """
+    pattern = repository.replace('_', '\\_').replace('%', '\\%') + ':%'
+    try:
+        with db_cursor() as cursor:
+            cursor.execute("""
+            SELECT q.orig_image_name, COALESCE(q.source_digest, MAX(p.source_digest))
+            FROM images_for_push q
+            LEFT JOIN pushed_images p ON p.source_registry_url = q.source_registry_url
+                AND p.orig_name_space = q.orig_name_space AND p.orig_image_name = q.orig_image_name
+                AND p.push_status = 1
+            WHERE q.source_registry_url = %s AND q.orig_name_space = %s AND q.orig_image_name LIKE %s
+            GROUP BY q.id, q.orig_image_name, q.source_digest
+            """, (registry_url, namespace, pattern))
+            return {name: digest for name, digest in cursor.fetchall()}
+    except Error as e:
+        print(f"查询队列错误: {e}")
+        return None
+
+def record_source_digests(registry_url, namespace, digests):
+    """为还没有记录源清单摘要的队列行写入摘要，不改变推送状态；digests为 {name:tag: 摘要}，返回是否成功"""
+    if not digests:
+        return True
+    try:
+        with db_cursor(commit=True) as cursor:
+            cursor.executemany("""
+            UPDATE images_for_push SET source_digest = %s
+            WHERE image_key = %s AND source_digest IS NULL
+            """, [(digest, image_key(registry_url, namespace, name)) for name, digest in digests.items()])
+        return True
+    except Error as e:
+        print(f"记录源清单摘要错误: {e}")
+        return False
+
+def image_key(registry_url, namespace, image_name):
+    """与images_for_push.image_key列相同的镜像引用摘要"""
+    return hashlib.sha256('|'.join((registry_url, namespace, image_name)).encode('utf-8')).hexdigest()
+
+def enqueue_images(images, platform="linux/amd64", priority=None):
+    """在一个事务中把镜像批量加入同步队列
+    
+    images为镜像引用字符串、(镜像引用, 平台)或(镜像引用, 平台, 源清单摘要)列表，重复的镜像只保留一个。
+    依靠image_key唯一索引用多行 INSERT ... ON DUPLICATE KEY UPDATE 写入：不存在时插入，
+    已推送或已放弃重试时重置为待推送，待推送的保持不变，并发调用也不会产生重复行；返回是否成功。
+    priority不为None时设置优先级（越大越先同步），已在队列中的镜像只会提高优先级
+    """
+    rows = {}
+    for image in images:
+        if isinstance(image, str):
+            image = (image, platform)
+        image, image_platform, source_digest = tuple(image) + (None,) * (3 - len(image))
+        registry_url, namespace, image_name = parse_image_info(image.strip())
+        rows[image_key(registry_url, namespace, image_name)] = (
+            registry_url, namespace, image_name, image_platform, source_digest)
+    if not rows:
+        return True
+    
+    keys = list(rows)
+    counts = {'inserted': 0, 'reset': 0, 'pending': 0}
+    try:
+        with db_cursor(commit=True) as cursor:
+            for start in range(0, len(keys), ENQUEUE_CHUNK_SIZE):
+                chunk = keys[start:start + ENQUEUE_CHUNK_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                # 只用于输出每个镜像的处理结果
+                cursor.execute(f"SELECT image_key, push_status FROM images_for_push WHERE image_key IN ({placeholders})",
+                               chunk)
+                existing = dict(cursor.fetchall())
+                
+                # push_status必须最后赋值，前面的表达式引用的是更新前的状态
+                cursor.execute(f"""
+                INSERT INTO images_for_push
+                (source_registry_url, orig_name_space, orig_image_name, platform, push_status, source_digest,
+                 priority, enqueued_at)
+                VALUES {', '.join(['(%s, %s, %s, %s, 0, %s, %s, NOW())'] * len(chunk))}
+                ON DUPLICATE KEY UPDATE
+                    {'priority = GREATEST(priority, VALUES(priority)),' if priority is not None else ''}
+                    enqueued_at = IF(push_status IN (1, 2), NOW(), enqueued_at),
+                    attempt_count = IF(push_status IN (1, 2), 0, attempt_count),
+                    last_error = IF(push_status IN (1, 2), NULL, last_error),
+                    next_attempt_at = IF(push_status IN (1, 2), NULL, next_attempt_at),
+                    source_digest = COALESCE(VALUES(source_digest), source_digest),
+                    push_status = 0
+                """, [value for key in chunk for value in rows[key] + (priority or 0,)])
+                
+                for key in chunk:
+                    registry_url, namespace, image_name = rows[key][:3]
+                    if key not in existing:
+                        counts['inserted'] += 1
+                        print(f"已添加新镜像: {registry_url}/{namespace}/{image_name}")
+                    elif existing[key] in (1, 2):
+                        counts['reset'] += 1
+                        print(f"已重置镜像状态: {registry_url}/{namespace}/{image_name}")
+                    else:
+                        counts['pending'] += 1
+                        print(f"镜像已存在且未推送: {registry_url}/{namespace}/{image_name}")
+        print(f"写入同步队列: 新增 {counts['inserted']} 个，重置 {counts['reset']} 个，已在队列中 {counts['pending']} 个")
+        return True
+    except Error as e:
+        print(f"数据库操作错误: {e}")
+        return False
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlencode
+
+import requests
+
+GITHUB_API_URL = "https://api.github.com"
+
+# ETag和响应缓存目录，在GitHub Actions中可通过actions/cache在多次运行之间保留
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mydocker-github')
+
+# 触发限流时最多重试的次数，以及没有Retry-After头时的初始等待时间（秒）
+MAX_RETRIES = 4
+SECONDARY_LIMIT_WAIT = 60
+# 主限流需要等待超过该秒数时不再等待，直接报错
+MAX_RATE_LIMIT_WAIT = 900
+
+class GitHubClient:
+    """GitHub REST API 客户端
+
+    使用一个带连接池的会话；GET响应按URL连同ETag缓存到磁盘，再次请求时带上If-None-Match，
+    返回304（不计入限流额度）时直接使用缓存内容；自动跟随Link分页，触发限流时退避重试
+    """
+
+    def __init__(self, token=None, cache_dir=None):
+        self.token = token if token is not None else os.environ.get("GITHUB_TOKEN")
+        self.cache_dir = cache_dir or os.environ.get('GITHUB_CACHE_DIR') or DEFAULT_CACHE_DIR
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/vnd.github.v3+json"})
+        if self.token:
+            self.session.headers["Authorization"] = f"token {self.token}"
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'not_modified': 0, 'retries': 0}
+        self.rate_limit_remaining = None
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def _load_cache(self, url):
+        try:
+            with open(self._cache_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_cache(self, url, response):
+        entry = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'next': response.links.get('next', {}).get('url'),
+            'data': response.json(),
+        }
+        if not entry['etag'] and not entry['last_modified']:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._cache_path(url), 'w') as f:
+                json.dump(entry, f)
+        except OSError as e:
+            print(f"写入GitHub API缓存失败: {e}")
+
+    def _rate_limit_wait(self, response, attempt):
+        """返回触发限流时需要等待的秒数，不是限流错误时返回None"""
+        if response.status_code not in (403, 429):
+            return None
+        if response.headers.get('Retry-After'):
+            return int(response.headers['Retry-After'])
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            # 主限流：等到额度重置
+            return max(0, int(response.headers.get('X-RateLimit-Reset', time.time())) - int(time.time())) + 1
+        if 'secondary rate limit' in response.text.lower():
+            # 次级限流没有给出等待时间时，至少等待一分钟并指数增加
+            return SECONDARY_LIMIT_WAIT * 2 ** attempt
+        return None
+
+    def _request(self, url):
+        """发送条件GET请求，返回(数据, 下一页URL)"""
+        cached = self._load_cache(url)
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            elif cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        for attempt in range(MAX_RETRIES + 1):
+            response = self.session.get(url, headers=headers, timeout=60)
+            self._count('requests')
+            if 'X-RateLimit-Remaining' in response.headers:
+                self.rate_limit_remaining = int(response.headers['X-RateLimit-Remaining'])
+            wait = self._rate_limit_wait(response, attempt)
+            if wait is None or attempt == MAX_RETRIES or wait > MAX_RATE_LIMIT_WAIT:
+                break
+            print(f"GitHub API限流，{wait}秒后重试: {url}")
+            self._count('retries')
+            time.sleep(wait)
+
+        if response.status_code == 304 and cached:
+            self._count('not_modified')
+            return cached['data'], cached.get('next')
+        response.raise_for_status()
+        self._save_cache(url, response)
+        return response.json(), response.links.get('next', {}).get('url')
+
+    def url(self, path, params=None):
+        url = path if path.startswith('http') else f"{GITHUB_API_URL}{path}"
+        if params:
+            url += '?' + urlencode(params)
+        return url
+
+    def get(self, path, params=None):
+        """GET一个API路径，返回JSON数据"""
+        data, _ = self._request(self.url(path, params))
+        return data
+
+    def paginate(self, path, params=None):
+        """逐条返回分页列表中的元素，调用方提前结束迭代时不会再请求后续页面"""
+        url = self.url(path, params)
+        while url:
+            data, url = self._request(url)
+            for item in data:
+                yield item
+
+    def print_stats(self):
+        """输出本次运行的GitHub API请求统计"""
+        requests_count = self.stats['requests']
+        not_modified = self.stats['not_modified']
+        print("========== GitHub API统计 ==========")
+        print(f"请求: {requests_count} 次，其中304未修改（不计入限流额度）: {not_modified} 次，"
+              f"计入额度: {requests_count - not_modified} 次，限流重试: {self.stats['retries']} 次")
+        if self.rate_limit_remaining is not None:
+            print(f"剩余额度: {self.rate_limit_remaining}")
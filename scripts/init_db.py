@@ -5,6 +5,56 @@ import os
 import mysql.connector
 from mysql.connector import Error
 
+def ensure_column(cursor, db_name, table, column, definition):
+    """为已存在的表补充新版本增加的列"""
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (db_name, table, column))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        print(f"表 {table} 已添加列 {column}")
+
+def ensure_index(cursor, db_name, table, index, definition):
+    """为已存在的表补充新版本增加的索引"""
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (db_name, table, index))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+        print(f"表 {table} 已添加索引 {index}")
+
+# 镜像引用（仓库地址|命名空间|名称:标签）的SHA-256，三个VARCHAR(255)列直接建唯一索引会超过索引长度限制
+IMAGE_KEY_DEFINITION = ("CHAR(64) AS (SHA2(CONCAT_WS('|', source_registry_url, orig_name_space, orig_image_name), 256)) "
+                        "STORED")
+
+def ensure_unique_image_key(cursor, db_name):
+    """为images_for_push添加镜像引用的唯一索引，添加前合并旧版本中重复入队的镜像"""
+    ensure_column(cursor, db_name, 'images_for_push', 'image_key', IMAGE_KEY_DEFINITION)
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'images_for_push' AND INDEX_NAME = 'idx_image_key'
+    """, (db_name,))
+    if cursor.fetchone()[0]:
+        return
+    # 保留id最小的一行，只要有一行待推送就保持待推送
+    cursor.execute("""
+    UPDATE images_for_push q
+    JOIN (
+        SELECT image_key, MIN(id) AS keep_id, MIN(push_status) AS push_status
+        FROM images_for_push GROUP BY image_key HAVING COUNT(*) > 1
+    ) d ON q.id = d.keep_id
+    SET q.push_status = d.push_status
+    """)
+    cursor.execute("""
+    DELETE q FROM images_for_push q
+    JOIN images_for_push k ON q.image_key = k.image_key AND q.id > k.id
+    """)
+    if cursor.rowcount:
+        print(f"表 images_for_push 已合并 {cursor.rowcount} 行重复的镜像")
+    ensure_index(cursor, db_name, 'images_for_push', 'idx_image_key', 'UNIQUE INDEX idx_image_key (image_key)')
+
 def init_database():
     """初始化数据库和表"""
     try:
@@ -42,9 +92,23 @@ def init_database():
                 orig_image_name VARCHAR(255),
                 add_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 platform VARCHAR(50) DEFAULT 'linux/amd64',
-                push_status TINYINT DEFAULT 0,
+                push_status TINYINT DEFAULT 0,  -- 0: 待推送, 1: 已推送, 2: 多次重试失败或永久性错误
+                lease_owner VARCHAR(128),
+                lease_expires_at DATETIME,
+                attempt_count INT DEFAULT 0,
+                last_error VARCHAR(1024),
+                next_attempt_at DATETIME,
+                source_digest VARCHAR(255),  -- 监控入队时源清单的摘要，用于发现同一标签被重新推送
+                priority INT NOT NULL DEFAULT 0,  -- 越大越先同步
+                estimated_size BIGINT,  -- 预计解压后的大小（字节），用于按大小调度
+                enqueued_at DATETIME,  -- 入队或重置为待推送的时间
+                queue_wait_seconds INT,  -- 最近一次被领取前的排队等待时间
+                image_key CHAR(64) AS (SHA2(CONCAT_WS('|', source_registry_url, orig_name_space, orig_image_name), 256)) STORED,
+                UNIQUE INDEX idx_image_key (image_key),
                 INDEX idx_push_status (push_status),
-                INDEX idx_orig_image_name (orig_image_name)
+                INDEX idx_orig_image_name (orig_image_name),
+                INDEX idx_push_lease (push_status, lease_expires_at),
+                INDEX idx_push_schedule (push_status, priority)
             )
             """)
             print("表 images_for_push 已创建或已存在")
@@ -64,6 +128,7 @@ def init_database():
                 image_size DECIMAL(10,2),
                 image_size_unit VARCHAR(10) DEFAULT 'MB',
                 digest VARCHAR(255),
+                source_digest VARCHAR(255),
                 platform VARCHAR(50) DEFAULT 'linux/amd64',
                 UNIQUE INDEX idx_registry_target_image (target_registry_url, registry_image_name),
                 INDEX idx_orig_image_name (orig_image_name)
@@ -71,6 +136,76 @@ def init_database():
             """)
             print("表 pushed_images 已创建或已存在")
             
+            # 创建 watcher_state 表，记录各获取脚本上次处理到的位置
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS watcher_state (
+                name VARCHAR(64) PRIMARY KEY,
+                last_value VARCHAR(255),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+            )
+            """)
+            print("表 watcher_state 已创建或已存在")
+            
+            # 创建 sync_runs 和 sync_events 表，记录每次运行和每个同步阶段的耗时与传输量
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_runs (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                run_id VARCHAR(64) NOT NULL,
+                worker_id VARCHAR(128),
+                mode VARCHAR(16),
+                targets VARCHAR(255),
+                started_at DATETIME,
+                finished_at DATETIME,
+                images INT,
+                pushed INT,
+                skipped INT,
+                failed INT,
+                bytes BIGINT,
+                summary JSON,
+                UNIQUE INDEX idx_run_id (run_id),
+                INDEX idx_started_at (started_at)
+            )
+            """)
+            print("表 sync_runs 已创建或已存在")
+            
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_events (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                run_id VARCHAR(64),
+                image_id INT,
+                image VARCHAR(512),
+                target VARCHAR(32),
+                phase VARCHAR(32),  -- claim, preflight, disk_reserve, pull, tag, push, inspect, copy, layer, total
+                started_at DATETIME(3),
+                seconds DOUBLE,
+                bytes BIGINT DEFAULT 0,
+                mbps DOUBLE,
+                attempt INT,  -- 第几次尝试同步该镜像
+                status VARCHAR(16),  -- ok, skipped, error, deferred
+                INDEX idx_run_id (run_id),
+                INDEX idx_phase_target_time (phase, target, started_at)
+            )
+            """)
+            print("表 sync_events 已创建或已存在")
+
+            # 升级旧版本创建的表
+            ensure_column(cursor, db_name, 'images_for_push', 'lease_owner', 'VARCHAR(128)')
+            ensure_column(cursor, db_name, 'images_for_push', 'lease_expires_at', 'DATETIME')
+            ensure_index(cursor, db_name, 'images_for_push', 'idx_push_lease',
+                         'INDEX idx_push_lease (push_status, lease_expires_at)')
+            ensure_column(cursor, db_name, 'images_for_push', 'attempt_count', 'INT DEFAULT 0')
+            ensure_column(cursor, db_name, 'images_for_push', 'last_error', 'VARCHAR(1024)')
+            ensure_column(cursor, db_name, 'images_for_push', 'next_attempt_at', 'DATETIME')
+            ensure_column(cursor, db_name, 'images_for_push', 'source_digest', 'VARCHAR(255)')
+            ensure_unique_image_key(cursor, db_name)
+            ensure_column(cursor, db_name, 'images_for_push', 'priority', 'INT NOT NULL DEFAULT 0')
+            ensure_column(cursor, db_name, 'images_for_push', 'estimated_size', 'BIGINT')
+            ensure_column(cursor, db_name, 'images_for_push', 'enqueued_at', 'DATETIME')
+            ensure_column(cursor, db_name, 'images_for_push', 'queue_wait_seconds', 'INT')
+            ensure_index(cursor, db_name, 'images_for_push', 'idx_push_schedule',
+                         'INDEX idx_push_schedule (push_status, priority)')
+            ensure_column(cursor, db_name, 'pushed_images', 'source_digest', 'VARCHAR(255) AFTER digest')
+            
     except Error as e:
         print(f"数据库连接或初始化错误: {e}")
     finally:
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from mysql.connector import Error
+
+from db import db_cursor, BatchWriter
+
+# 每个阶段保留最近多少次耗时用于计算分位数（常驻服务中不会无限增长）
+MAX_SAMPLES = 1000
+# JSON汇总中保留最近多少个镜像的明细
+MAX_IMAGES = 1000
+
+QUANTILES = (0.5, 0.95)
+
+# 互不重叠的传输阶段，sync_runs.bytes只按这些阶段累加（layer事件是copy的明细，计入会重复）
+TRANSFER_PHASES = ('pull', 'push', 'copy')
+
+# 指标名前缀
+PREFIX = 'mydocker_sync'
+
+def quantile(values, q):
+    """按最近排名法计算分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+def image_reference(image):
+    if image is None:
+        return None
+    return f"{image['source_registry_url']}/{image['orig_name_space']}/{image['orig_image_name']}"
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_atomic(path, content):
+    """先写临时文件再改名，textfile采集器不会读到写了一半的文件"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+class SyncMetrics:
+    """同步各阶段的耗时和传输量
+
+    每个阶段记录一条事件（镜像、目标、阶段、耗时、字节数、MB/s、第几次尝试、结果），批量写入sync_events表，
+    运行信息写入sync_runs表；并可以导出Prometheus textfile和JSON汇总
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writer = BatchWriter()
+        self.run_id = None
+        self.run = {}
+        # (阶段, 目标) -> {count, seconds, bytes, errors, samples}
+        self.phases = {}
+        # 镜像id -> 该镜像的事件列表，按完成顺序保留最近的MAX_IMAGES个
+        self.images = {}
+        self.image_status = {}
+        self.textfile = None
+        self.json_path = None
+
+    def configure(self, textfile=None, json_path=None):
+        """设置导出的Prometheus textfile和JSON汇总文件路径"""
+        self.textfile = textfile
+        self.json_path = json_path
+
+    def start_run(self, worker_id, mode, targets):
+        """开始一次运行，在sync_runs表中插入一行"""
+        self.run_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{socket.gethostname()}-{os.getpid()}"[:64]
+        self.run = {
+            'run_id': self.run_id,
+            'worker_id': worker_id,
+            'mode': mode,
+            'targets': ','.join(targets),
+            'started_at': time.time(),
+        }
+        try:
+            with db_cursor(commit=True) as cursor:
+                cursor.execute("""
+                INSERT INTO sync_runs (run_id, worker_id, mode, targets, started_at)
+                VALUES (%s, %s, %s, %s, NOW())
+                """, (self.run_id, worker_id, mode, self.run['targets']))
+        except Error as e:
+            print(f"记录运行信息错误: {e}")
+
+    def record(self, image, phase, seconds, target=None, transferred=0, status='ok'):
+        """记录一个阶段的耗时和传输字节数"""
+        # 开始时间在记录时确定，事件可能在批量写入器中等待一段时间才写入数据库
+        started_at = datetime.fromtimestamp(time.time() - seconds)
+        mbps = transferred / (1024 * 1024) / seconds if transferred and seconds > 0 else 0.0
+        attempt = (image.get('attempt_count') or 0) + 1 if image else None
+        event = {
+            'image_id': image['id'] if image else None,
+            'image': image_reference(image),
+            'target': target,
+            'phase': phase,
+            'seconds': round(seconds, 3),
+            'bytes': int(transferred),
+            'mbps': round(mbps, 2),
+            'attempt': attempt,
+            'status': status,
+        }
+        with self._lock:
+            stats = self.phases.setdefault((phase, target or ''), {
+                'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0, 'samples': deque(maxlen=MAX_SAMPLES)})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += int(transferred)
+            stats['errors'] += status != 'ok'
+            stats['samples'].append(seconds)
+            if image:
+                self.images.setdefault(image['id'], []).append(event)
+                while len(self.images) > MAX_IMAGES:
+                    self.images.pop(next(iter(self.images)))
+        if self.run_id:
+            self.writer.add("""
+            INSERT INTO sync_events
+            (run_id, image_id, image, target, phase, started_at, seconds, bytes, mbps, attempt, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (self.run_id, event['image_id'], event['image'], target, phase, started_at,
+                  seconds, event['bytes'], mbps, attempt, status))
+        return event
+
+    @contextmanager
+    def phase(self, image, phase, target=None):
+        """计时一个阶段；可以在with块中设置 event['bytes'] 和 event['status']，抛出异常时记为error"""
+        event = {'bytes': 0, 'status': 'ok'}
+        started = time.time()
+        try:
+            yield event
+        except Exception:
+            event['status'] = 'error'
+            raise
+        finally:
+            self.record(image, phase, time.time() - started, target, event['bytes'], event['status'])
+
+    def count_image(self, status):
+        """记录镜像的最终结果: ok、skipped、error、deferred"""
+        with self._lock:
+            self.image_status[status] = self.image_status.get(status, 0) + 1
+
+    def phase_summary(self):
+        """各阶段的统计，包括p50/p95耗时和平均速度"""
+        with self._lock:
+            items = [(key, dict(stats, samples=list(stats['samples']))) for key, stats in self.phases.items()]
+        summary = []
+        for (phase, target), stats in sorted(items):
+            summary.append({
+                'phase': phase,
+                'target': target or None,
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'seconds': round(stats['seconds'], 3),
+                'bytes': stats['bytes'],
+                'p50_seconds': round(quantile(stats['samples'], 0.5), 3),
+                'p95_seconds': round(quantile(stats['samples'], 0.95), 3),
+                'mbps': round(stats['bytes'] / (1024 * 1024) / stats['seconds'], 2)
+                        if stats['bytes'] and stats['seconds'] > 0 else 0.0,
+            })
+        return summary
+
+    def prometheus(self):
+        """生成Prometheus文本格式的指标"""
+        lines = [
+            f"# HELP {PREFIX}_phase_seconds 同步各阶段的耗时（秒）",
+            f"# TYPE {PREFIX}_phase_seconds summary",
+        ]
+        phases = self.phase_summary()
+        for stats in phases:
+            labels = f'phase="{escape_label(stats["phase"])}",target="{escape_label(stats["target"] or "")}"'
+            with self._lock:
+                samples = list(self.phases[(stats['phase'], stats['target'] or '')]['samples'])
+            for q in QUANTILES:
+                lines.append(f'{PREFIX}_phase_seconds{{{labels},quantile="{q}"}} {quantile(samples, q):.3f}')
+            lines.append(f"{PREFIX}_phase_seconds_sum{{{labels}}} {stats['seconds']:.3f}")
+            lines.append(f"{PREFIX}_phase_seconds_count{{{labels}}} {stats['count']}")
+        for name, key, help_text in (('phase_bytes_total', 'bytes', '同步各阶段传输的字节数'),
+                                     ('phase_errors_total', 'errors', '同步各阶段失败的次数')):
+            lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            for stats in phases:
+                labels = f'phase="{escape_label(stats["phase"])}",target="{escape_label(stats["target"] or "")}"'
+                lines.append(f"{PREFIX}_{name}{{{labels}}} {stats[key]}")
+        lines.append(f"# HELP {PREFIX}_images_total 按结果统计的同步镜像数")
+        lines.append(f"# TYPE {PREFIX}_images_total counter")
+        with self._lock:
+            image_status = dict(self.image_status)
+        for status, count in sorted(image_status.items()):
+            lines.append(f'{PREFIX}_images_total{{status="{escape_label(status)}"}} {count}')
+        lines.append(f"# HELP {PREFIX}_run_start_time_seconds 本次运行的开始时间")
+        lines.append(f"# TYPE {PREFIX}_run_start_time_seconds gauge")
+        lines.append(f"{PREFIX}_run_start_time_seconds {self.run.get('started_at', 0):.0f}")
+        lines.append(f"# HELP {PREFIX}_last_update_time_seconds 指标最近一次更新的时间")
+        lines.append(f"# TYPE {PREFIX}_last_update_time_seconds gauge")
+        lines.append(f"{PREFIX}_last_update_time_seconds {time.time():.0f}")
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """写入node_exporter textfile采集器读取的 .prom 文件"""
+        try:
+            write_atomic(path, self.prometheus())
+        except OSError as e:
+            print(f"写入Prometheus指标文件失败: {e}")
+
+    def summary(self, counters=None):
+        """本次运行的JSON汇总"""
+        with self._lock:
+            images = [{'image_id': image_id, 'events': events} for image_id, events in self.images.items()]
+            image_status = dict(self.image_status)
+        return dict(self.run, updated_at=time.time(), elapsed_seconds=round(time.time() - self.run.get('started_at', time.time()), 3),
+                    images=image_status, counters=counters or {}, phases=self.phase_summary(), image_events=images)
+
+    def write_json(self, path, counters=None):
+        try:
+            write_atomic(path, json.dumps(self.summary(counters), ensure_ascii=False, indent=2, default=str))
+        except OSError as e:
+            print(f"写入JSON汇总失败: {e}")
+
+    def export(self, counters=None):
+        """写入已配置的指标文件"""
+        if self.textfile:
+            self.write_textfile(self.textfile)
+        if self.json_path:
+            self.write_json(self.json_path, counters)
+
+    def finish_run(self, counters=None):
+        """写入剩余的事件和指标文件，并更新sync_runs中的结果"""
+        self.writer.flush()
+        self.export(counters)
+        if not self.run_id:
+            return
+        counters = counters or {}
+        phases = self.phase_summary()
+        with self._lock:
+            images = sum(self.image_status.values())
+        try:
+            with db_cursor(commit=True) as cursor:
+                cursor.execute("""
+                UPDATE sync_runs
+                SET finished_at = NOW(), images = %s, pushed = %s, skipped = %s, failed = %s, bytes = %s, summary = %s
+                WHERE run_id = %s
+                """, (images, counters.get('pushed', 0), counters.get('skipped', 0), counters.get('failed', 0),
+                      sum(stats['bytes'] for stats in phases if stats['phase'] in TRANSFER_PHASES),
+                      json.dumps({'phases': phases, 'counters': counters}, default=str), self.run_id))
+        except Error as e:
+            print(f"记录运行结果错误: {e}")
+
+# 同步过程共用的指标记录器
+METRICS = SyncMetrics()
@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+# 拉取清单时接受的媒体类型
+INDEX_MEDIA_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+)
+IMAGE_MEDIA_TYPES = (
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+)
+MANIFEST_ACCEPT = ', '.join(INDEX_MEDIA_TYPES + IMAGE_MEDIA_TYPES)
+
+# 流式传输blob时每次读取的字节数
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# 分块上传时单个分块失败后查询进度并重试的次数，以及重试间隔的基数（秒）
+CHUNK_RETRIES = 5
+CHUNK_RETRY_BASE_SECONDS = 2
+
+# Docker Hub 的实际API地址
+DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+DOCKER_HUB_ALIASES = ('docker.io', 'index.docker.io', DOCKER_HUB_REGISTRY)
+
+# Docker Hub 提供的用于查询拉取额度的镜像，HEAD请求不消耗额度
+DOCKER_HUB_RATE_LIMIT_REPOSITORY = 'ratelimitpreview/test'
+
+class RegistryError(Exception):
+    """仓库API返回错误"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class PermanentRegistryError(RegistryError):
+    """重试也不会成功的错误（清单中没有所需平台、不支持的清单类型等）"""
+
+def is_insecure_registry(registry_url):
+    """判断仓库是否通过HTTP访问（本地仓库或SYNC_INSECURE_REGISTRIES中列出的仓库）"""
+    host = registry_url.split('/')[0]
+    insecure = [r.strip() for r in os.environ.get('SYNC_INSECURE_REGISTRIES', '').split(',') if r.strip()]
+    if host in insecure:
+        return True
+    return host.split(':')[0] in ('localhost', '127.0.0.1')
+
+def registry_base_url(registry_url):
+    """把仓库地址转换为API基础URL"""
+    if registry_url.startswith(('http://', 'https://')):
+        return registry_url.rstrip('/')
+    if registry_url in ('docker.io', 'index.docker.io'):
+        registry_url = DOCKER_HUB_REGISTRY
+    scheme = 'http' if is_insecure_registry(registry_url) else 'https'
+    return f"{scheme}://{registry_url.rstrip('/')}"
+
+def is_docker_hub(registry_url):
+    """判断仓库是否为Docker Hub"""
+    return (registry_url or 'docker.io').rstrip('/') in DOCKER_HUB_ALIASES
+
+def parse_rate_limit(value):
+    """解析 ratelimit-limit/ratelimit-remaining 头，如 100;w=21600，返回次数"""
+    if not value:
+        return None
+    try:
+        return int(value.split(';')[0])
+    except ValueError:
+        return None
+
+def parse_upload_range(header):
+    """解析上传进度的Range头（如 0-1048575），返回已确认的字节数"""
+    if not header:
+        return None
+    end = int(header.split('-')[-1])
+    # 仓库对空的上传也返回 0-0
+    return end + 1 if end > 0 else 0
+
+def is_retryable_upload_error(error):
+    """分块上传中可以查询进度后重试的错误：连接中断、超时、仓库5xx和限流"""
+    if isinstance(error, RegistryError):
+        return error.status_code is not None and (error.status_code in (408, 429) or error.status_code >= 500)
+    return isinstance(error, requests.RequestException)
+
+def parse_auth_challenge(header):
+    """解析WWW-Authenticate头，返回(认证方式, 参数字典)"""
+    scheme, _, params = header.partition(' ')
+    values = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    return scheme.lower(), values
+
+def manifest_digest(body):
+    """计算清单内容的摘要"""
+    return 'sha256:' + hashlib.sha256(body).hexdigest()
+
+class BlobStream:
+    """把blob下载响应包装成带长度的文件对象，边读边校验摘要，用于流式上传"""
+
+    def __init__(self, response, digest, size, sink=None):
+        self._raw = response.raw if response is not None else None
+        self._digest = digest
+        self._size = size
+        self._hash = hashlib.sha256()
+        self._sink = sink
+        self.bytes_read = 0
+        self.verified = False
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = STREAM_CHUNK_SIZE
+        chunk = self._read_raw(size)
+        if chunk:
+            self._hash.update(chunk)
+            self.bytes_read += len(chunk)
+            if self._sink:
+                self._sink.write(chunk)
+        elif self.bytes_read != self._size or 'sha256:' + self._hash.hexdigest() != self._digest:
+            raise RegistryError(f"blob {self._digest} 内容不完整或摘要不匹配 "
+                                f"(已读取 {self.bytes_read}/{self._size} 字节)")
+        else:
+            self.verified = True
+        return chunk
+
+    def _read_raw(self, size):
+        return self._raw.read(size, decode_content=False)
+
+class SegmentedBlobStream(BlobStream):
+    """用多个并行的Range请求下载blob，按顺序读出，接口与BlobStream相同
+
+    最多parallel个分段同时下载，已下载未读取的分段保存在内存中；第一段在创建时同步下载，
+    仓库不支持Range请求时在开始上传前抛出RegistryError
+    """
+
+    def __init__(self, client, repository, digest, size, segment_size, parallel, sink=None):
+        super().__init__(None, digest, size, sink=sink)
+        self._segments = deque((start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size))
+        self._executor = ThreadPoolExecutor(max_workers=parallel)
+        self._pending = deque()
+        self._fetch = lambda start, end: client.fetch_blob_range(repository, digest, start, end)
+        self._buffer = b''
+        self._offset = 0
+        for _ in range(parallel):
+            self._submit()
+        try:
+            self._next_segment()
+        except Exception:
+            self.close()
+            raise
+
+    def _submit(self):
+        if self._segments:
+            start, end = self._segments.popleft()
+            self._pending.append(self._executor.submit(self._fetch, start, end))
+
+    def _next_segment(self):
+        self._buffer = self._pending.popleft().result()
+        self._offset = 0
+        self._submit()
+
+    def _read_raw(self, size):
+        if self._offset >= len(self._buffer):
+            if not self._pending:
+                return b''
+            self._next_segment()
+        chunk = self._buffer[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        return chunk
+
+    def close(self):
+        """取消未开始的分段下载"""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+class RegistryClient:
+    """Registry HTTP API v2 客户端，负责认证、清单和blob的读写"""
+
+    def __init__(self, registry_url, username=None, password=None):
+        self.registry_url = registry_url
+        self.base_url = registry_base_url(registry_url)
+        self.username = username
+        self.password = password
+        self.session = requests.Session()
+        self._tokens = {}
+        self._challenge = None
+        self._lock = threading.Lock()
+
+    def _auth_headers(self, scope):
+        with self._lock:
+            token = self._tokens.get(scope)
+        if token is None:
+            return {}
+        value, expires_at = token
+        if expires_at and expires_at < time.time():
+            return {}
+        return {'Authorization': value}
+
+    def _authenticate(self, challenge, scope):
+        """根据仓库返回的认证挑战获取令牌"""
+        scheme, params = parse_auth_challenge(challenge)
+        credentials = (self.username, self.password) if self.username and self.password else None
+        if scheme == 'basic':
+            if not credentials:
+                raise RegistryError(f"{self.registry_url} 需要用户名和密码", 401)
+            value = requests.auth._basic_auth_str(*credentials)
+            expires_at = None
+        elif scheme == 'bearer':
+            query = {'service': params.get('service', '')}
+            if scope:
+                # 跨仓库挂载需要同时申请多个仓库的权限
+                query['scope'] = list(scope) if isinstance(scope, tuple) else scope
+            response = self.session.get(params['realm'], params=query, auth=credentials, timeout=60)
+            if response.status_code != 200:
+                raise RegistryError(f"获取 {self.registry_url} 令牌失败: HTTP {response.status_code}",
+                                    response.status_code)
+            data = response.json()
+            token = data.get('token') or data.get('access_token')
+            value = f"Bearer {token}"
+            # 提前10秒刷新令牌，避免长时间传输过程中过期
+            expires_at = time.time() + int(data.get('expires_in', 60)) - 10
+        else:
+            raise RegistryError(f"不支持的认证方式: {scheme}", 401)
+        with self._lock:
+            self._tokens[scope] = (value, expires_at)
+
+    def request(self, method, url, scope=None, expected=(200,), **kwargs):
+        """发送API请求，遇到401时认证后重试一次"""
+        if not url.startswith(('http://', 'https://')):
+            url = urljoin(self.base_url + '/', url.lstrip('/'))
+        headers = dict(kwargs.pop('headers', None) or {})
+        kwargs.setdefault('timeout', 300)
+        body = kwargs.get('data')
+        streaming_body = body is not None and not isinstance(body, (bytes, str))
+        if streaming_body and not self._auth_headers(scope) and self._challenge:
+            # 流式请求体无法重发，发送数据前先用已知的认证挑战获取令牌
+            self._authenticate(self._challenge, scope)
+        response = self.session.request(method, url, headers={**headers, **self._auth_headers(scope)}, **kwargs)
+        if response.status_code == 401 and 'WWW-Authenticate' in response.headers:
+            if streaming_body:
+                raise RegistryError(f"{method} {url} 认证失败", 401)
+            response.close()
+            self._challenge = response.headers['WWW-Authenticate']
+            self._authenticate(self._challenge, scope)
+            response = self.session.request(method, url, headers={**headers, **self._auth_headers(scope)}, **kwargs)
+        if response.status_code not in expected:
+            message = response.text[:500] if not kwargs.get('stream') else ''
+            response.close()
+            raise RegistryError(f"{method} {url} 失败: HTTP {response.status_code} {message}".strip(),
+                                response.status_code)
+        return response
+
+    @staticmethod
+    def scope(repository, actions='pull'):
+        return f"repository:{repository}:{actions}"
+
+    def head_manifest(self, repository, reference):
+        """HEAD清单，返回(摘要, 媒体类型)，不存在时返回(None, None)"""
+        response = self.request('HEAD', f"/v2/{repository}/manifests/{reference}",
+                                scope=self.scope(repository), expected=(200, 404),
+                                headers={'Accept': MANIFEST_ACCEPT})
+        if response.status_code == 404:
+            return None, None
+        return response.headers.get('Docker-Content-Digest'), response.headers.get('Content-Type')
+
+    def rate_limit(self, repository=DOCKER_HUB_RATE_LIMIT_REPOSITORY):
+        """HEAD清单读取Docker Hub的拉取额度，返回(剩余次数, 上限)，不受限制时返回(None, None)"""
+        response = self.request('HEAD', f"/v2/{repository}/manifests/latest",
+                                scope=self.scope(repository), headers={'Accept': MANIFEST_ACCEPT})
+        return (parse_rate_limit(response.headers.get('ratelimit-remaining')),
+                parse_rate_limit(response.headers.get('ratelimit-limit')))
+
+    def list_tags(self, repository, page_size=1000):
+        """获取repository的全部标签，自动跟随Link分页"""
+        tags = []
+        url = f"/v2/{repository}/tags/list"
+        params = {'n': page_size}
+        while url:
+            response = self.request('GET', url, scope=self.scope(repository), params=params)
+            tags.extend(response.json().get('tags') or [])
+            # 下一页地址中已包含分页参数
+            url = response.links.get('next', {}).get('url')
+            params = None
+        return tags
+
+    def get_manifest(self, repository, reference):
+        """获取清单，返回(原始内容, 媒体类型, 摘要)"""
+        response = self.request('GET', f"/v2/{repository}/manifests/{reference}",
+                                scope=self.scope(repository), headers={'Accept': MANIFEST_ACCEPT})
+        body = response.content
+        media_type = response.headers.get('Content-Type', '').split(';')[0]
+        if media_type not in INDEX_MEDIA_TYPES + IMAGE_MEDIA_TYPES:
+            media_type = json_media_type(body) or media_type
+        return body, media_type, manifest_digest(body)
+
+    def put_manifest(self, repository, reference, body, media_type):
+        """推送清单，返回仓库计算的摘要"""
+        response = self.request('PUT', f"/v2/{repository}/manifests/{reference}",
+                                scope=self.scope(repository, 'pull,push'), expected=(201,),
+                                data=body, headers={'Content-Type': media_type})
+        return response.headers.get('Docker-Content-Digest') or manifest_digest(body)
+
+    def open_blob(self, repository, digest):
+        """以流的方式打开blob"""
+        return self.request('GET', f"/v2/{repository}/blobs/{digest}",
+                            scope=self.scope(repository), stream=True)
+
+    def fetch_blob_range(self, repository, digest, start, end):
+        """用Range请求读取blob中 [start, end] 的字节，仓库不支持Range请求时抛出RegistryError"""
+        response = self.request('GET', f"/v2/{repository}/blobs/{digest}", scope=self.scope(repository),
+                                expected=(200, 206), stream=True, headers={'Range': f"bytes={start}-{end}"})
+        if response.status_code != 206:
+            response.close()
+            raise RegistryError(f"{self.registry_url} 不支持Range请求")
+        data = response.raw.read(end - start + 1, decode_content=False)
+        response.close()
+        if len(data) != end - start + 1:
+            raise RegistryError(f"blob {digest} 的 {start}-{end} 段不完整（{len(data)} 字节）")
+        return data
+
+    def blob_exists(self, repository, digest):
+        """HEAD检查blob是否已存在于仓库中"""
+        response = self.request('HEAD', f"/v2/{repository}/blobs/{digest}",
+                                scope=self.scope(repository), expected=(200, 404))
+        return response.status_code == 200
+
+    def mount_blob(self, repository, digest, from_repository):
+        """尝试从同一仓库的其他repository挂载blob，返回(是否挂载成功, 未成功时的上传地址)"""
+        scope = (self.scope(repository, 'pull,push'), self.scope(from_repository))
+        response = self.request('POST', f"/v2/{repository}/blobs/uploads/",
+                                scope=scope, expected=(201, 202),
+                                params={'mount': digest, 'from': from_repository})
+        if response.status_code == 201:
+            return True, None
+        # 仓库不支持或找不到来源blob时会直接开启一次普通上传
+        return False, urljoin(self.base_url + '/', response.headers['Location'])
+
+    def start_upload(self, repository):
+        """开始一次blob上传，返回上传地址"""
+        response = self.request('POST', f"/v2/{repository}/blobs/uploads/",
+                                scope=self.scope(repository, 'pull,push'), expected=(202,))
+        return urljoin(self.base_url + '/', response.headers['Location'])
+
+    def upload_blob(self, repository, digest, stream, location=None):
+        """单次PUT完成blob上传，stream需支持len()和read()"""
+        if location is None:
+            location = self.start_upload(repository)
+        self.request('PUT', location, scope=self.scope(repository, 'pull,push'), expected=(201,),
+                     params={'digest': digest}, data=stream,
+                     headers={'Content-Type': 'application/octet-stream'})
+
+    def upload_offset(self, repository, location):
+        """查询上传进度，返回目标仓库已确认的字节数，上传已失效时返回None"""
+        response = self.request('GET', location, scope=self.scope(repository, 'pull,push'), expected=(204, 404))
+        if response.status_code == 404:
+            return None
+        return parse_upload_range(response.headers.get('Range')) or 0
+
+    def upload_chunk(self, repository, location, data, offset):
+        """PATCH上传一个分块，返回(下一次请求使用的上传地址, 已确认的字节数)"""
+        response = self.request('PATCH', location, scope=self.scope(repository, 'pull,push'), expected=(202,),
+                                data=data, headers={
+                                    'Content-Type': 'application/octet-stream',
+                                    'Content-Range': f"{offset}-{offset + len(data) - 1}",
+                                })
+        confirmed = parse_upload_range(response.headers.get('Range'))
+        location = urljoin(self.base_url + '/', response.headers.get('Location') or location)
+        return location, offset + len(data) if confirmed is None else confirmed
+
+    def upload_blob_chunked(self, repository, digest, stream, location=None, sessions=None, log=print):
+        """分块PATCH上传blob，每个分块确认后记录进度
+
+        sessions中有该blob未完成的上传时从已确认的字节继续，前面的数据从stream中读出后丢弃；
+        分块因连接中断或仓库错误失败时查询已确认的字节数后重试
+        """
+        key = sessions.key(self.registry_url, repository, digest)
+        if not sessions.claim(key):
+            # 同一进程中的另一个线程正在上传同一个blob，不能共用它的上传地址和记录，重新开始一个上传
+            self._upload_chunks(repository, digest, stream, location, sessions, None, log)
+            return
+        try:
+            self._upload_chunks(repository, digest, stream, location, sessions, key, log)
+        finally:
+            sessions.release(key)
+
+    def _upload_chunks(self, repository, digest, stream, location, sessions, key, log):
+        """分块上传的实现，key为None时不记录也不继续上传进度"""
+        size = len(stream)
+        offset = 0
+        saved = sessions.get(key) if key else None
+        if saved and saved.get('size') == size:
+            confirmed = self.upload_offset(repository, saved['location'])
+            if confirmed:
+                location, offset = saved['location'], confirmed
+                sessions.count_resumed(offset)
+                log(f"继续上传blob {digest}: 已确认 {offset / (1024 * 1024):.2f}/{size / (1024 * 1024):.2f}MB")
+        if location is None:
+            location = self.start_upload(repository)
+
+        # buffer保存从offset开始、尚未被目标仓库确认的数据
+        buffer = bytearray()
+        position = 0
+        while position < offset:
+            chunk = stream.read(min(STREAM_CHUNK_SIZE, offset - position))
+            if not chunk:
+                raise RegistryError(f"blob {digest} 数据不足 {offset} 字节，无法继续上传")
+            position += len(chunk)
+            if position > offset:
+                buffer.extend(chunk[len(chunk) - (position - offset):])
+
+        retries = 0
+        while offset < size:
+            while len(buffer) < sessions.chunk_size and position < size:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, sessions.chunk_size - len(buffer)))
+                if not chunk:
+                    break
+                buffer.extend(chunk)
+                position += len(chunk)
+            try:
+                location, confirmed = self.upload_chunk(repository, location, bytes(buffer), offset)
+                if confirmed == offset:
+                    raise RegistryError(f"blob {digest} 的分块未被仓库接收")
+                retries = 0
+            except (RegistryError, requests.RequestException) as e:
+                error = e
+                confirmed = None
+                while confirmed is None:
+                    retries += 1
+                    if not is_retryable_upload_error(error) or retries > CHUNK_RETRIES:
+                        raise error
+                    delay = CHUNK_RETRY_BASE_SECONDS * 2 ** (retries - 1)
+                    log(f"上传blob {digest} 的分块失败（{error}），{delay} 秒后从已确认的位置重试")
+                    time.sleep(delay)
+                    try:
+                        confirmed = self.upload_offset(repository, location)
+                    except (RegistryError, requests.RequestException) as e:
+                        error = e
+                        continue
+                    if confirmed is None:
+                        if key:
+                            sessions.remove(key)
+                        raise RegistryError(f"blob {digest} 的上传已失效", 404)
+            if not offset <= confirmed <= offset + len(buffer):
+                raise RegistryError(f"blob {digest} 上传进度异常: 已确认 {confirmed} 字节，已发送 {offset + len(buffer)} 字节")
+            del buffer[:confirmed - offset]
+            offset = confirmed
+            if key:
+                sessions.save(key, location, offset, size)
+
+        # 读到数据流末尾，源blob的摘要在此时校验，校验失败时不完成上传
+        if stream.read(STREAM_CHUNK_SIZE):
+            raise RegistryError(f"blob {digest} 的数据超过 {size} 字节")
+        self.request('PUT', location, scope=self.scope(repository, 'pull,push'), expected=(201,),
+                     params={'digest': digest}, data=b'', headers={'Content-Type': 'application/octet-stream'})
+        if key:
+            sessions.remove(key)
+
+def json_media_type(body):
+    """从清单内容中读取mediaType字段"""
+    try:
+        return json.loads(body).get('mediaType')
+    except ValueError:
+        return None
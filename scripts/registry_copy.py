@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from registry_client import (
+    RegistryError, PermanentRegistryError, BlobStream, SegmentedBlobStream, INDEX_MEDIA_TYPES, IMAGE_MEDIA_TYPES,
+    is_docker_hub
+)
+from blob_cache import get_blob_cache
+from upload_sessions import get_upload_sessions
+
+# 不可分发的外部层，目标仓库无需保存
+FOREIGN_LAYER_MEDIA_TYPES = (
+    'application/vnd.docker.image.rootfs.foreign.diff.tar.gzip',
+    'application/vnd.oci.image.layer.nondistributable.v1.tar+gzip',
+)
+
+# BuildKit生成的证明清单（SBOM、provenance）在多平台清单中带有该注解，平台为unknown/unknown
+ATTESTATION_ANNOTATION = 'vnd.docker.reference.type'
+
+# 查找可挂载blob时最多检查的同命名空间repository数量
+MOUNT_CANDIDATE_LIMIT = 5
+
+# 同时上传到多个目标时，每个目标最多缓存的数据块数量
+FANOUT_QUEUE_CHUNKS = 8
+
+# 每个镜像同时传输的blob数量
+DEFAULT_LAYER_CONCURRENCY = 4
+# 每个仓库同时传输的blob数量（所有镜像和worker线程共享），可按仓库单独设置
+DEFAULT_REGISTRY_CONCURRENCY = 6
+
+# 分段下载大blob时每个Range请求的大小，以及默认启用分段下载的最小blob大小
+RANGE_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_RANGE_MIN_SIZE = 256 * 1024 * 1024
+
+def registry_key(registry_url):
+    """并发限制按仓库地址区分，Docker Hub的各个地址视为同一个仓库"""
+    return 'docker.io' if is_docker_hub(registry_url) else registry_url
+
+class TransferLimits:
+    """blob传输的并发设置：每个镜像同时传输的blob数、每个仓库同时传输的blob数，以及大blob的分段下载"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self.layers = DEFAULT_LAYER_CONCURRENCY
+        self.default = DEFAULT_REGISTRY_CONCURRENCY
+        self.registries = {}
+        self.range_segments = 0
+        self.range_min_size = DEFAULT_RANGE_MIN_SIZE
+
+    def configure(self, layers=None, default=None, registries=None, range_segments=None, range_min_size=None):
+        """修改并发设置，需在开始传输前调用"""
+        with self._lock:
+            if layers is not None:
+                self.layers = max(1, layers)
+            if default is not None:
+                self.default = max(1, default)
+            if registries is not None:
+                self.registries = {registry_key(url): max(1, limit) for url, limit in registries.items()}
+            if range_segments is not None:
+                self.range_segments = range_segments
+            if range_min_size is not None:
+                self.range_min_size = range_min_size
+            self._semaphores = {}
+
+    def limit(self, registry_url):
+        return self.registries.get(registry_key(registry_url), self.default)
+
+    def _semaphore(self, key):
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = self._semaphores[key] = threading.BoundedSemaphore(self.registries.get(key, self.default))
+            return semaphore
+
+    @contextmanager
+    def slots(self, registry_urls):
+        """占用各仓库的一个传输槽；按仓库地址顺序获取，多个目标同时传输时不会互相等待对方已占用的槽"""
+        acquired = []
+        try:
+            for key in sorted(set(registry_key(url) for url in registry_urls)):
+                semaphore = self._semaphore(key)
+                semaphore.acquire()
+                acquired.append(semaphore)
+            yield
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+    def use_segments(self, size):
+        return self.range_segments > 1 and size >= self.range_min_size
+
+TRANSFER_LIMITS = TransferLimits()
+
+class BlobLocations:
+    """记录本次运行中已确认存在于目标仓库各repository中的blob，供跨仓库挂载使用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._repositories = {}
+
+    def add(self, registry_url, digest, repository):
+        with self._lock:
+            repositories = self._repositories.setdefault((registry_url, digest), [])
+            if repository not in repositories:
+                repositories.append(repository)
+
+    def get(self, registry_url, digest):
+        with self._lock:
+            return list(self._repositories.get((registry_url, digest), []))
+
+BLOB_LOCATIONS = BlobLocations()
+
+class Destination:
+    """复制目标：目标仓库客户端、repository和标签，以及该目标的复制结果或错误"""
+
+    def __init__(self, client, repository, tag, mount_candidates=(), name=None):
+        self.client = client
+        self.repository = repository
+        self.tag = tag
+        self.mount_candidates = mount_candidates
+        self.name = name or client.registry_url
+        self.result = {'size': 0, 'transferred': 0, 'skipped': 0, 'platforms': [], 'layers': []}
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add(self, key, value):
+        """累加result中的计数，同一镜像的多个blob并行传输时使用"""
+        with self._lock:
+            self.result[key] += value
+
+    def add_layer(self, layer):
+        with self._lock:
+            self.result['layers'].append(layer)
+
+    def fail(self, error, log=print):
+        with self._lock:
+            if self.error is not None:
+                return
+            self.error = error
+        log(f"目标 {self.name} 复制失败: {error}")
+
+class QueueStream:
+    """从队列读取数据块的文件对象，用于把一次下载同时上传到多个目标"""
+
+    def __init__(self, size):
+        self._size = size
+        self._queue = queue.Queue(maxsize=FANOUT_QUEUE_CHUNKS)
+        self.closed = False
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        chunk = self._queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk or b''
+
+    def put(self, chunk):
+        """写入数据块；上传方已失败时直接丢弃，避免阻塞下载"""
+        while not self.closed:
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def abort(self):
+        self.closed = True
+
+def split_platform(platform):
+    """把 linux/arm64/v8 形式的平台拆分为(os, architecture, variant)"""
+    parts = (platform or 'linux/amd64').split('/')
+    os_name = parts[0]
+    architecture = parts[1] if len(parts) > 1 else 'amd64'
+    variant = parts[2] if len(parts) > 2 else None
+    return os_name, architecture, variant
+
+def select_platform_manifest(index, platform):
+    """从多平台清单中选出指定平台的清单描述"""
+    os_name, architecture, variant = split_platform(platform)
+    for entry in index.get('manifests', []):
+        entry_platform = entry.get('platform', {})
+        if entry_platform.get('os') != os_name or entry_platform.get('architecture') != architecture:
+            continue
+        if variant and entry_platform.get('variant') != variant:
+            continue
+        return entry
+    raise PermanentRegistryError(f"多平台清单中没有找到平台 {platform}")
+
+def is_attestation(entry):
+    """判断多平台清单中的描述是否为证明清单而不是可运行的平台"""
+    return (ATTESTATION_ANNOTATION in (entry.get('annotations') or {})
+            or (entry.get('platform') or {}).get('os') == 'unknown')
+
+def image_blobs(manifest):
+    """返回镜像清单引用的全部blob描述（配置和各层）"""
+    blobs = [manifest['config']] + manifest.get('layers', [])
+    return [b for b in blobs if b.get('mediaType') not in FOREIGN_LAYER_MEDIA_TYPES]
+
+def find_mount_source(target, target_repo, digest, mount_candidates):
+    """在同命名空间的其他repository中查找已有该blob的来源，找不到返回None"""
+    known = [r for r in BLOB_LOCATIONS.get(target.registry_url, digest) if r != target_repo]
+    if known:
+        return known[0]
+    for repository in [r for r in mount_candidates if r != target_repo][:MOUNT_CANDIDATE_LIMIT]:
+        if target.blob_exists(repository, digest):
+            BLOB_LOCATIONS.add(target.registry_url, digest, repository)
+            return repository
+    return None
+
+def prepare_blob(destination, digest, log=print):
+    """检查目标是否已有blob或能否挂载，返回('exists'|'mounted'|None, 需要上传时可复用的上传地址)"""
+    target = destination.client
+    if target.blob_exists(destination.repository, digest):
+        BLOB_LOCATIONS.add(target.registry_url, digest, destination.repository)
+        return 'exists', None
+    
+    location = None
+    mount_source = find_mount_source(target, destination.repository, digest, destination.mount_candidates)
+    if mount_source:
+        mounted, location = target.mount_blob(destination.repository, digest, mount_source)
+        if mounted:
+            log(f"blob {digest} 已从 {mount_source} 挂载到 {destination.name}")
+            BLOB_LOCATIONS.add(target.registry_url, digest, destination.repository)
+            return 'mounted', None
+    return None, location
+
+def upload_blob(destination, digest, stream, location=None, log=print):
+    """上传blob到一个目标；启用分块上传且blob超过分块大小时分块上传，中断后可以继续"""
+    sessions = get_upload_sessions()
+    if sessions is not None and len(stream) > sessions.chunk_size:
+        destination.client.upload_blob_chunked(destination.repository, digest, stream, location, sessions, log=log)
+    else:
+        destination.client.upload_blob(destination.repository, digest, stream, location=location)
+
+def fanout_upload(stream, digest, uploads, log=print):
+    """把同一个下载流同时上传到多个目标，uploads为(目标, 上传地址)列表，返回上传成功的目标"""
+    queues = [QueueStream(len(stream)) for _ in uploads]
+    errors = {}
+    
+    def upload(index):
+        destination, location = uploads[index]
+        try:
+            upload_blob(destination, digest, queues[index], location, log=log)
+        except Exception as e:
+            errors[index] = e
+        finally:
+            # 上传结束后不再读取队列，下载方写入时直接丢弃，不能因此阻塞
+            queues[index].abort()
+    
+    threads = [threading.Thread(target=upload, args=(i,), daemon=True) for i in range(len(uploads))]
+    for thread in threads:
+        thread.start()
+    # 写入每个队列的结束标记：正常读完为None，下载失败时为异常，让所有上传一起失败
+    end = RegistryError(f"blob {digest} 下载中断")
+    try:
+        for chunk in stream:
+            for q in queues:
+                q.put(chunk)
+        end = None
+    except Exception as e:
+        end = e
+    finally:
+        for q in queues:
+            q.put(end)
+    for thread in threads:
+        thread.join()
+    
+    succeeded = []
+    for index, (destination, _) in enumerate(uploads):
+        if index in errors:
+            destination.fail(errors[index], log=log)
+        else:
+            succeeded.append(destination)
+    return succeeded
+
+def upload_stream(stream, digest, uploads, log=print):
+    """把一个数据流上传到需要上传的目标，返回上传成功的目标"""
+    if len(uploads) > 1:
+        return fanout_upload(stream, digest, uploads, log=log)
+    destination, location = uploads[0]
+    try:
+        upload_blob(destination, digest, stream, location, log=log)
+        return [destination]
+    except (RegistryError, requests.RequestException) as e:
+        destination.fail(e, log=log)
+        return []
+
+def open_source_stream(source, source_repo, digest, size, sink=None, log=print):
+    """打开源仓库中blob的下载流，返回(流, 响应)；blob足够大且启用分段下载时用并行Range请求下载，响应为None"""
+    if TRANSFER_LIMITS.use_segments(size):
+        try:
+            stream = SegmentedBlobStream(source, source_repo, digest, size, RANGE_SEGMENT_SIZE,
+                                         TRANSFER_LIMITS.range_segments, sink=sink)
+            return stream, None
+        except (RegistryError, requests.RequestException) as e:
+            log(f"blob {digest} 分段下载失败，改为整体下载: {e}")
+    response = source.open_blob(source_repo, digest)
+    return BlobStream(response, digest, size, sink=sink), response
+
+def copy_blob(source, source_repo, descriptor, destinations, log=print):
+    """把一个blob复制到所有目标：已存在则跳过，能挂载则挂载，其余目标共用一次源仓库下载流式上传
+    
+    启用blob缓存时优先从缓存读取，未命中时边下载边写入缓存。传输前占用源仓库（命中缓存时除外）和
+    各目标仓库的传输槽，传输的耗时、速度和等待传输槽的时间记录在各目标result的layers中
+    """
+    digest = descriptor['digest']
+    size = descriptor['size']
+    uploads = []
+    for destination in destinations:
+        if destination.error:
+            continue
+        try:
+            outcome, location = prepare_blob(destination, digest, log=log)
+        except (RegistryError, requests.RequestException) as e:
+            destination.fail(e, log=log)
+            continue
+        if outcome:
+            destination.add('skipped', size)
+        else:
+            uploads.append((destination, location))
+    if not uploads:
+        return
+    
+    cache = get_blob_cache()
+    cached = cache.open(digest, size) if cache else None
+    registries = [destination.client.registry_url for destination, _ in uploads]
+    if not cached:
+        registries.append(source.registry_url)
+    waited = time.time()
+    with TRANSFER_LIMITS.slots(registries):
+        started = time.time()
+        if cached:
+            origin = 'cache'
+            try:
+                log(f"blob {digest} 命中本地缓存")
+                succeeded = upload_stream(cached, digest, uploads, log=log)
+            finally:
+                cached.close()
+        else:
+            writer = cache.writer(digest, size) if cache else None
+            try:
+                stream, response = open_source_stream(source, source_repo, digest, size, sink=writer, log=log)
+            except (RegistryError, requests.RequestException) as e:
+                if writer:
+                    writer.discard()
+                for destination, _ in uploads:
+                    destination.fail(e, log=log)
+                return
+            origin = 'range' if response is None else 'registry'
+            try:
+                succeeded = upload_stream(stream, digest, uploads, log=log)
+            finally:
+                if response is None:
+                    stream.close()
+                else:
+                    response.close()
+                if writer:
+                    # 只缓存完整下载并通过摘要校验的blob
+                    if stream.verified:
+                        cache.commit(writer)
+                    else:
+                        writer.discard()
+        elapsed = time.time() - started
+    
+    layer = {
+        'digest': digest,
+        'size': size,
+        'seconds': round(elapsed, 3),
+        'wait_seconds': round(started - waited, 3),
+        'source': origin,
+    }
+    for destination in succeeded:
+        BLOB_LOCATIONS.add(destination.client.registry_url, digest, destination.repository)
+        destination.add('transferred', size)
+        destination.add_layer(layer)
+    if succeeded:
+        mbps = size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+        waiting = f"，等待传输槽 {layer['wait_seconds']:.1f} 秒" if layer['wait_seconds'] >= 0.1 else ''
+        log(f"已传输blob {digest} ({size / (1024 * 1024):.2f}MB) 到 {len(succeeded)} 个目标，"
+            f"用时 {elapsed:.1f} 秒（{mbps:.2f}MB/s）{waiting}")
+
+def copy_manifest_blobs(source, source_repo, manifest, destinations, copied=None, log=print):
+    """复制一个平台清单引用的全部blob，copied记录本次已处理的摘要，多平台共享的层只处理一次
+    
+    最多同时传输TRANSFER_LIMITS.layers个blob，各blob的日志在传输完成后按层的顺序输出。返回该平台清单的压缩大小
+    """
+    if copied is None:
+        copied = set()
+    platform_size = 0
+    pending = []
+    for descriptor in image_blobs(manifest):
+        platform_size += descriptor['size']
+        if descriptor['digest'] in copied:
+            continue
+        copied.add(descriptor['digest'])
+        for destination in destinations:
+            destination.add('size', descriptor['size'])
+        pending.append(descriptor)
+    
+    workers = min(TRANSFER_LIMITS.layers, len(pending))
+    if workers <= 1:
+        for descriptor in pending:
+            copy_blob(source, source_repo, descriptor, destinations, log=log)
+        return platform_size
+    
+    def copy(descriptor):
+        lines = []
+        copy_blob(source, source_repo, descriptor, destinations, log=lines.append)
+        return lines
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for lines in executor.map(copy, pending):
+            for line in lines:
+                log(line)
+    return platform_size
+
+def put_manifest(destinations, reference, body, media_type, log=print):
+    """向所有未失败的目标推送清单，reference为None时使用各目标自己的标签，返回各目标的摘要"""
+    digests = {}
+    for destination in destinations:
+        if destination.error:
+            continue
+        try:
+            digests[destination] = destination.client.put_manifest(
+                destination.repository, reference or destination.tag, body, media_type)
+        except (RegistryError, requests.RequestException) as e:
+            destination.fail(e, log=log)
+    return digests
+
+def copy_image(source, source_repo, reference, destinations, platform, log=print):
+    """通过Registry HTTP API把单个平台的镜像复制到一个或多个目标
+    
+    清单只从源仓库获取一次，每个blob只下载一次；只传输目标仓库缺少的blob。
+    结果（目标清单摘要、压缩后的总大小、实际传输和跳过的字节数）记录在各目标的result中
+    """
+    body, media_type, digest = source.get_manifest(source_repo, reference)
+    if media_type in INDEX_MEDIA_TYPES:
+        entry = select_platform_manifest(json.loads(body), platform)
+        log(f"多平台清单 {digest}，选择平台 {platform}: {entry['digest']}")
+        body, media_type, digest = source.get_manifest(source_repo, entry['digest'])
+    if media_type not in IMAGE_MEDIA_TYPES:
+        raise PermanentRegistryError(f"不支持的清单类型: {media_type}")
+
+    copy_manifest_blobs(source, source_repo, json.loads(body), destinations, log=log)
+
+    # 原样推送清单内容，保证目标摘要与源一致
+    for destination, target_digest in put_manifest(destinations, None, body, media_type, log=log).items():
+        destination.result['digest'] = target_digest
+        destination.result['media_type'] = media_type
+
+def image_compressed_size(source, source_repo, reference, platform):
+    """从清单读取指定平台镜像各层压缩后的总字节数（不下载任何层）"""
+    body, media_type, _ = source.get_manifest(source_repo, reference)
+    if media_type in INDEX_MEDIA_TYPES:
+        entry = select_platform_manifest(json.loads(body), platform)
+        body, media_type, _ = source.get_manifest(source_repo, entry['digest'])
+    if media_type not in IMAGE_MEDIA_TYPES:
+        raise PermanentRegistryError(f"不支持的清单类型: {media_type}")
+    return sum(blob.get('size', 0) for blob in image_blobs(json.loads(body)))
+
+def format_platform(entry_platform):
+    """把清单中的platform字段格式化为 os/architecture[/variant]"""
+    parts = [entry_platform.get('os', 'unknown'), entry_platform.get('architecture', 'unknown')]
+    if entry_platform.get('variant'):
+        parts.append(entry_platform['variant'])
+    return '/'.join(parts)
+
+def copy_image_index(source, source_repo, reference, destinations, platforms=None, log=print):
+    """一次复制多平台镜像：复制选中平台的清单和blob，再向每个目标推送一个多平台清单
+    
+    platforms为None时复制全部平台（原样推送源多平台清单，摘要不变；其中的证明清单不是平台，
+    会被去掉并重新生成多平台清单），否则只复制列出的平台并生成只包含这些平台的多平台清单。
+    各目标result中的platforms列出每个平台清单的摘要和大小
+    """
+    body, media_type, digest = source.get_manifest(source_repo, reference)
+    if media_type not in INDEX_MEDIA_TYPES:
+        # 源镜像只有一个平台，按普通镜像原样复制
+        if media_type not in IMAGE_MEDIA_TYPES:
+            raise PermanentRegistryError(f"不支持的清单类型: {media_type}")
+        log(f"{source_repo}:{reference} 不是多平台镜像，按单平台复制")
+        copy_manifest_blobs(source, source_repo, json.loads(body), destinations, log=log)
+        for destination, target_digest in put_manifest(destinations, None, body, media_type, log=log).items():
+            destination.result['digest'] = target_digest
+            destination.result['media_type'] = media_type
+        return
+
+    index = json.loads(body)
+    attestations = [entry for entry in index.get('manifests', []) if is_attestation(entry)]
+    if platforms is None:
+        entries = [entry for entry in index.get('manifests', []) if not is_attestation(entry)]
+    else:
+        entries = [select_platform_manifest(index, platform) for platform in platforms]
+    log(f"多平台清单 {digest}，复制 {len(entries)} 个清单"
+        + (f"，跳过 {len(attestations)} 个证明清单" if attestations else ''))
+
+    copied = set()
+    for entry in entries:
+        manifest_body, manifest_type, manifest_digest = source.get_manifest(source_repo, entry['digest'])
+        if manifest_type not in IMAGE_MEDIA_TYPES:
+            raise PermanentRegistryError(f"不支持的清单类型: {manifest_type}")
+        platform_size = copy_manifest_blobs(source, source_repo, json.loads(manifest_body), destinations,
+                                            copied, log=log)
+        # 平台清单按摘要推送，多平台清单通过摘要引用它们
+        platform = format_platform(entry.get('platform', {}))
+        for destination in put_manifest(destinations, manifest_digest, manifest_body, manifest_type, log=log):
+            destination.result['platforms'].append(
+                {'platform': platform, 'digest': manifest_digest, 'size': platform_size})
+        log(f"平台 {platform} 清单 {manifest_digest} 已复制")
+
+    if platforms is not None or attestations:
+        index = dict(index, manifests=entries)
+        body = json.dumps(index, indent=3).encode('utf-8')
+    for destination, target_digest in put_manifest(destinations, None, body, media_type, log=log).items():
+        destination.result['digest'] = target_digest
+        destination.result['media_type'] = media_type
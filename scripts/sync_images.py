@@ -4,77 +4,355 @@
 import os
 import sys
 import argparse
-import subprocess
-import mysql.connector
 from mysql.connector import Error
 from datetime import datetime
 import re
 import json
+import time
+import shutil
+import random
+import socket
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
 
-def get_db_connection():
-    """获取数据库连接"""
-    try:
-        connection = mysql.connector.connect(
-            host=os.environ.get('MYSQL_HOST'),
-            port=os.environ.get('MYSQL_PORT'),
-            user=os.environ.get('MYSQL_USER'),
-            password=os.environ.get('MYSQL_PASSWORD'),
-            database=os.environ.get('MYSQL_DB')
-        )
-        return connection
-    except Error as e:
-        print(f"数据库连接错误: {e}")
-        sys.exit(1)
+import requests
+
+from db import db_cursor, configure_pool, print_db_timings, STATUS_WRITER
+from registry_client import RegistryClient, RegistryError, PermanentRegistryError, DOCKER_HUB_ALIASES, is_docker_hub
+from registry_copy import (
+    Destination, copy_image, copy_image_index, image_compressed_size, TRANSFER_LIMITS, DEFAULT_LAYER_CONCURRENCY,
+    DEFAULT_REGISTRY_CONCURRENCY, DEFAULT_RANGE_MIN_SIZE
+)
+from disk_budget import DiskBudget, GB, UNCOMPRESSED_RATIO
+from blob_cache import configure_blob_cache, get_blob_cache, DEFAULT_CACHE_SIZE_GB
+from upload_sessions import configure_upload_sessions, get_upload_sessions, DEFAULT_STATE_PATH, DEFAULT_CHUNK_SIZE_MB
+from docker_client import DockerClient, DockerError, LayerProgress, registry_auth_header
+from metrics import METRICS
+
+# 拉取镜像后至少保留的可用磁盘空间（GB），不足时删除已推送的本地镜像
+MIN_FREE_SPACE_GB = 5
+
+# 领取镜像时的租约时长（秒），进程存活期间会在后台定期续租
+DEFAULT_LEASE_SECONDS = 1800
+
+# 失败重试：指数退避的基础间隔和上限（秒），超过最大尝试次数后标记为失败（push_status = 2）
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3 * 3600
+MAX_ATTEMPTS = 5
+
+# 拉取时磁盘空间不足的镜像推迟该秒数后再同步，给清理和其他镜像腾出空间的时间
+DISK_FULL_RETRY_SECONDS = 600
+
+# 本次运行结束前，等待不超过该秒数即可到期的重试会在本次运行中完成
+DEFAULT_RETRY_WINDOW = 900
+
+# 这些错误重试也不会成功（镜像或平台不存在、引用格式错误等）
+PERMANENT_ERROR_PATTERNS = (
+    'manifest unknown',
+    'not found',
+    'does not exist',
+    'no matching manifest',
+    'invalid reference format',
+    'name unknown',
+)
+
+# 全部平台（platform = all）同步时按该平台数估算Docker Hub拉取次数
+ESTIMATED_ALL_PLATFORMS = 4
+
+# Docker Hub额度不足时的领取顺序：不占额度的其他仓库镜像优先，其次是从未推送过的新镜像，然后是失败次数少的
+PRIORITY_ORDER = """
+    source_registry_url IN ({docker_hub}),
+    EXISTS (SELECT 1 FROM pushed_images p
+            WHERE p.orig_name_space = images_for_push.orig_name_space
+              AND p.orig_image_name = images_for_push.orig_image_name AND p.push_status = 1),
+    attempt_count
+""".format(docker_hub=', '.join(f"'{alias}'" for alias in DOCKER_HUB_ALIASES))
+
+# 调度策略: fifo 按入队顺序; priority 按优先级; sjf 按优先级，同一优先级中预计较小的镜像优先
+SCHEDULE_POLICIES = ('fifo', 'priority', 'sjf')
+DEFAULT_SCHEDULE = 'sjf'
+# 老化：每等待该分钟数有效优先级加1，大镜像和低优先级镜像不会一直被后来的镜像插队
+DEFAULT_AGING_MINUTES = 30
+# 还没有大小估算的镜像按该大小（字节）参与排序
+DEFAULT_ESTIMATED_SIZE = 1024 * 1024 * 1024
+
+# 镜像入队（或重置为待推送）的时间，以及开始可以被领取的时间（重试时为到期时间）
+ENQUEUED_AT = "COALESCE(enqueued_at, add_time)"
+ELIGIBLE_SINCE = f"GREATEST({ENQUEUED_AT}, COALESCE(next_attempt_at, {ENQUEUED_AT}))"
+
+# 每次为多少个待推送镜像估算大小
+ESTIMATE_BATCH_SIZE = 50
+DOCKER_HUB_TAG_API = "https://hub.docker.com/v2/repositories/{namespace}/{repository}/tags/{tag}"
+
+# 支持的目标仓库类型
+TARGET_CHOICES = ('aliyun', 'private')
+
+# 估算预检节省时间时使用的默认同步速度（MB/s）
+DEFAULT_SYNC_RATE_MBPS = 20
+
+# 并发模式下的日志输出锁、磁盘检查锁和每个线程的日志缓冲
+_print_lock = threading.Lock()
+_disk_lock = threading.Lock()
+_log_context = threading.local()
+
+# 每个仓库复用一个API客户端，共享连接和认证令牌
+_registry_clients = {}
+_registry_clients_lock = threading.Lock()
+# 目标仓库各命名空间下已有的repository，用于跨仓库挂载
+_target_repositories = {}
+
+class RunStats:
+    """线程安全的运行统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.started = time.time()
+
+    def add(self, key, value=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get(self, key, default=0):
+        with self._lock:
+            return self.counters.get(key, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+RUN_STATS = RunStats()
+
+class StageClock:
+    """统计拉取、推送阶段各自进行的时间以及两者同时进行的时间，累计到RUN_STATS中
+
+    pull_stage_seconds、push_stage_seconds为至少有一个镜像在拉取（推送）的时间，
+    pull_push_overlap_seconds为拉取和推送同时进行的时间
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {'pull': 0, 'push': 0}
+        self._last = time.time()
+
+    def _advance(self):
+        now = time.time()
+        elapsed = now - self._last
+        self._last = now
+        for stage, count in self._active.items():
+            if count:
+                RUN_STATS.add(f"{stage}_stage_seconds", elapsed)
+        if all(self._active.values()):
+            RUN_STATS.add('pull_push_overlap_seconds', elapsed)
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self._advance()
+            self._active[name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._advance()
+                self._active[name] -= 1
 
-def get_images_to_push():
-    """从数据库获取需要推送的镜像列表"""
-    connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
+STAGE_CLOCK = StageClock()
+
+class PullBudget:
+    """线程安全的Docker Hub拉取额度，remaining为None时表示不受限制"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.remaining = None
+        self.limit = None
+        self.used = 0
+
+    def set(self, remaining, limit):
+        with self._lock:
+            self.remaining = remaining
+            self.limit = limit
+
+    def acquire(self, count=1, exhaust=True):
+        """占用count次拉取额度，额度不足时返回False，exhaust为True时同时视为额度耗尽"""
+        with self._lock:
+            if self.remaining is not None:
+                if self.remaining < count:
+                    if exhaust:
+                        self.remaining = 0
+                    return False
+                self.remaining -= count
+            self.used += count
+            return True
+
+    def exhaust(self):
+        """Docker Hub返回429时调用，本次运行不再拉取Docker Hub镜像"""
+        with self._lock:
+            self.remaining = 0
+
+    @property
+    def exhausted(self):
+        with self._lock:
+            return self.remaining is not None and self.remaining <= 0
+
+HUB_BUDGET = PullBudget()
+
+# 通过 docker.sock 访问Docker守护进程，每个线程复用一个连接
+DOCKER = DockerClient()
+
+DISK_BUDGET = DiskBudget(DOCKER, '/', MIN_FREE_SPACE_GB)
+
+def log(message):
+    """输出日志；并发模式下写入当前镜像的日志缓冲，处理结束后整体输出"""
+    buffer = getattr(_log_context, 'buffer', None)
+    if buffer is not None:
+        buffer.append(str(message))
+        return
+    with _print_lock:
+        print(message, flush=True)
+
+def default_worker_id():
+    """默认的worker标识：主机名、进程号，以及GitHub Actions中的运行编号"""
+    parts = [socket.gethostname(), str(os.getpid())]
+    if os.environ.get('GITHUB_RUN_ID'):
+        parts.insert(0, f"gh{os.environ['GITHUB_RUN_ID']}-{os.environ.get('GITHUB_RUN_ATTEMPT', '1')}")
+    return '-'.join(parts)[:128]
+
+def schedule_order(policy=DEFAULT_SCHEDULE, aging_minutes=DEFAULT_AGING_MINUTES):
+    """返回调度策略对应的ORDER BY子句"""
+    if policy == 'fifo':
+        return 'id'
+    effective = 'priority'
+    if aging_minutes > 0:
+        effective = f"priority + FLOOR(TIMESTAMPDIFF(MINUTE, {ENQUEUED_AT}, NOW()) / {int(aging_minutes)})"
+    if policy == 'priority':
+        return f"{effective} DESC, id"
+    return f"{effective} DESC, COALESCE(estimated_size, {DEFAULT_ESTIMATED_SIZE}), id"
+
+def get_images_to_push(worker_id, limit, lease_seconds=DEFAULT_LEASE_SECONDS,
+                       skip_docker_hub=False, prioritize=False, order='id'):
+    """以租约方式领取需要推送的镜像
     
+    使用 SELECT ... FOR UPDATE SKIP LOCKED 领取未被其他runner持有（或租约已过期）的行，
+    并写入worker标识和租约到期时间，多个runner可以安全地并行消费同一个队列。
+    order为schedule_order()返回的领取顺序；skip_docker_hub为True时不领取Docker Hub镜像；
+    prioritize为True时先按PRIORITY_ORDER领取。领取时记录每个镜像的排队等待时间
+    """
+    conditions = ''
+    if skip_docker_hub:
+        conditions = f"AND source_registry_url NOT IN ({', '.join(['%s'] * len(DOCKER_HUB_ALIASES))})"
+    if prioritize:
+        order = f"{PRIORITY_ORDER}, {order}"
     try:
-        # 初始化数据库和表
-        from init_db import init_database
-        init_database()
-        
-        # 获取待推送的镜像
-        cursor.execute("""
-        SELECT id, source_registry_url, orig_name_space, orig_image_name, platform
-        FROM images_for_push
-        WHERE push_status = 0
-        """)
-        images = cursor.fetchall()
-        return images
+        with db_cursor(dictionary=True, commit=True) as cursor:
+            cursor.execute(f"""
+            SELECT id, source_registry_url, orig_name_space, orig_image_name, platform, attempt_count,
+                   priority, estimated_size, TIMESTAMPDIFF(SECOND, {ELIGIBLE_SINCE}, NOW()) AS queue_wait_seconds
+            FROM images_for_push
+            WHERE push_status = 0 AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+              AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
+              {conditions}
+            ORDER BY {order}
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """, (DOCKER_HUB_ALIASES if skip_docker_hub else ()) + (limit,))
+            images = cursor.fetchall()
+            if images:
+                ids = [image['id'] for image in images]
+                placeholders = ', '.join(['%s'] * len(ids))
+                cursor.execute(f"""
+                UPDATE images_for_push
+                SET lease_owner = %s, lease_expires_at = NOW() + INTERVAL %s SECOND,
+                    queue_wait_seconds = TIMESTAMPDIFF(SECOND, {ELIGIBLE_SINCE}, NOW())
+                WHERE id IN ({placeholders})
+                """, [worker_id, lease_seconds] + ids)
+            return images
     except Error as e:
         print(f"查询数据库错误: {e}")
         return []
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+
+def renew_leases(worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """延长当前worker持有的所有租约，避免长时间同步的镜像被其他runner重复领取"""
+    try:
+        with db_cursor(commit=True) as cursor:
+            cursor.execute("""
+            UPDATE images_for_push
+            SET lease_expires_at = NOW() + INTERVAL %s SECOND
+            WHERE lease_owner = %s AND push_status = 0
+            """, (lease_seconds, worker_id))
+    except Error as e:
+        log(f"续租错误: {e}")
+
+def release_lease(image_id):
+    """释放租约但不改变推送状态，让该镜像可以被重新领取（批量写入）"""
+    STATUS_WRITER.add("""
+    UPDATE images_for_push SET lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = %s
+    """, (image_id,))
+
+def count_pending_docker_hub():
+    """统计队列中待推送的Docker Hub镜像数量"""
+    try:
+        with db_cursor() as cursor:
+            cursor.execute(f"""
+            SELECT COUNT(*) FROM images_for_push
+            WHERE push_status = 0 AND source_registry_url IN ({', '.join(['%s'] * len(DOCKER_HUB_ALIASES))})
+            """, DOCKER_HUB_ALIASES)
+            return cursor.fetchone()[0]
+    except Error as e:
+        print(f"查询待推送镜像错误: {e}")
+        return 0
+
+def next_retry_delay(skip_docker_hub=False):
+    """距离最早一个待重试镜像到期的秒数，没有待重试镜像时返回None
+    
+    skip_docker_hub为True时不考虑Docker Hub镜像，与get_images_to_push的领取条件保持一致，
+    否则额度耗尽后到期的Docker Hub镜像会让调度循环不停地空转
+    """
+    conditions = ''
+    if skip_docker_hub:
+        conditions = f"AND source_registry_url NOT IN ({', '.join(['%s'] * len(DOCKER_HUB_ALIASES))})"
+    try:
+        with db_cursor() as cursor:
+            cursor.execute(f"""
+            SELECT TIMESTAMPDIFF(SECOND, NOW(), MIN(next_attempt_at)) FROM images_for_push
+            WHERE push_status = 0 AND next_attempt_at IS NOT NULL
+              AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+              {conditions}
+            """, DOCKER_HUB_ALIASES if skip_docker_hub else ())
+            delay = cursor.fetchone()[0]
+            return None if delay is None else max(0, int(delay))
+    except Error as e:
+        print(f"查询待重试镜像错误: {e}")
+        return None
+
+def start_lease_heartbeat(worker_id, lease_seconds, stop_event):
+    """后台定期续租，直到stop_event被设置"""
+    def heartbeat():
+        while not stop_event.wait(lease_seconds / 3):
+            renew_leases(worker_id, lease_seconds)
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    return thread
 
 def is_image_pushed(orig_image_name, target_registry_url):
     """检查镜像是否已经推送到目标仓库"""
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
     try:
-        cursor.execute("""
-        SELECT COUNT(*) FROM pushed_images 
-        WHERE orig_image_name = %s AND target_registry_url = %s
-        """, (orig_image_name, target_registry_url))
-        
-        count = cursor.fetchone()[0]
-        return count > 0
+        with db_cursor() as cursor:
+            cursor.execute("""
+            SELECT COUNT(*) FROM pushed_images 
+            WHERE orig_image_name = %s AND target_registry_url = %s AND push_status = 1
+            """, (orig_image_name, target_registry_url))
+            
+            count = cursor.fetchone()[0]
+            return count > 0
     except Error as e:
-        print(f"查询已推送镜像错误: {e}")
+        log(f"查询已推送镜像错误: {e}")
         return False
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
 
-def format_registry_image_name(source_registry_url, orig_name_space, orig_image_name, target_registry_url, targ_name_space):
-    """格式化目标仓库中的镜像名称"""
+def parse_target_reference(orig_image_name, targ_name_space):
+    """计算目标仓库中的仓库路径和标签"""
     # 提取镜像名和标签
     if ':' in orig_image_name:
         image_name, tag = orig_image_name.split(':', 1)
@@ -87,105 +365,434 @@ def format_registry_image_name(source_registry_url, orig_name_space, orig_image_
         # 对于类似 kube-state-metrics/kube-state-metrics 的情况，只保留最后一部分
         image_name = image_name.split('/')[-1]
     
+    return f"{targ_name_space}/{image_name}", tag
+
+def format_registry_image_name(source_registry_url, orig_name_space, orig_image_name, target_registry_url, targ_name_space):
+    """格式化目标仓库中的镜像名称"""
+    repository, tag = parse_target_reference(orig_image_name, targ_name_space)
+    
     # 构建完整的目标镜像名
-    registry_image_name = f"{target_registry_url}/{targ_name_space}/{image_name}:{tag}"
+    registry_image_name = f"{target_registry_url}/{repository}:{tag}"
     
     return registry_image_name
 
+def parse_source_reference(orig_name_space, orig_image_name):
+    """计算源仓库中的仓库路径和引用（标签或摘要）"""
+    if '@' in orig_image_name:
+        image_name, reference = orig_image_name.split('@', 1)
+    elif ':' in orig_image_name:
+        image_name, reference = orig_image_name.split(':', 1)
+    else:
+        image_name, reference = orig_image_name, 'latest'
+    repository = f"{orig_name_space}/{image_name}" if orig_name_space else image_name
+    return repository, reference
+
 def get_image_info(image_name):
-    """获取镜像大小和摘要信息"""
+    """获取镜像大小和摘要信息（一次inspect请求）"""
     try:
-        # 获取镜像大小
-        size_cmd = f"docker image inspect {image_name} --format='{{{{.Size}}}}'"
-        size_output = subprocess.check_output(size_cmd, shell=True).decode('utf-8').strip()
-        # 转换为浮点数，单位为MB
-        size_mb = float(size_output) / (1024 * 1024)
-        
-        # 获取镜像摘要
-        digest_cmd = f"docker image inspect {image_name} --format='{{{{.RepoDigests}}}}'"
-        digest_output = subprocess.check_output(digest_cmd, shell=True).decode('utf-8').strip()
-        # 提取摘要部分
-        digest_match = re.search(r'sha256:[a-f0-9]+', digest_output)
-        digest = digest_match.group(0) if digest_match else ""
-        
-        return size_mb, digest
-    except subprocess.CalledProcessError as e:
-        print(f"获取镜像信息错误: {e}")
+        info = DOCKER.inspect_image(image_name)
+    except DockerError as e:
+        log(f"获取镜像信息错误: {e}")
         return 0.0, "未知"
+    # 转换为浮点数，单位为MB
+    size_mb = float(info.get('Size', 0)) / (1024 * 1024)
+    # 优先使用该仓库对应的摘要
+    repository = image_name.split('@')[0].rsplit(':', 1)[0] if '/' in image_name else image_name
+    repo_digests = info.get('RepoDigests') or []
+    matched = [d for d in repo_digests if d.startswith(repository + '@')] or repo_digests
+    digest = matched[0].split('@', 1)[1] if matched else ""
+    return size_mb, digest
 
 def record_pushed_image(source_registry_url, target_registry_url, orig_name_space, 
                         orig_image_name, targ_name_space, registry_image_name, 
-                        image_size, digest, platform):
-    """记录已推送的镜像信息"""
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    
+                        image_size, digest, platform, source_digest=None):
+    """记录已推送的镜像信息；同一目标镜像重新推送时更新原有记录（批量写入）"""
+    STATUS_WRITER.add("""
+    INSERT INTO pushed_images 
+    (source_registry_url, target_registry_url, orig_name_space, orig_image_name, 
+     targ_name_space, registry_image_name, push_status, image_size, image_size_unit, digest,
+     source_digest, platform)
+    VALUES (%s, %s, %s, %s, %s, %s, 1, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE
+        push_status = 1, push_time = CURRENT_TIMESTAMP, image_size = VALUES(image_size),
+        digest = VALUES(digest), source_digest = VALUES(source_digest), platform = VALUES(platform)
+    """, (
+        source_registry_url, target_registry_url, orig_name_space, orig_image_name,
+        targ_name_space, registry_image_name, image_size, 'MB', digest, source_digest, platform
+    ))
+
+def record_push_failure(image, context):
+    """记录推送到某个目标仓库失败（push_status = 0），已有的成功记录保留原摘要以便下次重新同步（批量写入）"""
+    STATUS_WRITER.add("""
+    INSERT INTO pushed_images 
+    (source_registry_url, target_registry_url, orig_name_space, orig_image_name, 
+     targ_name_space, registry_image_name, push_status, platform)
+    VALUES (%s, %s, %s, %s, %s, %s, 0, %s)
+    ON DUPLICATE KEY UPDATE push_status = 0, push_time = CURRENT_TIMESTAMP
+    """, (
+        image['source_registry_url'], context['registry_url'], image['orig_name_space'],
+        image['orig_image_name'], context['name_space'], context['registry_image_name'], image['platform']
+    ))
+
+def get_pushed_record(target_registry_url, registry_image_name):
+    """获取目标镜像的推送记录，返回包含digest、source_digest、image_size的字典或None"""
     try:
-        cursor.execute("""
-        INSERT INTO pushed_images 
-        (source_registry_url, target_registry_url, orig_name_space, orig_image_name, 
-         targ_name_space, registry_image_name, push_status, image_size, image_size_unit, digest, platform)
-        VALUES (%s, %s, %s, %s, %s, %s, 1, %s, %s, %s, %s)
-        """, (
-            source_registry_url, target_registry_url, orig_name_space, orig_image_name,
-            targ_name_space, registry_image_name, image_size, 'MB', digest, platform
-        ))
-        connection.commit()
+        with db_cursor(dictionary=True) as cursor:
+            cursor.execute("""
+            SELECT digest, source_digest, image_size FROM pushed_images
+            WHERE target_registry_url = %s AND registry_image_name = %s AND push_status = 1
+            """, (target_registry_url, registry_image_name))
+            return cursor.fetchone()
     except Error as e:
-        print(f"记录已推送镜像错误: {e}")
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        log(f"查询推送记录错误: {e}")
+        return None
 
 def update_push_status(image_id):
-    """更新images_for_push表中的推送状态"""
-    connection = get_db_connection()
-    cursor = connection.cursor()
+    """更新images_for_push表中的推送状态（批量写入）"""
+    STATUS_WRITER.add("""
+    UPDATE images_for_push
+    SET push_status = 1, last_error = NULL, next_attempt_at = NULL, lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = %s
+    """, (image_id,))
+
+def is_transient_error(error):
+    """判断错误是否可能通过重试恢复：网络错误、仓库5xx、限流等为暂时性错误，镜像不存在、认证失败、
+    无权访问等为永久性错误（令牌过期已在RegistryClient中重新认证一次）
+    """
+    if isinstance(error, PermanentRegistryError):
+        return False
+    if isinstance(error, RegistryError) and error.status_code is not None:
+        return error.status_code in (408, 429) or error.status_code >= 500
+    if isinstance(error, requests.RequestException):
+        return True
+    text = str(error).lower()
+    return not any(pattern in text for pattern in PERMANENT_ERROR_PATTERNS)
+
+def retry_delay(attempt):
+    """第attempt次失败后的重试间隔：指数退避并加入随机抖动，避免多个镜像同时重试"""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return int(random.uniform(delay / 2, delay))
+
+def schedule_retry(image, errors):
+    """记录失败并安排重试；全部为永久性错误或超过最大尝试次数时标记为失败（批量写入）"""
+    attempt = (image.get('attempt_count') or 0) + 1
+    message = '; '.join(str(error) for error in errors)[:1024]
+    transient = any(is_transient_error(error) for error in errors)
+    if transient and attempt < MAX_ATTEMPTS:
+        delay = retry_delay(attempt)
+        log(f"镜像 {image['orig_image_name']} 第 {attempt} 次同步失败，{delay} 秒后重试")
+        RUN_STATS.add('retry_scheduled')
+        push_status = 0
+    else:
+        reason = '永久性错误' if not transient else f'已失败 {attempt} 次'
+        log(f"镜像 {image['orig_image_name']} 同步失败（{reason}），不再重试: {message}")
+        RUN_STATS.add('gave_up')
+        delay = 0
+        push_status = 2
+    image['result'] = 'error'
+    STATUS_WRITER.add("""
+    UPDATE images_for_push
+    SET push_status = %s, attempt_count = %s, last_error = %s, next_attempt_at = NOW() + INTERVAL %s SECOND,
+        lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = %s
+    """, (push_status, attempt, message, delay, image['id']))
+
+def check_docker_hub_rate_limit(stage):
+    """用HEAD请求读取Docker Hub拉取额度并输出，返回(剩余次数, 上限)"""
+    try:
+        remaining, limit = get_registry_client('docker.io').rate_limit()
+    except (RegistryError, requests.RequestException) as e:
+        print(f"获取Docker Hub拉取额度失败（{stage}）: {e}")
+        return None, None
+    if remaining is None:
+        print(f"Docker Hub拉取额度（{stage}）: 不受限制")
+    else:
+        print(f"Docker Hub拉取额度（{stage}）: 剩余 {remaining}/{limit}")
+    return remaining, limit
+
+def estimate_hub_pulls(platform):
+    """估算同步一个镜像消耗的Docker Hub拉取次数
+    
+    Docker Hub把最多两次清单GET计为一次拉取；多平台镜像需要获取索引和每个平台的清单
+    """
+    if not is_multi_platform(platform):
+        return 1
+    platforms = parse_platforms(platform)
+    count = len(platforms) if platforms is not None else ESTIMATED_ALL_PLATFORMS
+    return (count + 2) // 2
+
+def is_hub_rate_limited(error):
+    """判断错误是否为Docker Hub拉取次数超限"""
+    if isinstance(error, DockerError):
+        return 'toomanyrequests' in str(error).lower()
+    return isinstance(error, RegistryError) and error.status_code == 429 and 'docker.io' in str(error)
+
+def acquire_hub_pulls(image):
+    """从Docker Hub拉取前占用额度；额度不足时释放租约，留给之后的运行"""
+    if not is_docker_hub(image['source_registry_url']):
+        return True
+    if HUB_BUDGET.acquire(estimate_hub_pulls(image['platform'])):
+        return True
+    defer_rate_limited(image)
+    return False
+
+def defer_rate_limited(image):
+    """Docker Hub额度耗尽，推迟该镜像，不计入失败次数"""
+    log(f"Docker Hub拉取额度不足，推迟镜像 {image['orig_image_name']} 到之后的运行")
+    RUN_STATS.add('rate_limited')
+    image['result'] = 'deferred'
+    release_lease(image['id'])
+
+def defer_image(image, delay):
+    """推迟镜像到delay秒之后再领取，不改变推送状态，也不计入失败次数（批量写入）"""
+    image['result'] = 'deferred'
+    STATUS_WRITER.add("""
+    UPDATE images_for_push
+    SET next_attempt_at = NOW() + INTERVAL %s SECOND, lease_owner = NULL, lease_expires_at = NULL
+    WHERE id = %s
+    """, (delay, image['id']))
+
+def estimate_image_bytes(image, contexts):
+    """估算镜像拉取后占用的磁盘空间（字节），无法估算时返回None
+    
+    优先使用上次推送记录的实际大小；否则读取清单中各层压缩后的大小，按解压比例估算
+    """
+    for context in contexts:
+        record = get_pushed_record(context['registry_url'], context['registry_image_name'])
+        if record and record['image_size']:
+            return int(float(record['image_size']) * 1024 * 1024)
+    if image.get('estimated_size'):
+        # 入队后已估算过大小，不必再读取清单
+        return int(image['estimated_size'])
     
+    # 读取Docker Hub清单会消耗拉取额度，额度不足时不估算
+    if is_docker_hub(image['source_registry_url']) and not HUB_BUDGET.acquire(exhaust=False):
+        return None
+    source_repo, reference = parse_source_reference(image['orig_name_space'], image['orig_image_name'])
+    try:
+        compressed = image_compressed_size(get_registry_client(image['source_registry_url']),
+                                           source_repo, reference, image['platform'])
+    except (RegistryError, requests.RequestException) as e:
+        log(f"读取镜像清单大小失败: {e}")
+        return None
+    log(f"镜像各层压缩大小: {compressed / GB:.2f}GB")
+    return int(compressed * UNCOMPRESSED_RATIO)
+
+def docker_hub_tag_size(namespace, image_name, platform):
+    """通过Docker Hub网站API读取标签的压缩大小，不消耗拉取额度；无法读取时返回None"""
+    repository, _, tag = image_name.partition(':')
+    url = DOCKER_HUB_TAG_API.format(namespace=namespace or 'library', repository=repository, tag=tag or 'latest')
+    response = requests.get(url, timeout=30)
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    platform_parts = (platform.split(',')[0].split('/') + [None, None])[:2]
+    for entry in data.get('images') or []:
+        if [entry.get('os'), entry.get('architecture')] == platform_parts and entry.get('size'):
+            return entry['size']
+    return data.get('full_size')
+
+def estimate_compressed_size(image):
+    """估算待推送镜像各层压缩后的总字节数，无法估算时返回None"""
+    platform = image['platform']
+    count = 1
+    if is_multi_platform(platform):
+        # 多平台镜像按第一个平台的大小乘以平台数估算
+        platforms = parse_platforms(platform)
+        count = len(platforms) if platforms is not None else ESTIMATED_ALL_PLATFORMS
+        platform = platforms[0] if platforms else 'linux/amd64'
     try:
-        cursor.execute("""
-        UPDATE images_for_push SET push_status = 1
-        WHERE id = %s
-        """, (image_id,))
-        connection.commit()
+        if is_docker_hub(image['source_registry_url']):
+            size = docker_hub_tag_size(image['orig_name_space'], image['orig_image_name'], platform)
+        else:
+            source_repo, reference = parse_source_reference(image['orig_name_space'], image['orig_image_name'])
+            size = image_compressed_size(get_registry_client(image['source_registry_url']),
+                                         source_repo, reference, platform)
+    except (RegistryError, requests.RequestException, ValueError) as e:
+        log(f"估算镜像 {image['orig_image_name']} 大小失败: {e}")
+        return None
+    return size * count if size else None
+
+def estimate_queue_sizes(limit=ESTIMATE_BATCH_SIZE):
+    """为还没有大小估算的待推送镜像估算解压后的大小（estimated_size），供按大小调度使用
+    
+    先使用pushed_images中上次推送的实际大小；其余读取清单中各层的压缩大小按解压比例估算，
+    Docker Hub镜像改用网站API读取，不消耗拉取额度
+    """
+    try:
+        with db_cursor(dictionary=True, commit=True) as cursor:
+            cursor.execute("""
+            UPDATE images_for_push q
+            JOIN (
+                SELECT source_registry_url, orig_name_space, orig_image_name, MAX(image_size) AS image_size
+                FROM pushed_images WHERE push_status = 1 AND image_size > 0
+                GROUP BY source_registry_url, orig_name_space, orig_image_name
+            ) p ON p.source_registry_url = q.source_registry_url AND p.orig_name_space = q.orig_name_space
+                AND p.orig_image_name = q.orig_image_name
+            SET q.estimated_size = p.image_size * 1024 * 1024
+            WHERE q.push_status = 0 AND q.estimated_size IS NULL
+            """)
+            cursor.execute("""
+            SELECT id, source_registry_url, orig_name_space, orig_image_name, platform FROM images_for_push
+            WHERE push_status = 0 AND estimated_size IS NULL
+              AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+            ORDER BY id LIMIT %s
+            """, (limit,))
+            images = cursor.fetchall()
     except Error as e:
-        print(f"更新推送状态错误: {e}")
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+        log(f"估算镜像大小错误: {e}")
+        return
+    if not images:
+        return
+    
+    with ThreadPoolExecutor(max_workers=min(8, len(images))) as executor:
+        sizes = list(executor.map(estimate_compressed_size, images))
+    rows = [(int(size * UNCOMPRESSED_RATIO), image['id']) for image, size in zip(images, sizes) if size]
+    if not rows:
+        return
+    try:
+        with db_cursor(commit=True) as cursor:
+            cursor.executemany("UPDATE images_for_push SET estimated_size = %s WHERE id = %s", rows)
+        log(f"已估算 {len(rows)} 个待推送镜像的大小")
+    except Error as e:
+        log(f"记录镜像大小错误: {e}")
+
+def finish_image(image, errors):
+    """所有目标都成功时标记为已推送，否则安排重试"""
+    if errors:
+        schedule_retry(image, errors)
+    else:
+        update_push_status(image['id'])
 
 def get_available_disk_space(path="/"):
     """获取可用磁盘空间（GB）"""
     try:
-        import shutil
         total, used, free = shutil.disk_usage(path)
         return free / (1024 * 1024 * 1024)  # 转换为GB
     except Exception as e:
-        print(f"获取磁盘空间错误: {e}")
+        log(f"获取磁盘空间错误: {e}")
         return 0
 
 def clean_docker_images():
     """清理未使用的Docker镜像"""
-    try:
-        print("清理未使用的Docker镜像...")
-        # 首先尝试删除悬空镜像（dangling images）
-        subprocess.run("docker image prune -f", shell=True, check=True)
+    # 多个worker同时触发prune时docker会报错，这里串行执行
+    with _disk_lock:
+        try:
+            log("清理未使用的Docker镜像...")
+            # 删除悬空镜像（dangling images）
+            reclaimed = DOCKER.prune_images()
+            
+            # 获取清理后的可用空间
+            free_space = get_available_disk_space()
+            log(f"清理完成，释放 {reclaimed / GB:.2f}GB，当前可用磁盘空间: {free_space:.2f}GB")
+            return free_space
+        except DockerError as e:
+            log(f"清理Docker镜像错误: {e}")
+            return 0
+
+def is_multi_platform(platform):
+    """platform为all或逗号分隔的多个平台时表示需要同步多平台镜像"""
+    return platform == 'all' or ',' in (platform or '')
+
+def parse_platforms(platform):
+    """解析多平台配置，all返回None表示全部平台"""
+    if platform == 'all':
+        return None
+    return [p.strip() for p in platform.split(',') if p.strip()]
+
+def get_target_config(target, orig_name_space):
+    """获取目标仓库信息，返回(仓库地址, 用户名, 密码, 命名空间)"""
+    if target == 'aliyun':
+        target_registry_url = os.environ.get('ALIYUN_REGISTRY')
+        registry_user = os.environ.get('ALIYUN_REGISTRY_USER')
+        registry_password = os.environ.get('ALIYUN_REGISTRY_PASSWORD')
+        targ_name_space = os.environ.get('ALIYUN_NAME_SPACE')
+    else:  # private
+        target_registry_url = os.environ.get('MY_REGISTRY')
+        registry_user = os.environ.get('MY_REGISTRY_USER')
+        registry_password = os.environ.get('MY_REGISTRY_PASSWORD')
+        targ_name_space = orig_name_space
+    
+    # 移除URL中的协议部分
+    target_registry_url = re.sub(r'^https?://', '', target_registry_url)
+    return target_registry_url, registry_user, registry_password, targ_name_space
+
+def plan_targets(image, targets):
+    """为每个目标仓库计算目标镜像名并做预检，返回需要同步的目标列表"""
+    pending = []
+    for target in targets:
+        # 设置目标仓库信息
+        target_registry_url, registry_user, registry_password, targ_name_space = \
+            get_target_config(target, image['orig_name_space'])
         
-        # 如果空间仍然不足，可以考虑删除所有未使用的镜像
-        # subprocess.run("docker image prune -a -f", shell=True, check=True)
+        # 格式化目标镜像名
+        registry_image_name = format_registry_image_name(
+            image['source_registry_url'], image['orig_name_space'], image['orig_image_name'],
+            target_registry_url, targ_name_space
+        )
         
-        # 获取清理后的可用空间
-        free_space = get_available_disk_space()
-        print(f"清理完成，当前可用磁盘空间: {free_space:.2f}GB")
-        return free_space
-    except subprocess.CalledProcessError as e:
-        print(f"清理Docker镜像错误: {e}")
-        return 0
+        # 预检：源和目标清单摘要均未变化时跳过，无需拉取
+        skip, source_digest = preflight_check(image, target_registry_url, registry_user, registry_password,
+                                              targ_name_space, registry_image_name)
+        if skip:
+            continue
+        
+        target_repo, tag = parse_target_reference(image['orig_image_name'], targ_name_space)
+        pending.append({
+            'target': target,
+            'registry_url': target_registry_url,
+            'user': registry_user,
+            'password': registry_password,
+            'name_space': targ_name_space,
+            'registry_image_name': registry_image_name,
+            'repository': target_repo,
+            'tag': tag,
+            'source_digest': source_digest,
+        })
+    return pending
+
+def run_per_target(func, contexts):
+    """对每个目标并发执行func(context)，各目标的日志分别缓存后依次输出，返回 {目标: 结果}"""
+    if len(contexts) == 1:
+        return {contexts[0]['target']: func(contexts[0])}
+    
+    results = {}
+    logs = {}
+    
+    def worker(context):
+        _log_context.buffer = logs[context['target']] = []
+        try:
+            results[context['target']] = func(context)
+        except Exception as e:
+            log(f"同步到 {context['target']} 时发生未预期的错误: {e}")
+            results[context['target']] = False
+        finally:
+            _log_context.buffer = None
+    
+    with ThreadPoolExecutor(max_workers=len(contexts)) as executor:
+        list(executor.map(worker, contexts))
+    for context in contexts:
+        log(f"----- 目标 {context['target']} -----")
+        for line in logs[context['target']]:
+            log(line)
+    return results
+
+def format_layer_summary(progress):
+    """把各层的完成状态汇总为一行，如 Pull complete: 3, Already exists: 5"""
+    counts = progress.summary()
+    return ', '.join(f"{status}: {count}" for status, count in sorted(counts.items())) or '无新层'
+
+def pull_and_push_image(image, targets):
+    """拉取一次镜像并推送到所有目标仓库"""
+    job = fetch_image(image, targets)
+    if job is not None:
+        publish_image(job)
 
-def pull_and_push_image(image, target):
-    """拉取并推送镜像"""
+def fetch_image(image, targets):
+    """拉取阶段：预检、预留磁盘空间并拉取镜像，返回推送阶段需要的信息
+    
+    镜像已经处理结束（跳过、拉取失败、推迟或改用仓库直连复制）时返回None
+    """
     source_registry_url = image['source_registry_url']
     orig_name_space = image['orig_name_space']
     orig_image_name = image['orig_image_name']
@@ -197,114 +804,684 @@ def pull_and_push_image(image, target):
     else:
         source_image = f"{source_registry_url}/{orig_name_space}/{orig_image_name}"
     
-    print(f"处理镜像: {source_image}, 平台: {platform}")
-    
-    # 检查磁盘空间
-    free_space = get_available_disk_space()
-    print(f"当前可用磁盘空间: {free_space:.2f}GB")
+    # docker pull 只能拉取单个平台，多平台镜像改用仓库直连复制
+    if is_multi_platform(platform):
+        log(f"镜像 {source_image} 需要同步多个平台 ({platform})，改用仓库直连复制")
+        copy_image_via_registry(image, targets)
+        return None
     
-    # 如果可用空间小于5GB，尝试清理
-    if free_space < 5:
-        free_space = clean_docker_images()
-        if free_space < 5:
-            print(f"警告: 磁盘空间不足 ({free_space:.2f}GB)，可能影响镜像拉取")
+    log(f"处理镜像: {source_image}, 平台: {platform}, 目标: {', '.join(targets)}")
     
-    # 设置目标仓库信息
-    if target == 'aliyun':
-        target_registry_url = os.environ.get('ALIYUN_REGISTRY')
-        registry_user = os.environ.get('ALIYUN_REGISTRY_USER')
-        registry_password = os.environ.get('ALIYUN_REGISTRY_PASSWORD')
-        targ_name_space = os.environ.get('ALIYUN_NAME_SPACE')
-    else:  # private
-        target_registry_url = os.environ.get('MY_REGISTRY')
-        registry_user = os.environ.get('MY_REGISTRY_USER')
-        registry_password = os.environ.get('MY_REGISTRY_PASSWORD')
-        targ_name_space = orig_name_space
+    # 预检各目标，全部未变化时无需拉取
+    with METRICS.phase(image, 'preflight'):
+        contexts = plan_targets(image, targets)
+    if not contexts:
+        image['result'] = 'skipped'
+        update_push_status(image['id'])
+        return None
     
-    # 移除URL中的协议部分
-    target_registry_url = re.sub(r'^https?://', '', target_registry_url)
+    # 占用Docker Hub拉取额度，不足时推迟
+    if not acquire_hub_pulls(image):
+        return None
     
-    # 检查镜像是否已推送
-    if is_image_pushed(orig_image_name, target_registry_url):
-        print(f"镜像 {orig_image_name} 已经推送到 {target_registry_url}，跳过")
-        return
+    # 按预计大小预留磁盘空间，不足时删除已推送的镜像或等待其他镜像完成
+    with METRICS.phase(image, 'disk_reserve'):
+        expected_bytes = estimate_image_bytes(image, contexts)
+        free_after = DISK_BUDGET.reserve(image['id'], expected_bytes or 0, log=log)
+    expected = f"{expected_bytes / GB:.2f}GB" if expected_bytes is not None else "未知"
+    log(f"磁盘: 预计需要 {expected}，预留后可用 {free_after / GB:.2f}GB，"
+        f"余量 {(free_after - DISK_BUDGET.headroom) / GB:.2f}GB")
     
+    started = time.time()
+    progress = LayerProgress(log)
     try:
-        # 拉取镜像
-        pull_cmd = f"docker pull --platform={platform} {source_image}"
-        print(f"拉取镜像: {pull_cmd}")
-        subprocess.run(pull_cmd, shell=True, check=True)
-        
-        # 登录目标仓库
-        login_cmd = f"docker login {target_registry_url} -u {registry_user} -p {registry_password}"
-        print(f"登录仓库: {target_registry_url}")
-        subprocess.run(login_cmd, shell=True, check=True)
-        
-        # 格式化目标镜像名
-        registry_image_name = format_registry_image_name(
-            source_registry_url, orig_name_space, orig_image_name, 
-            target_registry_url, targ_name_space
-        )
+        # 拉取镜像，所有目标共用这一次拉取
+        log(f"拉取镜像: {source_image}（{platform}）")
+        with STAGE_CLOCK.stage('pull'):
+            DOCKER.pull_image(source_image, platform, on_event=progress)
+        log(f"拉取完成: {format_layer_summary(progress)}")
+    except DockerError as e:
+        log(f"拉取镜像 {source_image} 时出错: {e}")
+        METRICS.record(image, 'pull', time.time() - started, transferred=progress.transferred(), status='error')
+        DISK_BUDGET.release(image['id'])
+        if is_hub_rate_limited(e):
+            # 额度已耗尽，本次运行不再拉取Docker Hub镜像
+            HUB_BUDGET.exhaust()
+            defer_rate_limited(image)
+            return None
+        # 如果是磁盘空间不足导致的错误，尝试清理后推迟该镜像，不计为失败
+        if "no space left on device" in str(e).lower():
+            log("检测到磁盘空间不足，尝试清理...")
+            clean_docker_images()
+            log(f"镜像 {image['orig_image_name']} 推迟 {DISK_FULL_RETRY_SECONDS} 秒后再同步")
+            defer_image(image, DISK_FULL_RETRY_SECONDS)
+            return None
         
-        # 标记镜像
-        tag_cmd = f"docker tag {source_image} {registry_image_name}"
-        print(f"标记镜像: {tag_cmd}")
-        subprocess.run(tag_cmd, shell=True, check=True)
+        RUN_STATS.add('failed', len(contexts))
+        for context in contexts:
+            record_push_failure(image, context)
         
-        # 推送镜像
-        push_cmd = f"docker push {registry_image_name}"
-        print(f"推送镜像: {push_cmd}")
-        subprocess.run(push_cmd, shell=True, check=True)
+        # 其他错误，按错误类型安排重试或标记为失败
+        schedule_retry(image, [e])
+        return None
+    except BaseException:
+        # 非Docker错误（如连接中断）由run_guarded处理，预留的空间必须归还，否则后续拉取会一直等待
+        DISK_BUDGET.release(image['id'])
+        raise
+    pull_seconds = time.time() - started
+    METRICS.record(image, 'pull', pull_seconds, transferred=progress.transferred())
+    DISK_BUDGET.commit(image['id'])
+    return {
+        'image': image,
+        'source_image': source_image,
+        'contexts': contexts,
+        'expected_bytes': expected_bytes,
+        'pull_seconds': pull_seconds,
+        'pulled_at': time.time(),
+    }
+
+def publish_image(job):
+    """推送阶段：把拉取阶段已拉取的镜像推送到所有目标仓库，并更新推送状态"""
+    image = job['image']
+    source_image = job['source_image']
+    contexts = job['contexts']
+    pull_seconds = job['pull_seconds']
+    source_registry_url = image['source_registry_url']
+    orig_name_space = image['orig_name_space']
+    orig_image_name = image['orig_image_name']
+    platform = image['platform']
+    waited = time.time() - job['pulled_at']
+    if waited >= 1:
+        log(f"镜像 {source_image} 拉取完成后等待推送 {waited:.1f} 秒")
+    
+    def push_to_target(context):
+        push_started = time.time()
+        registry_image_name = context['registry_image_name']
+        try:
+            # 标记镜像
+            log(f"标记镜像: {source_image} -> {registry_image_name}")
+            with METRICS.phase(image, 'tag', context['target']):
+                DOCKER.tag_image(source_image, registry_image_name)
+            
+            # 推送镜像，凭据通过X-Registry-Auth头传给守护进程，无需docker login
+            log(f"推送镜像: {registry_image_name}")
+            auth = registry_auth_header(context['user'], context['password'], context['registry_url'])
+            progress = LayerProgress(log)
+            with METRICS.phase(image, 'push', context['target']) as event:
+                DOCKER.push_image(registry_image_name, auth, on_event=progress)
+                event['bytes'] = progress.transferred()
+            log(f"推送完成: {format_layer_summary(progress)}")
+        except DockerError as e:
+            log(f"推送镜像 {registry_image_name} 时出错: {e}")
+            RUN_STATS.add('failed')
+            record_push_failure(image, context)
+            context['error'] = e
+            return False
         
-        # 获取镜像信息 - 这里image_size现在是浮点数
-        image_size, digest = get_image_info(registry_image_name)
+        with METRICS.phase(image, 'inspect', context['target']):
+            # 获取镜像信息 - 这里image_size现在是浮点数
+            image_size, digest = get_image_info(registry_image_name)
+            context['image_size'] = image_size
+            
+            # 以目标仓库实际的清单摘要为准，供下次预检对比；推送结果中没有摘要时查询目标仓库
+            if progress.aux.get('Digest'):
+                digest = progress.aux['Digest']
+            else:
+                destination = get_registry_client(context['registry_url'], context['user'], context['password'])
+                digest = resolve_manifest_digest(destination, context['repository'], context['tag']) or digest
         
         # 记录已推送的镜像
         record_pushed_image(
-            source_registry_url, target_registry_url, orig_name_space,
-            orig_image_name, targ_name_space, registry_image_name,
-            image_size, digest, platform
+            source_registry_url, context['registry_url'], orig_name_space,
+            orig_image_name, context['name_space'], registry_image_name,
+            image_size, digest, platform, context['source_digest']
         )
         
-        print(f"镜像 {source_image} 成功推送到 {registry_image_name}，大小: {image_size:.2f}MB")
-        
-        # # 清理本地镜像，释放空间
-        # print(f"清理本地镜像: {source_image} 和 {registry_image_name}")
-        # subprocess.run(f"docker rmi {source_image} {registry_image_name}", shell=True)
+        RUN_STATS.add('sync_seconds', pull_seconds + time.time() - push_started)
+        log(f"镜像 {source_image} 成功推送到 {registry_image_name}，大小: {image_size:.2f}MB")
+        RUN_STATS.add('pushed')
+        RUN_STATS.add('pushed_mb', image_size)
+        return True
+    
+    # 并发推送到各目标，每个目标有独立的推送记录和成功/失败状态
+    try:
+        with STAGE_CLOCK.stage('push'):
+            results = run_per_target(push_to_target, contexts)
+    finally:
+        # 本地镜像保留到需要空间时再按LRU删除，后续镜像可以复用共享的层；
+        # 推送出现非Docker错误时同样交给LRU管理，避免占用的空间一直不被归还
+        local_size = max(context.get('image_size', 0) for context in contexts) * 1024 * 1024
+        DISK_BUDGET.track(image['id'], [source_image] + [context['registry_image_name'] for context in contexts],
+                          int(local_size) or job['expected_bytes'] or 0)
+    
+    # 更新推送状态，有目标失败时安排重试（已成功的目标下次会被预检跳过）
+    finish_image(image, [context.get('error') or f"推送到 {context['target']} 失败"
+                         for context in contexts if not results.get(context['target'])])
+
+def get_target_repositories(target_registry_url, targ_name_space):
+    """获取目标仓库同一命名空间下已推送过的repository，作为跨仓库挂载blob的候选来源"""
+    key = (target_registry_url, targ_name_space)
+    with _registry_clients_lock:
+        if key in _target_repositories:
+            return _target_repositories[key]
+    
+    repositories = []
+    try:
+        with db_cursor() as cursor:
+            cursor.execute("""
+            SELECT registry_image_name FROM pushed_images
+            WHERE target_registry_url = %s AND targ_name_space = %s AND push_status = 1
+            ORDER BY push_time DESC
+            """, (target_registry_url, targ_name_space))
+            rows = cursor.fetchall()
+        prefix = f"{target_registry_url}/"
+        for (registry_image_name,) in rows:
+            repository = registry_image_name[len(prefix):].split('@')[0].rsplit(':', 1)[0]
+            if registry_image_name.startswith(prefix) and repository not in repositories:
+                repositories.append(repository)
+    except Error as e:
+        log(f"查询已推送仓库错误: {e}")
+    
+    with _registry_clients_lock:
+        _target_repositories[key] = repositories
+    return repositories
+
+def get_registry_client(registry_url, username=None, password=None):
+    """获取（或创建）仓库API客户端"""
+    key = (registry_url, username)
+    with _registry_clients_lock:
+        if key not in _registry_clients:
+            _registry_clients[key] = RegistryClient(registry_url, username, password)
+        return _registry_clients[key]
+
+def resolve_manifest_digest(client, repository, reference):
+    """通过HEAD请求获取清单摘要，失败或不存在时返回None"""
+    try:
+        digest, _ = client.head_manifest(repository, reference)
+        return digest
+    except (RegistryError, requests.RequestException) as e:
+        log(f"获取 {client.registry_url}/{repository}:{reference} 清单摘要失败: {e}")
+        return None
+
+def preflight_check(image, target_registry_url, registry_user, registry_password,
+                    targ_name_space, registry_image_name):
+    """预检：用HEAD请求获取源和目标的清单摘要并与数据库记录对比
+    
+    返回(是否跳过, 源清单摘要)。摘要都未变化时跳过，无需拉取镜像；
+    无法获取源摘要时退回到只检查推送记录是否存在
+    """
+    source_repo, reference = parse_source_reference(image['orig_name_space'], image['orig_image_name'])
+    source = get_registry_client(image['source_registry_url'])
+    source_digest = resolve_manifest_digest(source, source_repo, reference)
+    
+    if source_digest is None:
+        if is_image_pushed(image['orig_image_name'], target_registry_url):
+            log(f"镜像 {image['orig_image_name']} 已经推送到 {target_registry_url}，跳过")
+            RUN_STATS.add('skipped')
+            return True, None
+        return False, None
+    
+    record = get_pushed_record(target_registry_url, registry_image_name)
+    if not record or record['source_digest'] != source_digest:
+        return False, source_digest
+    
+    target_repo, tag = parse_target_reference(image['orig_image_name'], targ_name_space)
+    destination = get_registry_client(target_registry_url, registry_user, registry_password)
+    target_digest = resolve_manifest_digest(destination, target_repo, tag)
+    if target_digest is None or target_digest != record['digest']:
+        return False, source_digest
+    
+    log(f"镜像 {image['orig_image_name']} 源摘要 {source_digest} 与目标 {registry_image_name} 均未变化，跳过")
+    RUN_STATS.add('skipped')
+    RUN_STATS.add('preflight_skipped')
+    RUN_STATS.add('preflight_skipped_mb', float(record['image_size'] or 0))
+    return True, source_digest
+
+def copy_image_via_registry(image, targets):
+    """通过Registry HTTP API直接把镜像从源仓库复制到所有目标仓库，不经过Docker守护进程和本地磁盘"""
+    source_registry_url = image['source_registry_url']
+    orig_name_space = image['orig_name_space']
+    orig_image_name = image['orig_image_name']
+    platform = image['platform']
+    
+    source_repo, reference = parse_source_reference(orig_name_space, orig_image_name)
+    log(f"处理镜像: {source_registry_url}/{source_repo}:{reference}, 平台: {platform}, "
+        f"目标: {', '.join(targets)}（仓库直连复制）")
+    
+    # 预检各目标，全部未变化时直接返回
+    with METRICS.phase(image, 'preflight'):
+        contexts = plan_targets(image, targets)
+    if not contexts:
+        image['result'] = 'skipped'
+        update_push_status(image['id'])
+        return
+    
+    # 占用Docker Hub拉取额度，不足时推迟
+    if not acquire_hub_pulls(image):
+        return
+    
+    destinations = []
+    for context in contexts:
+        client = get_registry_client(context['registry_url'], context['user'], context['password'])
+        mount_candidates = get_target_repositories(context['registry_url'], context['name_space'])
+        destination = Destination(client, context['repository'], context['tag'], mount_candidates,
+                                  name=context['target'])
+        destination.context = context
+        destinations.append(destination)
+    
+    started = time.time()
+    try:
+        # 清单和blob只从源仓库获取一次，同时写入所有目标
+        source = get_registry_client(source_registry_url)
+        if is_multi_platform(platform):
+            copy_image_index(source, source_repo, reference, destinations, parse_platforms(platform), log=log)
+        else:
+            copy_image(source, source_repo, reference, destinations, platform, log=log)
+    except (RegistryError, requests.RequestException) as e:
+        if is_hub_rate_limited(e):
+            HUB_BUDGET.exhaust()
+            defer_rate_limited(image)
+            return
+        for destination in destinations:
+            destination.fail(e, log=log)
+    elapsed = time.time() - started
+    
+    errors = []
+    for destination in destinations:
+        context = destination.context
+        result = destination.result
+        if destination.error or 'digest' not in result:
+            METRICS.record(image, 'copy', elapsed, context['target'], result.get('transferred', 0), 'error')
+            log(f"复制镜像 {source_repo}:{reference} 到 {context['registry_image_name']} 失败")
+            RUN_STATS.add('failed')
+            record_push_failure(image, context)
+            errors.append(destination.error or f"复制到 {context['target']} 失败")
+            continue
         
-    except subprocess.CalledProcessError as e:
-        print(f"处理镜像 {source_image} 时出错: {e}")
+        METRICS.record(image, 'copy', elapsed, context['target'], result['transferred'])
+        for layer in result['layers']:
+            METRICS.record(image, 'layer', layer['seconds'], context['target'], layer['size'])
+        RUN_STATS.add('bytes_transferred', result['transferred'])
+        RUN_STATS.add('bytes_skipped', result['skipped'])
+        image_size = result['size'] / (1024 * 1024)
+        record_pushed_image(
+            source_registry_url, context['registry_url'], orig_name_space,
+            orig_image_name, context['name_space'], context['registry_image_name'],
+            image_size, result['digest'], platform, context['source_digest']
+        )
         
-        # 如果是磁盘空间不足导致的错误，尝试清理并更新状态
-        if "no space left on device" in str(e).lower():
-            print("检测到磁盘空间不足，尝试清理...")
-            clean_docker_images()
-            # 不更新推送状态，下次仍会尝试该镜像
-            return
+        # 多平台镜像为每个平台清单单独记录一行，以摘要引用区分
+        for platform_result in result['platforms']:
+            record_pushed_image(
+                source_registry_url, context['registry_url'], orig_name_space,
+                orig_image_name, context['name_space'],
+                f"{context['registry_url']}/{context['repository']}@{platform_result['digest']}",
+                platform_result['size'] / (1024 * 1024), platform_result['digest'],
+                platform_result['platform'], context['source_digest']
+            )
         
-        # 其他错误，更新推送状态为失败（可选）
-        # update_push_status_failed(image['id'])
+        RUN_STATS.add('sync_seconds', elapsed)
+        log(f"镜像 {source_repo}:{reference} 成功复制到 {context['registry_image_name']}，压缩大小: {image_size:.2f}MB，"
+            f"传输 {result['transferred'] / (1024 * 1024):.2f}MB，跳过已存在 {result['skipped'] / (1024 * 1024):.2f}MB")
+        RUN_STATS.add('pushed')
+        RUN_STATS.add('pushed_mb', image_size)
     
-    # 更新推送状态为成功
-    update_push_status(image['id'])
+    # 更新推送状态，有目标失败时安排重试
+    finish_image(image, errors)
+
+def begin_image(image, buffered=False):
+    """开始同步一个镜像，buffered为True时该镜像的日志先写入缓冲区，返回开始时间"""
+    if buffered:
+        _log_context.buffer = []
+    if image.get('queue_wait_seconds') is not None:
+        log(f"镜像 {image['orig_image_name']} 排队等待 {image['queue_wait_seconds']} 秒"
+            f"（优先级 {image.get('priority') or 0}）")
+        RUN_STATS.add('queue_wait_seconds', max(0, image['queue_wait_seconds']))
+        RUN_STATS.add('queue_wait_count')
+    return time.time()
+
+def run_guarded(image, func, *args):
+    """执行同步步骤，单个镜像的意外错误不应影响其他worker；出错时安排重试并返回None"""
+    try:
+        return func(*args)
+    except Exception as e:
+        log(f"同步镜像 {image['orig_image_name']} 时发生未预期的错误: {e}")
+        RUN_STATS.add('failed')
+        schedule_retry(image, [e])
+        return None
+
+def end_image(image, started, buffered=False):
+    """记录镜像的同步结果，buffered为True时整体输出该镜像的日志"""
+    status = image.get('result', 'ok')
+    METRICS.record(image, 'total', time.time() - started, status=status)
+    METRICS.count_image(status)
+    if buffered:
+        lines = _log_context.buffer
+        _log_context.buffer = None
+        with _print_lock:
+            print(f"===== 镜像 {image['orig_name_space']}/{image['orig_image_name']} 日志 =====")
+            print("\n".join(lines), flush=True)
+
+def sync_image(image, targets, buffered=False, mode='docker'):
+    """同步单个镜像；buffered为True时该镜像的日志在处理结束后整体输出"""
+    started = begin_image(image, buffered)
+    try:
+        run_guarded(image, copy_image_via_registry if mode == 'registry' else pull_and_push_image, image, targets)
+    finally:
+        end_image(image, started, buffered)
+
+class ImagePipeline:
+    """docker模式的流水线：拉取阶段提前拉取后续镜像，推送阶段同时推送已拉取的镜像
+    
+    拉取阶段最多领先推送阶段depth个镜像（已开始拉取、尚未开始推送），超过时等待；拉取前仍按预计大小
+    向DISK_BUDGET预留空间，空间不足时等待推送完成、删除已推送的镜像后再拉取，因此提前量同时受磁盘预算限制。
+    每个镜像的日志在推送结束后整体输出
+    """
+
+    def __init__(self, targets, workers, depth):
+        self.targets = targets
+        self._fetchers = ThreadPoolExecutor(max_workers=workers)
+        self._publishers = ThreadPoolExecutor(max_workers=workers)
+        self._ahead = threading.BoundedSemaphore(depth)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        # 拉取阶段会向推送阶段提交任务，先等拉取阶段结束；异常退出时取消尚未开始的任务，
+        # 已拉取但未推送的镜像由_discard归还磁盘预算
+        cancel = exc_type is not None
+        self._fetchers.shutdown(wait=True, cancel_futures=cancel)
+        self._publishers.shutdown(wait=True, cancel_futures=cancel)
+
+    def submit(self, image):
+        """提交一个镜像，返回的Future在镜像推送结束（或在拉取阶段结束）后完成"""
+        done = Future()
+        future = self._fetchers.submit(self._fetch, image, done)
+        future.add_done_callback(lambda f: f.cancelled() and done.cancel())
+        return done
+
+    def _fetch(self, image, done):
+        self._ahead.acquire()
+        started = begin_image(image, buffered=True)
+        job = run_guarded(image, fetch_image, image, self.targets)
+        if job is None:
+            self._ahead.release()
+            end_image(image, started, buffered=True)
+            done.set_result(None)
+            return
+        job['started'] = started
+        job['logs'] = _log_context.buffer
+        _log_context.buffer = None
+        try:
+            future = self._publishers.submit(self._publish, job, done)
+        except RuntimeError:
+            # 推送阶段已经关闭
+            self._discard(job, done)
+            return
+        future.add_done_callback(lambda f: f.cancelled() and self._discard(job, done))
+
+    def _publish(self, job, done):
+        self._ahead.release()
+        _log_context.buffer = job['logs']
+        try:
+            run_guarded(job['image'], publish_image, job)
+        finally:
+            # publish_image已交给LRU管理时这里不会改变预算；在那之前出错时归还已拉取镜像占用的空间
+            DISK_BUDGET.release(job['image']['id'])
+            end_image(job['image'], job['started'], buffered=True)
+            done.set_result(None)
+
+    def _discard(self, job, done):
+        """已拉取的镜像没有进入推送阶段（流水线关闭），归还提前量、磁盘预算和租约"""
+        image = job['image']
+        self._ahead.release()
+        DISK_BUDGET.release(image['id'])
+        image['result'] = 'deferred'
+        release_lease(image['id'])
+        _log_context.buffer = job['logs']
+        log(f"流水线已关闭，镜像 {job['source_image']} 未推送，留待下次同步")
+        end_image(image, job['started'], buffered=True)
+        done.set_result(None)
+
+def print_summary(total):
+    """输出本次运行的吞吐量统计"""
+    elapsed = max(time.time() - RUN_STATS.started, 0.001)
+    pushed = RUN_STATS.get('pushed')
+    pushed_mb = RUN_STATS.get('pushed_mb', 0.0)
+    log("========== 同步统计 ==========")
+    log(f"镜像总数: {total}，按目标仓库统计 成功: {pushed}, 跳过: {RUN_STATS.get('skipped')}, 失败: {RUN_STATS.get('failed')}")
+    log(f"推送数据量: {pushed_mb:.2f}MB, 总耗时: {elapsed:.1f}秒")
+    log(f"吞吐量: {pushed * 60 / elapsed:.2f} 镜像/分钟, {pushed_mb / elapsed:.2f}MB/s")
+    push_stage_seconds = RUN_STATS.get('push_stage_seconds', 0.0)
+    if push_stage_seconds:
+        overlap = RUN_STATS.get('pull_push_overlap_seconds', 0.0)
+        log(f"拉取 {RUN_STATS.get('pull_stage_seconds', 0.0):.1f}秒，推送 {push_stage_seconds:.1f}秒，"
+            f"拉取与推送同时进行 {overlap:.1f}秒（占推送时间的 {overlap * 100 / push_stage_seconds:.0f}%）")
+    if RUN_STATS.get('queue_wait_count'):
+        log(f"平均排队等待: {RUN_STATS.get('queue_wait_seconds') / RUN_STATS.get('queue_wait_count'):.1f}秒")
+    preflight_skipped = RUN_STATS.get('preflight_skipped')
+    if preflight_skipped:
+        # 按本次运行的实际同步速度估算节省的时间，没有同步数据时使用默认速度
+        sync_seconds = RUN_STATS.get('sync_seconds', 0.0)
+        rate = pushed_mb / sync_seconds if pushed_mb and sync_seconds else DEFAULT_SYNC_RATE_MBPS
+        saved_seconds = RUN_STATS.get('preflight_skipped_mb', 0.0) / rate
+        log(f"预检跳过未变化的镜像: {preflight_skipped} 个，预计节省 {saved_seconds:.1f}秒")
+    cache = get_blob_cache()
+    if cache and (cache.hits or cache.misses):
+        log(f"blob缓存: 命中 {cache.hits} 次，未命中 {cache.misses} 次，命中率 {cache.hits * 100 / (cache.hits + cache.misses):.1f}%，"
+            f"节省下载 {cache.bytes_saved / (1024 * 1024):.2f}MB，缓存大小 {cache.total_bytes / GB:.2f}GB")
+    sessions = get_upload_sessions()
+    if sessions is not None and sessions.resumed:
+        log(f"分块上传: 继续了 {sessions.resumed} 个中断的上传，免于重新上传 {sessions.resumed_bytes / (1024 * 1024):.2f}MB")
+    if DISK_BUDGET.evicted:
+        log(f"为腾出磁盘空间删除已推送的本地镜像: {DISK_BUDGET.evicted} 个，约 {DISK_BUDGET.evicted_bytes / GB:.2f}GB")
+    if HUB_BUDGET.used or RUN_STATS.get('rate_limited'):
+        log(f"Docker Hub拉取: 约 {HUB_BUDGET.used} 次，因额度不足推迟: {RUN_STATS.get('rate_limited')} 个镜像")
+    if RUN_STATS.get('retry_scheduled') or RUN_STATS.get('gave_up'):
+        log(f"安排重试: {RUN_STATS.get('retry_scheduled')} 次，放弃重试: {RUN_STATS.get('gave_up')} 个镜像")
+    bytes_transferred = RUN_STATS.get('bytes_transferred')
+    bytes_skipped = RUN_STATS.get('bytes_skipped')
+    if bytes_transferred or bytes_skipped:
+        log(f"blob传输: {bytes_transferred / (1024 * 1024):.2f}MB, "
+            f"目标仓库已存在而跳过: {bytes_skipped / (1024 * 1024):.2f}MB")
+
+def parse_targets(value):
+    """解析目标仓库列表，如 aliyun,private"""
+    targets = []
+    for target in value.split(','):
+        target = target.strip()
+        if target not in TARGET_CHOICES:
+            raise argparse.ArgumentTypeError(f"未知的目标仓库: {target}（可选: {', '.join(TARGET_CHOICES)}）")
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+def parse_registry_concurrency(value):
+    """解析各仓库的并发传输数，如 default=6,docker.io=8,aliyun=2"""
+    limits = {}
+    for item in value.split(','):
+        name, _, limit = item.strip().partition('=')
+        try:
+            limits[name.strip()] = int(limit)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"无效的仓库并发设置: {item}（格式: 仓库=数量）")
+    return limits
+
+def configure_transfers(args):
+    """按命令行参数设置registry模式下blob传输的并发数，仓库可以写地址或目标名aliyun、private"""
+    limits = dict(args.registry_concurrency or {})
+    default = limits.pop('default', None)
+    registries = {}
+    for name, limit in limits.items():
+        if name in TARGET_CHOICES:
+            if not os.environ.get('ALIYUN_REGISTRY' if name == 'aliyun' else 'MY_REGISTRY'):
+                print(f"目标 {name} 未配置仓库地址，忽略其并发设置")
+                continue
+            name = get_target_config(name, None)[0]
+        registries[name] = limit
+    TRANSFER_LIMITS.configure(layers=args.layer_concurrency, default=default, registries=registries,
+                              range_segments=args.range_segments, range_min_size=int(args.range_min_mb * 1024 * 1024))
 
 def main():
     parser = argparse.ArgumentParser(description='Docker镜像同步工具')
-    parser.add_argument('--target', choices=['aliyun', 'private'], required=True, help='目标仓库类型')
+    parser.add_argument('--target', type=parse_targets, default=os.environ.get('SYNC_TARGETS'),
+                        help='目标仓库类型: aliyun、private，或逗号分隔的多个目标如 aliyun,private'
+                             '（默认读取环境变量 SYNC_TARGETS）')
+    parser.add_argument('--workers', type=int, default=1, help='并发同步的镜像数量（默认1，即串行）')
+    parser.add_argument('--platforms',
+                        help='覆盖数据库中的平台配置: all 同步全部平台，或逗号分隔的平台列表，如 linux/amd64,linux/arm64')
+    parser.add_argument('--db-batch-size', type=int, default=STATUS_WRITER.batch_size,
+                        help='同步状态批量写入数据库的语句数量（默认%(default)s）')
+    parser.add_argument('--worker-id', default=os.environ.get('SYNC_WORKER_ID'), help='领取镜像时写入的worker标识（默认: 主机名-进程号，GitHub Actions中带运行编号）')
+    parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help='领取镜像的租约时长，进程崩溃后租约到期的镜像会被其他runner重新领取（默认%(default)s秒）')
+    parser.add_argument('--retry-window', type=int, default=DEFAULT_RETRY_WINDOW,
+                        help='队列处理完后，等待不超过该秒数即可到期的重试会在本次运行中完成，0表示不等待（默认%(default)s秒）')
+    parser.add_argument('--blob-cache', default=os.environ.get('SYNC_BLOB_CACHE'),
+                        help='registry模式下的本地blob缓存目录（OCI镜像布局），可在多次运行之间保留')
+    parser.add_argument('--blob-cache-size', type=float, default=DEFAULT_CACHE_SIZE_GB,
+                        help='blob缓存大小上限（GB），超过时淘汰最久未使用的blob（默认%(default)s）')
+    parser.add_argument('--upload-chunk-mb', type=float, default=DEFAULT_CHUNK_SIZE_MB,
+                        help='registry模式下超过该大小的blob分块PATCH上传，记录已确认的字节数，中断后（包括下次运行）'
+                             '从该位置继续，0表示总是单次上传（默认%(default)sMB）')
+    parser.add_argument('--upload-state', default=os.environ.get('SYNC_UPLOAD_STATE') or DEFAULT_STATE_PATH,
+                        help='未完成的分块上传记录文件，可在多次运行之间保留（默认 %(default)s）')
+    parser.add_argument('--layer-concurrency', type=int, default=DEFAULT_LAYER_CONCURRENCY,
+                        help='registry模式下每个镜像同时下载上传的层数（默认%(default)s）')
+    parser.add_argument('--registry-concurrency', type=parse_registry_concurrency,
+                        default=os.environ.get('SYNC_REGISTRY_CONCURRENCY'),
+                        help='各仓库同时传输的blob数，所有镜像共享，如 default=6,docker.io=8,aliyun=2；'
+                             f'仓库可以写地址或目标名，未列出的仓库使用default（默认{DEFAULT_REGISTRY_CONCURRENCY}）')
+    parser.add_argument('--range-segments', type=int, default=0,
+                        help='大blob拆成多个Range请求并行下载的数量，0表示不分段（默认%(default)s）')
+    parser.add_argument('--range-min-mb', type=float, default=DEFAULT_RANGE_MIN_SIZE // (1024 * 1024),
+                        help='启用分段下载的最小blob大小（默认%(default)sMB）')
+    parser.add_argument('--mode', choices=['docker', 'registry'], default='docker',
+                        help='同步方式: docker 通过本地Docker守护进程拉取推送; registry 通过Registry HTTP API直接复制')
+    parser.add_argument('--pipeline-depth', type=int, default=0,
+                        help='docker模式的流水线：推送当前镜像的同时提前拉取后续镜像，最多领先该数量的镜像，'
+                             '同时受磁盘预算限制；0表示不启用，每个worker拉取完一个镜像推送后再拉取下一个（默认%(default)s）')
+    parser.add_argument('--schedule', choices=SCHEDULE_POLICIES, default=DEFAULT_SCHEDULE,
+                        help='领取顺序: fifo 按入队顺序; priority 按优先级; sjf 按优先级，同一优先级中预计较小的镜像优先'
+                             '（默认%(default)s）')
+    parser.add_argument('--aging-minutes', type=int, default=DEFAULT_AGING_MINUTES,
+                        help='每排队等待该分钟数有效优先级加1，避免大镜像一直等待，0表示不老化（默认%(default)s）')
+    parser.add_argument('--metrics-textfile', default=os.environ.get('SYNC_METRICS_TEXTFILE'),
+                        help='写入Prometheus textfile格式的各阶段耗时和传输量，供node_exporter采集，如 /var/lib/node_exporter/mydocker_sync.prom')
+    parser.add_argument('--metrics-json', default=os.environ.get('SYNC_METRICS_JSON'),
+                        help='运行结束时写入JSON汇总（各阶段p50/p95耗时、传输量和每个镜像的明细）')
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help='以常驻服务方式运行：监听HTTP接口（POST /webhook、GET /status），收到镜像后立即同步')
     args = parser.parse_args()
+    if not args.target:
+        parser.error('需要通过 --target 或环境变量 SYNC_TARGETS 指定目标仓库')
+    pipelined = args.pipeline_depth > 0
+    if pipelined and (args.mode != 'docker' or args.serve):
+        parser.error('--pipeline-depth 只能用于docker模式的单次运行')
     
-    # 获取需要推送的镜像列表
-    images = get_images_to_push()
+    # 每个worker、每个目标都可能同时占用一个连接（流水线的拉取和推送阶段各有一组worker），常驻服务的HTTP接口另外需要连接
+    configure_pool(max(1, args.workers) * (2 if pipelined else 1) * len(args.target) + (4 if args.serve else 2))
+    STATUS_WRITER.batch_size = max(1, args.db_batch_size)
+    if args.blob_cache:
+        cache = configure_blob_cache(args.blob_cache, args.blob_cache_size)
+        print(f"blob缓存: {args.blob_cache}，已有 {cache.total_bytes / GB:.2f}GB，上限 {args.blob_cache_size}GB")
+    # docker模式下的多平台镜像同样通过Registry HTTP API复制
+    sessions = configure_upload_sessions(args.upload_state, args.upload_chunk_mb)
+    configure_transfers(args)
+    if sessions is not None and len(sessions):
+        print(f"未完成的分块上传: {len(sessions)} 个，需要时从已确认的位置继续")
     
-    if not images:
-        print("没有找到需要推送的镜像")
+    # 初始化数据库和表
+    from init_db import init_database
+    init_database()
+    
+    workers = max(1, args.workers)
+    worker_id = args.worker_id or default_worker_id()
+    order = schedule_order(args.schedule, args.aging_minutes)
+    METRICS.configure(args.metrics_textfile, args.metrics_json)
+    METRICS.start_run(worker_id, args.mode, args.target)
+    if args.serve:
+        from sync_server import serve
+        serve(args.serve, args.target, workers, worker_id, args.lease_seconds, args.mode, args.platforms, order)
+        print_db_timings()
         return
+    print(f"worker: {worker_id}，目标仓库: {', '.join(args.target)}，并发数: {workers}"
+          + (f"，流水线提前拉取: {args.pipeline_depth}" if pipelined else ''))
+    
+    # 读取Docker Hub拉取额度，不足以同步队列中全部Docker Hub镜像时按优先级领取
+    remaining, limit = check_docker_hub_rate_limit('开始')
+    HUB_BUDGET.set(remaining, limit)
+    prioritize = False
+    if remaining is not None:
+        pending = count_pending_docker_hub()
+        if pending > remaining:
+            print(f"Docker Hub拉取额度不足（待推送 {pending} 个），优先同步其他仓库和新镜像，其余镜像推迟")
+            prioritize = True
+    if args.schedule == 'sjf':
+        estimate_queue_sizes()
     
-    print(f"找到 {len(images)} 个需要推送的镜像")
+    stop_heartbeat = threading.Event()
+    start_lease_heartbeat(worker_id, args.lease_seconds, stop_heartbeat)
+    
+    claimed = set()
+    exhausted = False
+    futures = set()
+    if pipelined:
+        # 正在推送的镜像和提前拉取的镜像都占用领取名额
+        executor = ImagePipeline(args.target, workers, args.pipeline_depth)
+        capacity = workers + args.pipeline_depth
+        submit = executor.submit
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        capacity = workers
+        submit = lambda image: executor.submit(sync_image, image, args.target, workers > 1, args.mode)
+    with executor:
+        while True:
+            # worker有空闲时领取新镜像，其他runner已领取的镜像会被跳过
+            if not exhausted and len(futures) < capacity:
+                with METRICS.phase(None, 'claim'):
+                    images = get_images_to_push(worker_id, capacity - len(futures), args.lease_seconds,
+                                                skip_docker_hub=HUB_BUDGET.exhausted, prioritize=prioritize,
+                                                order=order)
+                if not images:
+                    exhausted = True
+                else:
+                    claimed.update(image['id'] for image in images)
+                    print(f"领取 {len(images)} 个需要推送的镜像")
+                for image in images:
+                    if args.platforms:
+                        image = dict(image, platform=args.platforms)
+                    futures.add(submit(image))
+            if not futures:
+                # 队列已空，等待即将到期的重试在本次运行中完成，而不是等到下一次触发
+                STATUS_WRITER.flush()
+                delay = next_retry_delay(skip_docker_hub=HUB_BUDGET.exhausted)
+                if delay is None or delay > args.retry_window:
+                    break
+                print(f"等待 {delay} 秒后重试失败的镜像")
+                time.sleep(delay)
+                exhausted = False
+                continue
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+            METRICS.export()
+    stop_heartbeat.set()
+    
+    total = len(claimed)
+    STATUS_WRITER.flush()
+    METRICS.finish_run(RUN_STATS.snapshot())
+    if not total:
+        print("没有找到需要推送的镜像")
+        return
     
-    # 处理每个镜像
-    for image in images:
-        pull_and_push_image(image, args.target)
+    if remaining is not None or HUB_BUDGET.used:
+        check_docker_hub_rate_limit('结束')
+    print_summary(total)
+    print_db_timings()
 
 if __name__ == "__main__":
+    # sync_server 通过 import sync_images 使用本模块，避免以脚本运行时再加载一份独立的副本
+    sys.modules.setdefault('sync_images', sys.modules[__name__])
     main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from mysql.connector import Error
+
+from db import db_cursor, STATUS_WRITER
+from add_webhook_image import parse_images
+from enqueue import enqueue_images
+from metrics import METRICS
+from sync_images import (get_images_to_push, next_retry_delay, check_docker_hub_rate_limit, start_lease_heartbeat,
+                         estimate_queue_sizes, sync_image, print_summary, HUB_BUDGET, RUN_STATS)
+
+# 请求体大小上限（字节）
+MAX_BODY_BYTES = 1024 * 1024
+
+# 队列为空时检查新镜像和到期重试的最长间隔（秒），收到Webhook时立即检查
+DEFAULT_POLL_INTERVAL = 60
+
+# 重新读取Docker Hub拉取额度的间隔（秒）
+RATE_LIMIT_REFRESH_SECONDS = 600
+
+HTTP_REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+def get_queue_depth():
+    """统计队列中各状态的镜像数量"""
+    try:
+        with db_cursor(dictionary=True) as cursor:
+            cursor.execute("""
+            SELECT
+                SUM(push_status = 0 AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())) AS pending,
+                SUM(push_status = 0 AND next_attempt_at > NOW()) AS waiting_retry,
+                SUM(push_status = 0 AND lease_expires_at >= NOW()) AS leased,
+                SUM(push_status = 2) AS failed
+            FROM images_for_push
+            """)
+            row = cursor.fetchone()
+            return {key: int(value or 0) for key, value in row.items()}
+    except Error as e:
+        print(f"查询队列错误: {e}")
+        return None
+
+class SyncServer:
+    """常驻同步服务
+
+    一个asyncio进程中同时运行HTTP接口和同步调度：Webhook写入队列后立即唤醒调度，
+    镜像在固定大小的线程池中同步，数据库连接池、仓库认证令牌、Docker连接和blob缓存在多次同步之间复用
+    """
+
+    def __init__(self, targets, workers, worker_id, lease_seconds, mode='docker', platforms=None, order='id',
+                 token=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.targets = targets
+        self.workers = workers
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.mode = mode
+        self.platforms = platforms
+        self.order = order
+        # 按大小调度时需要为新入队的镜像估算大小
+        self.estimate_sizes = 'estimated_size' in order
+        self.token = token
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # 镜像id -> {image, platform, started}
+        self.in_flight = {}
+        self.claimed = 0
+        self.received = 0
+        self.started = time.time()
+        self._wake = None
+        self._stopping = None
+        self._rate_limit_checked = 0
+
+    async def run(self, host, port):
+        self._wake = asyncio.Event()
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        stop_heartbeat = threading.Event()
+        start_lease_heartbeat(self.worker_id, self.lease_seconds, stop_heartbeat)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"同步服务已启动: http://{host}:{port}（POST /webhook 添加镜像，GET /status 查看状态），"
+              f"worker: {self.worker_id}，目标仓库: {', '.join(self.targets)}，并发数: {self.workers}", flush=True)
+        try:
+            await self.dispatch()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if self.in_flight:
+                print(f"等待 {len(self.in_flight)} 个正在同步的镜像完成...", flush=True)
+            self.executor.shutdown(wait=True)
+            stop_heartbeat.set()
+            STATUS_WRITER.flush()
+            METRICS.finish_run(RUN_STATS.snapshot())
+            print_summary(self.claimed)
+
+    async def dispatch(self):
+        """调度循环：worker有空闲时领取镜像；队列为空时等待Webhook、镜像完成或到期的重试"""
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            self._wake.clear()
+            await self.refresh_rate_limit()
+            free = self.workers - len(self.in_flight)
+            images = []
+            if free > 0:
+                started = time.time()
+                images = await asyncio.to_thread(get_images_to_push, self.worker_id, free, self.lease_seconds,
+                                                 HUB_BUDGET.exhausted, False, self.order)
+                METRICS.record(None, 'claim', time.time() - started)
+            for image in images:
+                if self.platforms:
+                    image = dict(image, platform=self.platforms)
+                self.claimed += 1
+                self.in_flight[image['id']] = {
+                    'image': f"{image['source_registry_url']}/{image['orig_name_space']}/{image['orig_image_name']}",
+                    'platform': image['platform'],
+                    'started': time.time(),
+                }
+                future = loop.run_in_executor(self.executor, sync_image, image, self.targets, self.workers > 1,
+                                              self.mode)
+                future.add_done_callback(lambda _, image_id=image['id']: self.finish(image_id))
+            if images and len(self.in_flight) < self.workers:
+                # 可能还有更多待推送的镜像
+                continue
+
+            timeout = self.poll_interval
+            if len(self.in_flight) < self.workers:
+                delay = await asyncio.to_thread(next_retry_delay, HUB_BUDGET.exhausted)
+                if delay is not None:
+                    timeout = min(timeout, max(delay, 1))
+            await self.wait_for_wake(timeout)
+
+    def finish(self, image_id):
+        """镜像同步结束（在事件循环中调用）"""
+        self.in_flight.pop(image_id, None)
+        asyncio.ensure_future(asyncio.to_thread(self.flush))
+        self._wake.set()
+
+    def flush(self):
+        """写入积累的同步状态和阶段事件，并更新指标文件"""
+        STATUS_WRITER.flush()
+        METRICS.writer.flush()
+        METRICS.export(RUN_STATS.snapshot())
+
+    async def wait_for_wake(self, timeout):
+        wake = asyncio.ensure_future(self._wake.wait())
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        await asyncio.wait({wake, stopping}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        wake.cancel()
+        stopping.cancel()
+
+    async def refresh_rate_limit(self):
+        """定期重新读取Docker Hub拉取额度，额度恢复后继续同步Docker Hub镜像；同时为新入队的镜像估算大小"""
+        if time.time() - self._rate_limit_checked < RATE_LIMIT_REFRESH_SECONDS:
+            return
+        self._rate_limit_checked = time.time()
+        remaining, limit = await asyncio.to_thread(check_docker_hub_rate_limit, '当前')
+        HUB_BUDGET.set(remaining, limit)
+        if self.estimate_sizes:
+            await asyncio.to_thread(estimate_queue_sizes)
+
+    def status(self, queue):
+        now = time.time()
+        return {
+            'worker_id': self.worker_id,
+            'uptime_seconds': int(now - self.started),
+            'workers': self.workers,
+            'queue': queue,
+            'in_flight': [dict(info, id=image_id, elapsed_seconds=int(now - info['started']))
+                          for image_id, info in self.in_flight.items()],
+            'claimed': self.claimed,
+            'webhook_images': self.received,
+            'docker_hub': {'remaining': HUB_BUDGET.remaining, 'limit': HUB_BUDGET.limit, 'used': HUB_BUDGET.used},
+            'stats': RUN_STATS.snapshot(),
+            'phases': METRICS.phase_summary(),
+        }
+
+    async def handle_connection(self, reader, writer):
+        """处理一个HTTP请求，响应后关闭连接"""
+        try:
+            code, body = await self.handle_request(reader)
+        except (asyncio.IncompleteReadError, ValueError, UnicodeDecodeError) as e:
+            code, body = 400, {'error': f"无效的请求: {e}"}
+        except Exception as e:
+            print(f"处理请求时发生错误: {e}", flush=True)
+            code, body = 500, {'error': str(e)}
+        data = json.dumps(body, ensure_ascii=False, default=str).encode('utf-8')
+        writer.write(f"HTTP/1.1 {code} {HTTP_REASONS.get(code, '')}\r\n"
+                     f"Content-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        method, path, _ = request_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        path = path.split('?', 1)[0]
+
+        if self.token and headers.get('authorization') != f"Bearer {self.token}":
+            return 401, {'error': '未授权'}
+        if path == '/status':
+            if method != 'GET':
+                return 405, {'error': '只支持GET'}
+            return 200, self.status(await asyncio.to_thread(get_queue_depth))
+        if path != '/webhook':
+            return 404, {'error': f"未知的路径: {path}"}
+        if method != 'POST':
+            return 405, {'error': '只支持POST'}
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+            return 413, {'error': f"请求体超过 {MAX_BODY_BYTES} 字节"}
+        payload = json.loads((await reader.readexactly(length)).decode('utf-8')) if length else None
+        # 与 repository_dispatch 的 client_payload 相同，接受 {"image": ...} 或 {"images": [...]}，可选 priority
+        priority = None
+        if isinstance(payload, dict):
+            priority = payload.get('priority')
+            payload = payload.get('image') or payload.get('images')
+        if priority is not None and not isinstance(priority, int):
+            return 400, {'error': 'priority 必须是整数'}
+        images = parse_images(payload)
+        if not images:
+            return 400, {'error': '没有有效的镜像'}
+        if not await asyncio.to_thread(enqueue_images, images, priority=priority):
+            return 500, {'error': '写入同步队列失败'}
+        self.received += len(images)
+        # 立即开始同步，不等待下一次轮询
+        self._wake.set()
+        if self.estimate_sizes:
+            # 在后台估算新镜像的大小，不阻塞响应和同步；按大小调度时不必等到下一次定期估算
+            asyncio.ensure_future(asyncio.to_thread(estimate_queue_sizes))
+        return 202, {'queued': len(images), 'in_flight': len(self.in_flight)}
+
+def serve(address, targets, workers, worker_id, lease_seconds, mode='docker', platforms=None, order='id'):
+    """以常驻服务方式运行同步，address为 HOST:PORT，order为领取顺序"""
+    host, _, port = address.rpartition(':')
+    server = SyncServer(targets, workers, worker_id, lease_seconds, mode, platforms, order,
+                        token=os.environ.get('SYNC_SERVER_TOKEN'))
+    asyncio.run(server.run(host or '127.0.0.1', int(port)))
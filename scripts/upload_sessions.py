@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import threading
+
+# 未完成的上传记录默认保存位置，在GitHub Actions中可通过actions/cache在多次运行之间保留
+DEFAULT_STATE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'mydocker-uploads', 'sessions.json')
+
+# 分块上传时每个PATCH请求的默认大小（MB），不超过该大小的blob仍然单次PUT上传
+DEFAULT_CHUNK_SIZE_MB = 32
+
+# 仓库默认会清理一周前未完成的上传，超过该秒数的记录不再尝试继续
+SESSION_MAX_AGE = 7 * 24 * 3600
+
+_sessions = None
+
+class UploadSessions:
+    """未完成的分块上传记录
+
+    按 仓库/repository@摘要 记录上传地址和目标仓库已确认的字节数，每个分块确认后写入本地JSON文件，
+    上传中断（包括进程退出）后可以从最后确认的字节继续，上传完成后删除记录。
+    同一进程中同一个blob同时只有一个线程使用其记录（claim/release）
+    """
+
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._sessions = {}
+        # 本进程中正在上传的blob，其记录只能由持有它的线程使用
+        self._active = set()
+        self.resumed = 0
+        self.resumed_bytes = 0
+        try:
+            with open(path) as f:
+                sessions = json.load(f)
+        except (OSError, ValueError):
+            sessions = {}
+        expired = time.time() - SESSION_MAX_AGE
+        self._sessions = {key: session for key, session in sessions.items() if session.get('updated', 0) > expired}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    @staticmethod
+    def key(registry_url, repository, digest):
+        return f"{registry_url}/{repository}@{digest}"
+
+    def claim(self, key):
+        """占用一个blob的上传记录，已被其他线程占用时返回False"""
+        with self._lock:
+            if key in self._active:
+                return False
+            self._active.add(key)
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._active.discard(key)
+
+    def get(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            return dict(session) if session else None
+
+    def save(self, key, location, offset, size):
+        """记录目标仓库已确认的字节数和下一次请求使用的上传地址"""
+        with self._lock:
+            self._sessions[key] = {'location': location, 'offset': offset, 'size': size, 'updated': time.time()}
+            self._write()
+
+    def remove(self, key):
+        with self._lock:
+            if self._sessions.pop(key, None) is not None:
+                self._write()
+
+    def count_resumed(self, offset):
+        with self._lock:
+            self.resumed += 1
+            self.resumed_bytes += offset
+
+    def _write(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self._sessions, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"写入上传记录失败: {e}")
+
+def configure_upload_sessions(path=DEFAULT_STATE_PATH, chunk_size_mb=DEFAULT_CHUNK_SIZE_MB):
+    """启用分块上传，chunk_size_mb为0时不启用"""
+    global _sessions
+    _sessions = UploadSessions(path, int(chunk_size_mb * 1024 * 1024)) if chunk_size_mb > 0 else None
+    return _sessions
+
+def get_upload_sessions():
+    """返回已启用的上传记录，未启用分块上传时返回None"""
+    return _sessions
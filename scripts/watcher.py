@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import base64
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+import requests
+
+from db import print_db_timings
+from enqueue import enqueue_images, parse_image_info, get_known_digests, record_source_digests
+from github_client import GitHubClient
+from init_db import init_database
+from registry_client import RegistryClient
+from watcher_state import get_watermark, set_watermark
+
+# 默认的来源配置文件
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'watchers.yaml')
+
+# 未配置tag_pattern时只处理 1.2.3 / v1.2.3 形式的版本tag
+DEFAULT_TAG_PATTERN = r'^v?[0-9]+\.[0-9]+\.[0-9]+'
+
+# 水位过旧或找不到时，每次最多处理的新tag数量
+MAX_NEW_TAGS = 20
+
+# 仓库标签来源默认只关注最新的几个版本（同一版本的变体标签如 -cpu 一起计算）
+DEFAULT_MAX_VERSIONS = 5
+
+# 并发获取清单摘要的HEAD请求数
+DEFAULT_HEAD_CONCURRENCY = 8
+
+# 从tag中提取版本号，如 v1.4.0-cu128 -> (1, 4, 0)
+VERSION_PATTERN = re.compile(r'^v?([0-9]+)(?:\.([0-9]+))?(?:\.([0-9]+))?')
+# 版本范围中的一个条件，如 >=1.4、<2、^1.4.0、~1.4
+SEMVER_CLAUSE_PATTERN = re.compile(r'(>=|<=|==|!=|>|<|=|\^|~)?\s*(v?[0-9]+(?:\.[0-9]+)*)')
+
+# 带ETag缓存的GitHub API客户端，所有来源共用
+GITHUB = GitHubClient()
+
+class WatcherError(Exception):
+    """来源配置错误或上游数据不足"""
+
+def log(source, message):
+    """输出带来源名称的日志，多个来源并发检查时便于区分"""
+    print(f"[{source['name']}] {message}", flush=True)
+
+def version_key(tag):
+    """按tag中的数字排序，如 1.10.0 排在 1.9.1 之后"""
+    return tuple(int(x) for x in re.findall(r'[0-9]+', tag)), tag
+
+def parse_version(tag):
+    """提取tag开头的版本号，缺少的部分补0；不是版本tag时返回None"""
+    match = VERSION_PATTERN.match(tag)
+    if not match:
+        return None
+    return tuple(int(part or 0) for part in match.groups())
+
+def semver_match(tag, spec):
+    """判断tag的版本是否满足版本范围，条件之间用逗号或空格分隔，如 ">=1.4, <2"
+
+    ^1.4.0 表示 >=1.4.0,<2.0.0；~1.4.0 表示 >=1.4.0,<1.5.0
+    """
+    version = parse_version(tag)
+    if version is None:
+        return False
+    clauses = SEMVER_CLAUSE_PATTERN.findall(spec)
+    if not clauses:
+        raise WatcherError(f"无效的版本范围: {spec}")
+    for op, bound in clauses:
+        bound = parse_version(bound)
+        op = op or '=='
+        if op == '^':
+            upper = (bound[0] + 1, 0, 0)
+        elif op == '~':
+            upper = (bound[0], bound[1] + 1, 0)
+        else:
+            upper = None
+        if upper:
+            ok = bound <= version < upper
+        else:
+            ok = {
+                '>=': version >= bound, '<=': version <= bound, '>': version > bound, '<': version < bound,
+                '==': version == bound, '=': version == bound, '!=': version != bound,
+            }[op]
+        if not ok:
+            return False
+    return True
+
+def get_new_tags(repo, pattern, watermark):
+    """获取水位之后匹配pattern的GitHub tag
+
+    返回(基准tag, 按版本从旧到新排列的新tag列表)。没有水位时只返回最新的tag，以前一个tag为基准
+    """
+    tags = []
+    found = False
+    for tag in GITHUB.paginate(f"/repos/{repo}/tags", {'per_page': 100}):
+        # 遇到水位后不再请求后续页面
+        name = tag['name']
+        if not re.match(pattern, name):
+            continue
+        if name == watermark:
+            found = True
+            break
+        tags.append(name)
+        if (watermark is None and len(tags) == 2) or len(tags) > MAX_NEW_TAGS:
+            break
+
+    tags.sort(key=version_key)
+    if found:
+        return watermark, tags
+    if len(tags) < 2:
+        raise WatcherError(f"{repo} 中没有找到足够的匹配 {pattern} 的tag")
+    return tags[0], tags[1:]
+
+def get_file_content(repo, tag, path):
+    """获取指定tag中文件的内容，文件不存在时返回None"""
+    try:
+        content = GITHUB.get(f"/repos/{repo}/contents/{path}", {'ref': tag})
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+    if 'content' in content:
+        return base64.b64decode(content['content']).decode('utf-8')
+    return None
+
+def extract_images_from_yaml(yaml_content):
+    """从docker-compose内容中提取所有服务的镜像"""
+    if not yaml_content:
+        return []
+    docker_compose = yaml.safe_load(yaml_content) or {}
+    return [service['image'] for service in (docker_compose.get('services') or {}).values()
+            if isinstance(service, dict) and 'image' in service]
+
+def poll_github_tags(source, watermark):
+    """GitHub tag -> 镜像模板：每个新tag生成一个镜像，如 xprobe/xinference:{tag}"""
+    pattern = source.get('tag_pattern', DEFAULT_TAG_PATTERN)
+    _, new_tags = get_new_tags(source['repo'], pattern, watermark)
+    if not new_tags:
+        log(source, f"没有新的tag（水位: {watermark}）")
+        return [], None
+    log(source, f"新tag: {', '.join(new_tags)}")
+    return [source['image'].format(tag=tag) for tag in new_tags], new_tags[-1]
+
+def poll_compose_diff(source, watermark):
+    """按版本顺序对比每个新tag与前一个tag的compose文件，返回新增或更改的镜像"""
+    pattern = source.get('tag_pattern', DEFAULT_TAG_PATTERN)
+    baseline_tag, new_tags = get_new_tags(source['repo'], pattern, watermark)
+    if not new_tags:
+        # tag列表未变化，无需获取compose文件
+        log(source, f"没有新的tag（水位: {watermark}）")
+        return [], None
+    log(source, f"基准tag: {baseline_tag}，新tag: {', '.join(new_tags)}")
+
+    previous_images = set(extract_images_from_yaml(get_file_content(source['repo'], baseline_tag, source['path'])))
+    images = []
+    for tag in new_tags:
+        content = get_file_content(source['repo'], tag, source['path'])
+        current_images = set(extract_images_from_yaml(content))
+        changed = current_images - previous_images
+        log(source, f"tag {tag}: 新增或更改的镜像 {len(changed)} 个")
+        images.extend(sorted(changed))
+        if content:
+            previous_images = current_images
+    return images, new_tags[-1]
+
+def select_registry_tags(tags, source):
+    """按tag_pattern和semver过滤标签，保留最新的max_versions个版本
+
+    没有版本号的标签（如latest）只按tag_pattern过滤，用于发现同一标签被重新推送
+    """
+    pattern = source.get('tag_pattern', DEFAULT_TAG_PATTERN)
+    spec = source.get('semver')
+    tags = [tag for tag in tags if re.match(pattern, tag)
+            and (not spec or parse_version(tag) is None or semver_match(tag, spec))]
+    versions = sorted({parse_version(tag) for tag in tags} - {None})
+    latest = set(versions[-source.get('max_versions', DEFAULT_MAX_VERSIONS):])
+    return sorted((tag for tag in tags if parse_version(tag) is None or parse_version(tag) in latest),
+                  key=version_key)
+
+def poll_registry_tags(source, watermark):
+    """直接列出源仓库的标签，并发HEAD获取清单摘要，只返回新标签和摘要变化（被重新推送）的标签"""
+    registry_url, namespace, repository = parse_image_info(source['image'])
+    repository = repository.split(':', 1)[0]
+    repo = f"{namespace}/{repository}" if namespace else repository
+    client = RegistryClient(registry_url)
+    tags = select_registry_tags(client.list_tags(repo), source)
+
+    known = get_known_digests(registry_url, namespace, repository)
+    if known is None:
+        raise WatcherError("无法读取队列中已有的标签")
+
+    def head(tag):
+        digest, _ = client.head_manifest(repo, tag)
+        return tag, digest
+
+    # Docker Hub 的HEAD请求不计入拉取限额
+    with ThreadPoolExecutor(max_workers=source.get('concurrency', DEFAULT_HEAD_CONCURRENCY)) as executor:
+        digests = list(executor.map(head, tags))
+
+    images = []
+    new_tags = []
+    changed_tags = []
+    unknown = {}
+    for tag, digest in digests:
+        name = f"{repository}:{tag}"
+        if digest is None:
+            continue
+        if name not in known:
+            new_tags.append(tag)
+        elif known[name] is None:
+            # 摘要列加入之前入队的镜像没有记录摘要，无法判断是否变化，只记录当前摘要，避免全部重新同步
+            unknown[name] = digest
+            continue
+        elif known[name] != digest:
+            changed_tags.append(tag)
+        else:
+            continue
+        images.append((f"{registry_url}/{repo}:{tag}", digest))
+    if unknown and record_source_digests(registry_url, namespace, unknown):
+        log(source, f"记录了 {len(unknown)} 个已有标签的源清单摘要")
+    log(source, f"匹配的标签: {len(tags)} 个，新标签: {', '.join(new_tags) or '无'}，"
+                f"摘要变化: {', '.join(changed_tags) or '无'}")
+    return images, None
+
+# 来源类型 -> 检查函数，检查函数返回(镜像列表, 新水位)，镜像为引用字符串或(引用, 源清单摘要)
+POLLERS = {
+    'github_tags': poll_github_tags,
+    'compose_diff': poll_compose_diff,
+    'registry_tags': poll_registry_tags,
+}
+
+def watermark_name(source):
+    return source.get('watermark', f"{source['name']}_tags")
+
+def poll_source(source):
+    """检查一个来源，返回 {source, images, watermark, error}"""
+    result = {'source': source, 'images': [], 'watermark': None, 'error': None}
+    try:
+        images, result['watermark'] = POLLERS[source['type']](source, get_watermark(watermark_name(source)))
+        platform = source.get('platform', 'linux/amd64')
+        result['images'] = [(image, platform) if isinstance(image, str) else (image[0], platform, image[1])
+                            for image in images]
+    except Exception as e:
+        # 单个来源失败（包括读取水位失败）不影响其他来源，本次运行跳过该来源
+        log(source, f"检查失败: {e}")
+        result['error'] = e
+    return result
+
+async def poll_all(sources):
+    """在一个进程中并发检查所有来源"""
+    return await asyncio.gather(*(asyncio.to_thread(poll_source, source) for source in sources))
+
+def load_config(path, names=None):
+    """读取来源配置，names不为空时只返回指定名称的来源"""
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    sources = config.get('sources') or []
+    for source in sources:
+        if not source.get('name') or source.get('type') not in POLLERS:
+            raise WatcherError(f"来源配置无效: {source}（type 可选: {', '.join(POLLERS)}）")
+    if names:
+        unknown = set(names) - {source['name'] for source in sources}
+        if unknown:
+            raise WatcherError(f"配置中没有这些来源: {', '.join(sorted(unknown))}")
+        sources = [source for source in sources if source['name'] in names]
+    return sources
+
+def main():
+    parser = argparse.ArgumentParser(description='上游镜像监控：检查配置的所有来源并把新镜像加入同步队列')
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help='来源配置文件（默认 watchers.yaml）')
+    parser.add_argument('--source', action='append', help='只检查指定名称的来源，可重复指定')
+    parser.add_argument('--dry-run', action='store_true', help='只输出发现的镜像，不写入数据库')
+    args = parser.parse_args()
+
+    try:
+        sources = load_config(args.config, args.source)
+    except (OSError, yaml.YAMLError, WatcherError) as e:
+        print(f"读取来源配置失败: {e}")
+        sys.exit(1)
+
+    # 确保队列和水位表存在
+    if not args.dry_run:
+        init_database()
+
+    results = asyncio.run(poll_all(sources))
+    images = [image for result in results for image in result['images']]
+    failed = [result['source']['name'] for result in results if result['error']]
+    print(f"检查来源 {len(sources)} 个，发现镜像 {len(images)} 个，失败 {len(failed)} 个")
+
+    has_new_images = False
+    if args.dry_run:
+        for image in images:
+            print(f"{image[0]} ({image[1]})")
+    elif enqueue_images(images):
+        has_new_images = bool(images)
+        # 全部镜像写入后才推进水位，失败时下次重新处理
+        for result in results:
+            if result['watermark']:
+                set_watermark(watermark_name(result['source']), result['watermark'])
+
+    # 设置GitHub Actions输出变量
+    with open(os.environ.get('GITHUB_OUTPUT', '/dev/null'), 'a') as f:
+        f.write(f"has_new_images={str(has_new_images).lower()}\n")
+
+    if has_new_images:
+        print("发现新镜像，将触发Docker Image Sync工作流")
+    else:
+        print("未发现新镜像")
+
+    print_db_timings()
+    GITHUB.print_stats()
+    if failed:
+        print(f"检查失败的来源: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from mysql.connector import Error
+
+from db import db_cursor
+
+def get_watermark(name):
+    """读取水位（上次处理到的位置，如tag），没有记录时返回None
+
+    读取失败时抛出异常而不是返回None，否则会被当作第一次运行而从头重新处理
+    """
+    try:
+        with db_cursor() as cursor:
+            cursor.execute("SELECT last_value FROM watcher_state WHERE name = %s", (name,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except Error as e:
+        print(f"读取水位错误: {e}")
+        raise
+
+def set_watermark(name, value):
+    """记录水位，之后的运行只处理该位置之后的新内容"""
+    try:
+        with db_cursor(commit=True) as cursor:
+            cursor.execute("""
+            INSERT INTO watcher_state (name, last_value) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE last_value = VALUES(last_value), updated_at = CURRENT_TIMESTAMP
+            """, (name, value))
+        return True
+    except Error as e:
+        print(f"记录水位错误: {e}")
+        return False